@@ -5,8 +5,9 @@ Entry point for deployment
 import os
 from business_management_system import app, init_db
 
-# Initialize database
-init_db()
+# Bring the schema up to date (set MIGRATE_ON_STARTUP=0 to run `flask migrate` separately)
+if os.environ.get('MIGRATE_ON_STARTUP', '1') == '1':
+    init_db()
 
 # For gunicorn
 if __name__ == '__main__':
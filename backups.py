@@ -0,0 +1,267 @@
+"""
+Online snapshots, retention and restore
+
+snapshot() copies a live database with SQLite's online backup API, which
+reads pages through SQLite itself, so the copy is always consistent no
+matter how much gunicorn is writing -- unlike copying the file, which can
+catch the database and its -wal file mid-write.  The copy runs BACKUP_PAGES
+pages per step with a BACKUP_PAUSE sleep in between, so a backup trickles
+through the disk instead of saturating it while checkouts are running.
+
+A write from another connection restarts an in-progress backup.  On a busy
+store that could go on forever, so after BACKUP_MAX_RESTARTS restarts the
+rest is copied in a single step; in WAL mode that step only holds a read
+snapshot, which never blocks writers.
+
+Each snapshot is written as <store>-<timestamp>.db.partial, checked with
+PRAGMA integrity_check, switched to a self-contained rollback-journal file
+and only then renamed to .db, so anything ending in .db in BACKUP_DIR is a
+verified, complete copy.  prune() keeps the newest BACKUP_KEEP per store.
+
+With BACKUP_INTERVAL_HOURS set, each worker runs a scheduler thread; a lock
+file makes sure only one process snapshots at a time, and a store is only
+snapshotted once its newest snapshot is older than the interval.
+
+restore() writes a snapshot back into a database through the same backup
+API (after saving a pre-restore snapshot), so connections already open in
+running workers see the restored data instead of a swapped-out file.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows: schedule backups from a single process
+    fcntl = None
+
+BACKUP_DIR = os.environ.get('BACKUP_DIR', 'backups')
+BACKUP_PAGES = int(os.environ.get('BACKUP_PAGES', 256))
+BACKUP_PAUSE = float(os.environ.get('BACKUP_PAUSE', 0.005))
+BACKUP_MAX_RESTARTS = int(os.environ.get('BACKUP_MAX_RESTARTS', 10))
+BACKUP_KEEP = int(os.environ.get('BACKUP_KEEP', 14))
+BACKUP_INTERVAL_HOURS = float(os.environ.get('BACKUP_INTERVAL_HOURS', 0))
+SCHEDULER_POLL = 60
+BUSY_TIMEOUT = 10
+
+
+class BackupError(Exception):
+    pass
+
+
+def _open(path):
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT * 1000}")
+    return conn
+
+
+def verify(path):
+    """Run PRAGMA integrity_check on a database file; returns the list of problems (empty if sound)."""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        problems = [row[0] for row in conn.execute("PRAGMA integrity_check")]
+    except sqlite3.DatabaseError as e:
+        problems = [str(e)]
+    finally:
+        conn.close()
+    return [] if problems == ['ok'] else problems
+
+
+class _Restarted(Exception):
+    pass
+
+
+def _copy(source, target, pages, pause):
+    # Page-batched copy; returns how many times a concurrent write restarted it
+    progress = {'remaining': None, 'restarts': 0}
+
+    def on_step(status, remaining, total):
+        if progress['remaining'] is not None and remaining > progress['remaining']:
+            progress['restarts'] += 1
+        progress['remaining'] = remaining
+        if progress['restarts'] >= BACKUP_MAX_RESTARTS:
+            raise _Restarted()
+        time.sleep(pause)
+
+    try:
+        source.backup(target, pages=pages, progress=on_step)
+    except _Restarted:
+        source.backup(target)
+    return progress['restarts']
+
+
+def _snapshot_name(store, now):
+    return f"{store}-{now.strftime('%Y%m%d-%H%M%S')}.db"
+
+
+def snapshot(path, store='main', backup_dir=None, pages=None, pause=None, label=None):
+    """Back the database at `path` up into backup_dir; returns a summary dict.
+
+    Raises BackupError (and leaves no .db file behind) if the copy fails its integrity check.
+    """
+    backup_dir = backup_dir or BACKUP_DIR
+    os.makedirs(backup_dir, exist_ok=True)
+    now = datetime.now()
+    name = _snapshot_name(f"{store}-{label}" if label else store, now)
+    final = os.path.join(backup_dir, name)
+    partial = final + '.partial'
+
+    started = time.perf_counter()
+    source, target = _open(path), sqlite3.connect(partial)
+    try:
+        restarts = _copy(source, target, pages or BACKUP_PAGES, BACKUP_PAUSE if pause is None else pause)
+        # A snapshot should be one file that opens anywhere, without a -wal next to it
+        target.execute("PRAGMA journal_mode = DELETE")
+        page_count = target.execute("PRAGMA page_count").fetchone()[0]
+    finally:
+        source.close()
+        target.close()
+
+    problems = verify(partial)
+    if problems:
+        os.remove(partial)
+        raise BackupError(f"Snapshot of {path} failed integrity check: {'; '.join(problems[:5])}")
+    os.replace(partial, final)
+    return {'store': store, 'path': final, 'created_at': now.strftime("%Y-%m-%d %H:%M:%S"),
+            'bytes': os.path.getsize(final), 'pages': page_count, 'restarts': restarts,
+            'seconds': round(time.perf_counter() - started, 3)}
+
+
+def list_snapshots(store='main', backup_dir=None):
+    """Verified snapshots of one store, newest first: [(path, created datetime, bytes)]."""
+    backup_dir = backup_dir or BACKUP_DIR
+    if not os.path.isdir(backup_dir):
+        return []
+    snapshots = []
+    for filename in os.listdir(backup_dir):
+        # <store>-YYYYmmdd-HHMMSS.db; pre-restore copies carry an extra label and are not pruned
+        head, ext = os.path.splitext(filename)
+        prefix, stamp = head[:-16], head[-15:]
+        if ext != '.db' or prefix != store or head[-16:-15] != '-':
+            continue
+        try:
+            created = datetime.strptime(stamp, '%Y%m%d-%H%M%S')
+        except ValueError:
+            continue
+        path = os.path.join(backup_dir, filename)
+        snapshots.append((path, created, os.path.getsize(path)))
+    snapshots.sort(key=lambda s: s[1], reverse=True)
+    return snapshots
+
+
+def prune(store='main', backup_dir=None, keep=None):
+    """Delete all but the newest `keep` snapshots of a store; returns the deleted paths."""
+    keep = BACKUP_KEEP if keep is None else keep
+    removed = []
+    for path, _, _ in list_snapshots(store, backup_dir)[keep:]:
+        os.remove(path)
+        removed.append(path)
+    return removed
+
+
+def _counters(conn):
+    # Highest data version and catalog change number, where the schema has them
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    version = conn.execute("SELECT MAX(version) FROM data_versions").fetchone()[0] \
+        if 'data_versions' in tables else None
+    change = conn.execute("SELECT MAX(version) FROM stock_changes").fetchone()[0] \
+        if 'stock_changes' in tables else None
+    return tables, version or 0, change or 0
+
+
+def _advance_counters(conn, before):
+    # Workers' caches (versions.py) and tills (pos_sync.py) only notice changes
+    # through counters going up; move them past their pre-restore values so
+    # every cache reloads and every till pulls the whole restored catalog.
+    tables, version, change = _counters(conn)
+    if 'data_versions' in tables:
+        conn.execute("UPDATE data_versions SET version = version + ?", (max(before[1], version) + 1,))
+    if 'stock_changes' in tables:
+        # Shifted past every old number at once, so the unique index never sees a clash
+        conn.execute("UPDATE stock_changes SET version = version + ?", (max(before[2], change) + 1,))
+    conn.commit()
+
+
+def restore(snapshot_path, path, store='main', backup_dir=None):
+    """Replace the contents of the database at `path` with a snapshot.
+
+    The snapshot is verified first and the current database is saved as a
+    '<store>-pre-restore-...' snapshot.  Returns that safety snapshot's summary.
+    """
+    problems = verify(snapshot_path)
+    if problems:
+        raise BackupError(f"{snapshot_path} failed integrity check: {'; '.join(problems[:5])}")
+    safety = snapshot(path, store, backup_dir, label='pre-restore')
+
+    source, target = sqlite3.connect(f"file:{snapshot_path}?mode=ro", uri=True), _open(path)
+    try:
+        before = _counters(target)
+        # One step: the target is write-locked for the copy, so nobody sees a half-restored database
+        source.backup(target)
+        target.execute("PRAGMA journal_mode = WAL")
+        _advance_counters(target, before)
+    finally:
+        source.close()
+        target.close()
+    return safety
+
+
+def _due(store, backup_dir, interval_hours):
+    snapshots = list_snapshots(store, backup_dir)
+    return not snapshots or (datetime.now() - snapshots[0][1]).total_seconds() >= interval_hours * 3600
+
+
+def run_scheduled(stores, backup_dir=None, interval_hours=None):
+    """Snapshot and prune every store whose newest snapshot is older than the interval."""
+    backup_dir = backup_dir or BACKUP_DIR
+    interval_hours = interval_hours or BACKUP_INTERVAL_HOURS
+    os.makedirs(backup_dir, exist_ok=True)
+    done = []
+    with open(os.path.join(backup_dir, '.schedule.lock'), 'w') as lock:
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return done  # another worker is already on it
+        for store, path in stores.items():
+            if os.path.exists(path) and _due(store, backup_dir, interval_hours):
+                done.append(snapshot(path, store, backup_dir))
+                prune(store, backup_dir)
+    return done
+
+
+class Scheduler:
+    """Per-worker thread that calls run_scheduled() every SCHEDULER_POLL seconds."""
+
+    def __init__(self, stores_fn):
+        self.stores_fn = stores_fn
+        self._thread = threading.Thread(target=self._run, name='backup-scheduler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                for result in run_scheduled(self.stores_fn()):
+                    print(f"Backup: {result['path']} ({result['bytes']} bytes, {result['seconds']} s)")
+            except Exception as e:
+                print(f"Backup scheduler error: {e}")
+            time.sleep(SCHEDULER_POLL)
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def ensure_scheduler(stores_fn):
+    """Start this worker's backup scheduler if BACKUP_INTERVAL_HOURS is set and it is not running yet."""
+    if BACKUP_INTERVAL_HOURS <= 0 or os.getpid() in _schedulers:
+        return
+    with _schedulers_lock:
+        if os.getpid() not in _schedulers:
+            scheduler = _schedulers[os.getpid()] = Scheduler(stores_fn)
+            scheduler.start()
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+Benchmark harness
+
+Builds a synthetic database (see synthetic.py) in a temporary directory
+through init_db(), then drives the real routes and reports throughput and
+p50/p90/p99 latency per route as JSON:
+
+  client    in-process through the Flask test client (C threads)
+  gunicorn  a multi-process gunicorn server over HTTP (W workers, C client threads)
+
+    python benchmarks/bench.py                            # defaults, both drivers
+    python benchmarks/bench.py --skus 20000 --years 3 --requests 500
+    python benchmarks/bench.py --compare benchmarks/results/<old>.json
+
+Results are written to benchmarks/results/<commit>-<timestamp>.json (or
+--out).  With --compare, each route is checked against an earlier result
+and the run exits non-zero if any p99 or throughput regresses by more than
+--max-regression percent.
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+
+
+def _invoice_body(rng, data):
+    lines = []
+    for name in rng.sample(data['products'], rng.randint(1, 3)):
+        quantity = rng.randint(1, 3)
+        lines.append({'product_name': name, 'quantity': quantity, 'price': 100, 'total': quantity * 100})
+    return {'customer_name': f"Customer {rng.randint(1, 500):04d}", 'customer_phone': '',
+            'payment_type': rng.choice(('cash', 'cash', 'cash', 'credit')), 'items': lines}
+
+
+# name -> (method, path(rng, data), json body(rng, data) or None)
+SCENARIOS = {
+    'dashboard': ('GET', lambda rng, data: '/', None),
+    'analytics': ('GET', lambda rng, data: '/analytics', None),
+    'get_all_stock': ('GET', lambda rng, data: '/get_all_stock', None),
+    'ledger': ('GET', lambda rng, data: '/ledger?format=json', None),
+    'print_invoice': ('GET', lambda rng, data: f"/print_invoice/{rng.choice(data['invoices'])}", None),
+    'create_invoice': ('POST', lambda rng, data: '/create_invoice', _invoice_body),
+}
+
+
+def percentile(latencies, p):
+    """Nearest-rank percentile of a sorted list."""
+    if not latencies:
+        return None
+    return latencies[max(0, min(len(latencies) - 1, math.ceil(p / 100 * len(latencies)) - 1))]
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def summarize(latencies, errors, seconds):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': round(seconds, 3),
+        'throughput_rps': round(len(latencies) / seconds, 1) if seconds else None,
+        'p50_ms': _ms(percentile(latencies, 50)),
+        'p90_ms': _ms(percentile(latencies, 90)),
+        'p99_ms': _ms(percentile(latencies, 99)),
+        'max_ms': _ms(latencies[-1] if latencies else None),
+    }
+
+
+def _failed(status, body):
+    # Routes report most failures as 200 {'success': False}
+    if status >= 400:
+        return True
+    if body[:1] == b'{':
+        try:
+            return json.loads(body).get('success') is False
+        except ValueError:
+            return False
+    return False
+
+
+def run_load(send, scenario, data, requests, concurrency, seed):
+    """Issue `requests` calls of one scenario from `concurrency` threads; returns the summary."""
+    method, path, body = SCENARIOS[scenario]
+    latencies, errors, lock = [], [0], threading.Lock()
+    per_thread = [requests // concurrency + (i < requests % concurrency) for i in range(concurrency)]
+
+    def worker(index):
+        rng = random.Random(seed * 1000 + index)
+        mine = []
+        for _ in range(per_thread[index]):
+            url = path(rng, data)
+            payload = body(rng, data) if body else None
+            started = time.perf_counter()
+            status, content = send(method, url, payload)
+            mine.append(time.perf_counter() - started)
+            if _failed(status, content):
+                with lock:
+                    errors[0] += 1
+        with lock:
+            latencies.extend(mine)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    return summarize(latencies, errors[0], time.perf_counter() - started)
+
+
+def client_driver(app):
+    local = threading.local()
+
+    def send(method, url, payload):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        response = local.client.open(url, method=method, json=payload)
+        return response.status_code, response.get_data()
+    return send
+
+
+def http_driver(base_url):
+    def send(method, url, payload):
+        data = json.dumps(payload).encode() if payload is not None else None
+        request = urllib.request.Request(base_url + url, data=data, method=method,
+                                         headers={'Content-Type': 'application/json'} if data else {})
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+    return send
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(db_path, workers):
+    port = _free_port()
+    env = dict(os.environ, DATABASE_PATH=db_path)
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--workers', str(workers), '--threads', '4',
+                               '--bind', f'127.0.0.1:{port}', '--pythonpath', f'{ROOT},{HERE}',
+                               '--log-level', 'warning', 'bench_wsgi:app'], env=env, cwd=ROOT)
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with code {server.returncode}")
+        try:
+            urllib.request.urlopen(base_url + '/get_all_stock', timeout=5).read()
+            return server, base_url
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("gunicorn did not start within 60 s")
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(results, baseline_path, max_regression):
+    """Print per-route changes against an earlier result; returns the list of regressions."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    regressions = []
+    print(f"\nAgainst {baseline_path} ({baseline['meta'].get('commit')}):")
+    for driver, routes in results['results'].items():
+        for route, now in routes.items():
+            before = baseline['results'].get(driver, {}).get(route)
+            if not before:
+                continue
+            changes = []
+            for key, worse_if_higher in (('p99_ms', True), ('throughput_rps', False)):
+                if not before.get(key) or now.get(key) is None:
+                    continue
+                change = (now[key] - before[key]) / before[key] * 100
+                changes.append(f"{key} {before[key]} -> {now[key]} ({change:+.1f}%)")
+                if (change if worse_if_higher else -change) > max_regression:
+                    regressions.append(f"{driver}/{route} {key}")
+            print(f"  {driver:8} {route:15} " + ', '.join(changes))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--skus', type=int, default=2000)
+    parser.add_argument('--years', type=float, default=1.0)
+    parser.add_argument('--sales-per-day', type=int, default=100)
+    parser.add_argument('--customers', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--requests', type=int, default=200, help='requests per route and driver')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn worker processes')
+    parser.add_argument('--drivers', default='client,gunicorn')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--out')
+    parser.add_argument('--compare')
+    parser.add_argument('--max-regression', type=float, default=20.0, help='percent')
+    parser.add_argument('--keep-db', action='store_true')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    db_path = os.path.join(workdir, 'bench.db')
+    # Must be set before the app (and database.py) is imported
+    os.environ['DATABASE_PATH'] = db_path
+    os.environ.setdefault('SLOW_QUERY_MS', '1000')
+    from bench_wsgi import app
+    from synthetic import generate
+
+    print(f"Generating {args.skus} SKUs x {args.years} years into {db_path} ...")
+    started = time.perf_counter()
+    data = generate(db_path, skus=args.skus, years=args.years, sales_per_day=args.sales_per_day,
+                    customers=args.customers, seed=args.seed)
+    data['generate_seconds'] = round(time.perf_counter() - started, 1)
+    print(f"  {data['rows']} in {data['generate_seconds']} s")
+
+    scenarios = [name for name in args.scenarios.split(',') if name]
+    results = {}
+    for driver in args.drivers.split(','):
+        server = None
+        if driver == 'client':
+            send = client_driver(app)
+        elif driver == 'gunicorn':
+            server, base_url = start_gunicorn(db_path, args.workers)
+            send = http_driver(base_url)
+        else:
+            parser.error(f"unknown driver: {driver}")
+        try:
+            results[driver] = {}
+            for scenario in scenarios:
+                method, path, _ = SCENARIOS[scenario]
+                if method == 'GET':
+                    # One untimed request so cold caches do not skew small runs
+                    send(method, path(random.Random(0), data), None)
+                summary = run_load(send, scenario, data, args.requests, args.concurrency, args.seed)
+                results[driver][scenario] = summary
+                print(f"{driver:8} {scenario:15} {summary['throughput_rps']:>8} req/s  "
+                      f"p50 {summary['p50_ms']} ms  p99 {summary['p99_ms']} ms  errors {summary['errors']}")
+        finally:
+            if server:
+                server.terminate()
+                server.wait(10)
+
+    output = {
+        'meta': {
+            'commit': _git_commit(),
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'cpus': os.cpu_count(),
+            'args': vars(args),
+            'dataset': {key: data[key] for key in ('skus', 'years', 'rows', 'generate_seconds')},
+        },
+        'results': results,
+    }
+    out = args.out or os.path.join(HERE, 'results',
+                                   f"{output['meta']['commit']}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(output, f, indent=2)
+    print(f"\nResults written to {out}")
+
+    if not args.keep_db:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+
+    if args.compare:
+        regressions = compare(output, args.compare, args.max_regression)
+        if regressions:
+            print("Regressions over {:g}%: {}".format(args.max_regression, ', '.join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
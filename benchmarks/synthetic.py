@@ -0,0 +1,126 @@
+"""
+Synthetic shop data for benchmarks
+
+generate() fills a database created by init_db() with a realistic-looking
+history: a catalog whose sales follow a long-tail (Zipf-like) popularity,
+daily sales with one to a few lines each over several years, a share of
+them on credit to named customers, daily expenses, monthly supplier
+purchases on credit and customer payments, with each sale line's cost of
+goods sold and an opening cost layer per product.  Rows go straight into the tables
+in one transaction per month, so every trigger-maintained rollup, alert
+counter and party balance ends up exactly as if the app had written them.
+Everything is seeded, so the same arguments give the same database.
+"""
+
+import random
+from datetime import date, datetime, timedelta
+
+from database import connection
+from inventory import open_balance
+
+EXPENSE_CATEGORIES = ('rent', 'utilities', 'salaries', 'transport', 'maintenance', 'marketing')
+
+
+def stamp(day, second):
+    """'YYYY-MM-DD HH:MM:SS' for the `second`-th second of trading (from 08:00) on `day`."""
+    return f"{day.isoformat()} {8 + second // 3600 % 12:02d}:{second // 60 % 60:02d}:{second % 60:02d}"
+
+
+def _months(start, end):
+    day = start
+    while day <= end:
+        month_end = min(end, (day.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1))
+        yield day, month_end
+        day = month_end + timedelta(days=1)
+
+
+def generate(path=None, skus=2000, years=1.0, sales_per_day=100, max_lines=4, customers=500,
+             suppliers=30, expenses_per_day=3, credit_share=0.2, seed=42):
+    """Populate the database at `path`; returns a summary dict with row counts and sample keys."""
+    rng = random.Random(seed)
+    today = date.today()
+    start = today - timedelta(days=int(365 * years))
+
+    products = []
+    for i in range(1, skus + 1):
+        cost = round(rng.uniform(20, 2000), 2)
+        products.append((f"Product {i:05d}", 1_000_000, cost, round(cost * rng.uniform(1.15, 1.6), 2),
+                         f"Supplier {rng.randrange(suppliers) + 1:03d}", stamp(start, i)))
+    # Long-tail popularity: a few products sell far more than the rest
+    weights = [1 / rank ** 0.9 for rank in range(1, skus + 1)]
+    customer_names = [f"Customer {i:04d}" for i in range(1, customers + 1)]
+
+    counts = {'sales': 0, 'sale_items': 0, 'expenses': 0, 'credits': 0}
+    invoices = []
+    with connection(path) as conn:
+        with conn:
+            conn.executemany('''INSERT INTO stock (product_name, quantity, purchase_price, selling_price,
+                                                   supplier, date_added) VALUES (?, ?, ?, ?, ?, ?)''', products)
+        ids = [row[0] for row in conn.execute("SELECT id FROM stock ORDER BY id")]
+        with conn:
+            # One cost layer per product; every product has a single purchase price, so sale
+            # lines are costed directly instead of journaling millions of sale movements
+            cursor = conn.cursor()
+            for stock_id, product in zip(ids, products):
+                open_balance(cursor, stock_id, product[1], product[2])
+        sale_id = (conn.execute("SELECT MAX(id) FROM sales").fetchone()[0] or 0) + 1
+
+        for month_start, month_end in _months(start, today - timedelta(days=1)):
+            sales, items, expenses, credits = [], [], [], []
+            day = month_start
+            while day <= month_end:
+                for n in range(max(0, int(rng.gauss(sales_per_day, sales_per_day * 0.2)))):
+                    when = stamp(day, n * 30)
+                    lines = rng.choices(range(skus), weights, k=rng.randint(1, max_lines))
+                    total = 0
+                    for index in lines:
+                        quantity = rng.randint(1, 5)
+                        price = products[index][3]
+                        total += quantity * price
+                        items.append((sale_id, ids[index], products[index][0], quantity, price,
+                                      products[index][2], quantity * price, when, quantity * products[index][2]))
+                    on_credit = rng.random() < credit_share
+                    customer = rng.choice(customer_names) if on_credit or rng.random() < 0.3 else 'Walk-in Customer'
+                    invoice_no = f"SYN{day.strftime('%Y%m%d')}-{n + 1:05d}"
+                    sales.append((sale_id, invoice_no, customer, '', '[]', round(total, 2),
+                                  'credit' if on_credit else 'cash', when))
+                    if on_credit:
+                        credits.append(('customer', customer, round(total, 2), f"Sale: {invoice_no}", when, 'charge'))
+                    if rng.random() < 0.01:
+                        invoices.append(invoice_no)
+                    sale_id += 1
+                for n in range(expenses_per_day):
+                    expenses.append((rng.choice(EXPENSE_CATEGORIES), round(rng.uniform(500, 20000), 2),
+                                     'Synthetic expense', stamp(day, 40000 + n)))
+                day += timedelta(days=1)
+
+            # Month end: restock from a few suppliers and collect some customer payments
+            when = stamp(month_end, 43000)
+            for n in range(min(suppliers, 5)):
+                credits.append(('supplier', f"Supplier {rng.randrange(suppliers) + 1:03d}",
+                                round(rng.uniform(50000, 500000), 2), "Stock purchase: monthly", when, 'charge'))
+            for customer in rng.sample(customer_names, min(customers, 50)):
+                credits.append(('customer', customer, -round(rng.uniform(100, 5000), 2), 'Payment', when, 'payment'))
+
+            with conn:
+                conn.executemany('''INSERT INTO sales (id, invoice_no, customer_name, customer_phone, items,
+                                                       total_amount, payment_type, sale_date)
+                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', sales)
+                conn.executemany('''INSERT INTO sale_items (sale_id, stock_id, product_name, quantity, unit_price,
+                                                            unit_cost, total, sale_date, cogs)
+                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''', items)
+                conn.executemany("INSERT INTO expenses (category, amount, description, date) VALUES (?, ?, ?, ?)",
+                                 expenses)
+                conn.executemany('''INSERT INTO credits (type, name, amount, description, date, kind)
+                                    VALUES (?, ?, ?, ?, ?, ?)''', credits)
+            counts['sales'] += len(sales)
+            counts['sale_items'] += len(items)
+            counts['expenses'] += len(expenses)
+            counts['credits'] += len(credits)
+
+        with conn:
+            conn.execute('''UPDATE stock SET sold_quantity = COALESCE(
+                                (SELECT SUM(quantity) FROM sale_items WHERE stock_id = stock.id), 0)''')
+        conn.execute("ANALYZE")
+    return {'generated_at': datetime.now().isoformat(timespec='seconds'), 'skus': skus, 'years': years,
+            'rows': counts, 'products': [p[0] for p in products[:50]], 'invoices': invoices[-200:]}
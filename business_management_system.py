@@ -3,180 +3,312 @@
 Complete Business Management System - Bug Fixed Version
 """
 
-from flask import Flask, render_template, request, jsonify
-import sqlite3
-import json
-from datetime import datetime, timedelta
-import webbrowser
-import threading
+from flask import Flask, render_template, request, jsonify, Response
+import click
+import os
+from datetime import datetime
+
+from database import get_db, close_db, connection, current_path, write_transaction
+from summaries import rebuild_summaries, get_totals, get_stock_totals
+from profit_loss import profit_loss, margin_report, parse_date, next_day
+from pagination import fetch_page
+from exports import stream_export
+from stock_import import UPSERT_STOCK_SQL, import_stock, read_csv, receive_deliveries, validate_row
+from inventory import adjust, returned_sale, return_to_stock, rebuild_cogs, total_cogs, movements
+from checkout import place_sale, SaleRejected, resolve_product
+from pos_sync import apply_batch, catalog_delta, catalog_version, DELTA_LIMIT as SYNC_DELTA_LIMIT
+import receipts
+import metrics
+import backups
+import stores
+from stores import all_stores, current_store, fan_out
+from catalog_cache import catalog
+from http_cache import conditional, version_etag, gzip_response
+from chat_intents import ask, answers as chat_answers
+from search import (cached_search, parse_kinds, rebuild_search, results as search_results,
+                    MAX_LIMIT as SEARCH_MAX_LIMIT)
+from ledger import (rebuild_ledger, ensure_party, get_party, record_payment, statement,
+                    aging_report, PARTY_TYPES)
+from forecasting import forecasts, forecast_revenue
+from migrations import migrate, applied_versions, MIGRATIONS
+from stock_alerts import (rebuild_stock_alerts, roll_window, low_stock,
+                          dead_stock, high_velocity, DEAD_STOCK_DAYS, HIGH_VELOCITY_UNITS)
 
 app = Flask(__name__)
+app.teardown_appcontext(close_db)
+app.after_request(gzip_response)
+# Latency histograms, SQL timing and opt-in profiling (see metrics.py)
+app.before_request(metrics.start_request)
+app.after_request(metrics.finish_request)
+
+# Pick the store (and so the database file) for this request; see stores.py
+app.before_request(stores.select_store)
+
+@app.before_request
+def start_receipt_dispatcher():
+    # Started lazily so each gunicorn worker (not the master or CLI) owns one per store
+    receipts.ensure_dispatcher(current_path())
+
+@app.before_request
+def start_backup_scheduler():
+    # No-op unless BACKUP_INTERVAL_HOURS is set; see backups.py
+    backups.ensure_scheduler(all_stores)
 
 def init_db():
-    conn = sqlite3.connect('business_system.db')
+    # Brings every store's schema up to date; see migrations.py
+    for store_id, path in all_stores().items():
+        with connection(path) as conn:
+            migrate(conn, path=path)
+
+def _cli_stores(store_id):
+    # --store limits a CLI command to one store; default is all of them
+    if store_id is None:
+        return all_stores()
+    path = stores.lookup(store_id)
+    if path is None:
+        raise click.BadParameter(f"Unknown store: {store_id}", param_hint='--store')
+    return {store_id: path}
+
+@app.cli.command('rebuild-summaries')
+@click.option('--store', 'store_id', help='Only this store.')
+def rebuild_summaries_command(store_id):
+    """Recompute the dashboard rollups, stock alert counters, party balances and search index from the base tables."""
+    for store, path in _cli_stores(store_id).items():
+        with connection(path) as conn:
+            rebuild_summaries(conn.cursor())
+            rebuild_cogs(conn.cursor())
+            rebuild_stock_alerts(conn.cursor())
+            rebuild_ledger(conn.cursor())
+            rebuild_search(conn.cursor())
+            conn.commit()
+        print(f"{store}: summary tables rebuilt.")
+
+@app.cli.command('migrate')
+@click.option('--to', 'target', type=int, help='Stop after this schema version.')
+@click.option('--store', 'store_id', help='Only this store.')
+def migrate_command(target, store_id):
+    """Apply pending schema migrations."""
+    for store, path in _cli_stores(store_id).items():
+        with connection(path) as conn:
+            applied = migrate(conn, target, path=path)
+        print(f"{store}: applied {len(applied)} migration(s)." if applied else f"{store}: schema is up to date.")
+
+@app.cli.command('migrate-status')
+@click.option('--store', 'store_id', help='Only this store.')
+def migrate_status_command(store_id):
+    """List schema migrations and whether each has been applied."""
+    for store, path in _cli_stores(store_id).items():
+        with connection(path) as conn:
+            done = applied_versions(conn)
+        print(f"{store} ({path}):")
+        for version, name, _ in sorted(MIGRATIONS, key=lambda m: m[0]):
+            print(f"{version:4}  {'applied' if version in done else 'pending':8} {name}")
+
+@app.cli.command('backup')
+@click.option('--store', 'store_id', help='Only this store.')
+@click.option('--keep', type=int, help='Snapshots to keep per store (default BACKUP_KEEP).')
+def backup_command(store_id, keep):
+    """Take an online, verified snapshot of each store and prune old ones."""
+    for store, path in _cli_stores(store_id).items():
+        result = backups.snapshot(path, store)
+        removed = backups.prune(store, keep=keep)
+        print(f"{store}: {result['path']} ({result['bytes']} bytes, {result['seconds']} s, "
+              f"{result['restarts']} restarts); pruned {len(removed)}.")
+
+@app.cli.command('list-backups')
+@click.option('--store', 'store_id', help='Only this store.')
+def list_backups_command(store_id):
+    """List the snapshots of each store, newest first."""
+    for store in _cli_stores(store_id):
+        for path, created, size in backups.list_snapshots(store):
+            print(f"{store:12} {created:%Y-%m-%d %H:%M:%S} {size:>12} {path}")
+
+@app.cli.command('verify-backup')
+@click.argument('snapshot', type=click.Path(exists=True, dir_okay=False))
+def verify_backup_command(snapshot):
+    """Run an integrity check on a snapshot file."""
+    problems = backups.verify(snapshot)
+    print('\n'.join(problems) if problems else f"{snapshot}: ok")
+    if problems:
+        raise SystemExit(1)
+
+@app.cli.command('restore')
+@click.argument('snapshot', type=click.Path(exists=True, dir_okay=False))
+@click.option('--store', 'store_id', default=stores.DEFAULT_STORE, show_default=True)
+@click.confirmation_option(prompt='This replaces the store\'s current data. Continue?')
+def restore_command(snapshot, store_id):
+    """Restore a store from a snapshot (the current data is snapshotted first)."""
+    (store, path), = _cli_stores(store_id).items()
+    try:
+        safety = backups.restore(snapshot, path, store)
+    except backups.BackupError as e:
+        raise click.ClickException(str(e))
+    # The snapshot may predate later migrations
+    with connection(path) as conn:
+        migrate(conn, path=path)
+    print(f"{store} restored from {snapshot}; previous data saved as {safety['path']}.")
+
+@app.cli.command('create-store')
+@click.argument('store_id')
+def create_store_command(store_id):
+    """Create a new store database and bring it up to the current schema."""
+    try:
+        path = stores.create_store(store_id)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    with connection(path) as conn:
+        migrate(conn, path=path)
+    print(f"Store {store_id} created at {path}.")
+
+def _listing_page(listing, template, name):
+    # One keyset page of a history listing, as HTML or (?format=json) as JSON
+    conn = get_db()
     cursor = conn.cursor()
+    as_json = request.args.get('format') == 'json'
+    try:
+        rows, columns, next_cursor = fetch_page(cursor, listing, request.args)
+    except ValueError as e:
+        if as_json:
+            return jsonify({'success': False, 'error': str(e)})
+        return f"Error: {str(e)}", 400
     
-    cursor.execute('''CREATE TABLE IF NOT EXISTS stock (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        product_name TEXT NOT NULL,
-        quantity INTEGER NOT NULL,
-        sold_quantity INTEGER DEFAULT 0,
-        purchase_price REAL NOT NULL,
-        selling_price REAL NOT NULL,
-        supplier TEXT,
-        date_added TEXT NOT NULL
-    )''')
-    
-    cursor.execute('''CREATE TABLE IF NOT EXISTS sales (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        invoice_no TEXT NOT NULL,
-        customer_name TEXT,
-        customer_phone TEXT,
-        items TEXT NOT NULL,
-        total_amount REAL NOT NULL,
-        payment_type TEXT NOT NULL,
-        sale_date TEXT NOT NULL
-    )''')
-    
-    cursor.execute('''CREATE TABLE IF NOT EXISTS credits (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        type TEXT NOT NULL,
-        name TEXT NOT NULL,
-        amount REAL NOT NULL,
-        description TEXT,
-        date TEXT NOT NULL
-    )''')
-    
-    cursor.execute('''CREATE TABLE IF NOT EXISTS expenses (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        category TEXT NOT NULL,
-        amount REAL NOT NULL,
-        description TEXT,
-        date TEXT NOT NULL
-    )''')
-    
-    cursor.execute('''CREATE TABLE IF NOT EXISTS returns (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        product_name TEXT NOT NULL,
-        quantity INTEGER NOT NULL,
-        reason TEXT,
-        customer_name TEXT,
-        return_date TEXT NOT NULL
-    )''')
-    
-    conn.commit()
-    conn.close()
+    if as_json:
+        return jsonify({'success': True, name: [dict(zip(columns, row)) for row in rows],
+                        'next_cursor': next_cursor})
+    return render_template(template, **{name: rows}, next_cursor=next_cursor, filters=request.args)
+
+def get_sale_items(cursor, sale_id):
+    cursor.execute('''SELECT product_name, quantity, unit_price, total, stock_id
+                      FROM sale_items WHERE sale_id = ? ORDER BY id''', (sale_id,))
+    return [{'product_name': row[0], 'quantity': row[1], 'price': row[2],
+             'total': row[3], 'stock_id': row[4]} for row in cursor.fetchall()]
 
 @app.route('/')
 def dashboard():
-    conn = sqlite3.connect('business_system.db')
+    conn = get_db()
     cursor = conn.cursor()
     
-    # Get dashboard data
-    cursor.execute("SELECT SUM(total_amount) FROM sales")
-    total_revenue = cursor.fetchone()[0] or 0
-    
-    cursor.execute("SELECT COUNT(*) FROM sales")
-    total_sales = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT SUM(quantity) FROM stock")
-    total_stock = cursor.fetchone()[0] or 0
-    
-    cursor.execute("SELECT SUM(amount) FROM expenses")
-    total_expenses = cursor.fetchone()[0] or 0
+    # Get dashboard data (from the rollup tables, independent of history size)
+    total_revenue, total_sales, total_expenses, _ = get_totals(cursor)
+    cost_of_goods = total_cogs(cursor)
+    total_stock = get_stock_totals(cursor)[1]
     
     # Yearly growth data
-    cursor.execute("""SELECT strftime('%Y', sale_date) as year, SUM(total_amount) 
-                     FROM sales GROUP BY year ORDER BY year""")
+    cursor.execute("""SELECT period, revenue FROM summary_totals
+                     WHERE granularity = 'year' AND sales_count > 0 ORDER BY period""")
     yearly_data = cursor.fetchall()
     
     # Monthly data for current year
     current_year = datetime.now().year
-    cursor.execute("""SELECT strftime('%m', sale_date) as month, SUM(total_amount) 
-                     FROM sales WHERE strftime('%Y', sale_date) = ? 
-                     GROUP BY month ORDER BY month""", (str(current_year),))
+    cursor.execute("""SELECT substr(period, 6, 2), revenue FROM summary_totals
+                     WHERE granularity = 'month' AND period BETWEEN ? AND ? AND sales_count > 0
+                     ORDER BY period""", (f"{current_year}-01", f"{current_year}-12"))
     monthly_data = cursor.fetchall()
     
     # Top-selling products
     cursor.execute("SELECT product_name, sold_quantity FROM stock WHERE sold_quantity > 0 ORDER BY sold_quantity DESC LIMIT 5")
     top_products = cursor.fetchall()
     
-    # Low stock alerts
-    cursor.execute("SELECT product_name, quantity FROM stock WHERE quantity < 10")
-    low_stock = cursor.fetchall()
+    # Stock alerts (per-product reorder levels, indexed)
+    low_stock_items = low_stock(cursor)
+    dead_stock_items = dead_stock(cursor)
     
-    # Stock with sold quantities
-    cursor.execute("SELECT * FROM stock ORDER BY id")
-    stock_data = cursor.fetchall()
+    # Stock with sold quantities: the newest page only, /stock pages through the rest
+    stock_data = fetch_page(cursor, 'stock', {})[0]
     
-    conn.close()
+    # Demand forecast for the next week
+    next_week_revenue = forecast_revenue(cursor)
+    top_forecast = forecasts.get(cursor)[:5]
     
     dashboard_data = {
         'total_revenue': total_revenue,
         'total_sales': total_sales,
         'total_stock': total_stock,
         'total_expenses': total_expenses,
-        'profit': total_revenue - total_expenses,
+        'cogs': cost_of_goods,
+        'profit': total_revenue - cost_of_goods - total_expenses,
         'yearly_data': yearly_data,
         'monthly_data': monthly_data,
         'stock_data': stock_data,
         'top_products': top_products,
-        'low_stock': low_stock
+        'low_stock': low_stock_items,
+        'dead_stock': dead_stock_items,
+        'forecast_revenue': next_week_revenue,
+        'top_forecast': top_forecast
     }
     
     return render_template('dashboard.html', data=dashboard_data)
 
 @app.route('/stock')
 def stock():
-    conn = sqlite3.connect('business_system.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM stock ORDER BY id")
-    stocks = cursor.fetchall()
-    conn.close()
-    return render_template('stock_management.html', stocks=stocks)
+    return _listing_page('stock', 'stock_management.html', 'stocks')
 
 @app.route('/add_stock', methods=['POST'])
 def add_stock():
     try:
         data = request.json
-        conn = sqlite3.connect('business_system.db')
+        name, quantity, purchase_price, selling_price, supplier = validate_row(data)
+        conn = get_db()
         cursor = conn.cursor()
         
-        cursor.execute('''INSERT INTO stock 
-                         (product_name, quantity, purchase_price, selling_price, supplier, date_added)
-                         VALUES (?, ?, ?, ?, ?, ?)''',
-                      (data['product_name'], data['quantity'], data['purchase_price'], 
-                       data['selling_price'], data['supplier'], datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        cursor.execute(UPSERT_STOCK_SQL,
+                      (name, quantity, purchase_price, selling_price, supplier,
+                       datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        receive_deliveries(cursor, [(name, quantity, purchase_price, supplier)])
         
-        if data.get('add_to_credit') and data['supplier']:
-            total_cost = float(data['quantity']) * float(data['purchase_price'])
+        if supplier:
+            ensure_party(cursor, 'supplier', supplier)
+        if data.get('add_to_credit') and supplier:
+            total_cost = quantity * purchase_price
             cursor.execute('''INSERT INTO credits (type, name, amount, description, date)
                              VALUES (?, ?, ?, ?, ?)''',
-                          ("supplier", data['supplier'], total_cost, f"Stock purchase: {data['product_name']}", 
+                          ("supplier", supplier, total_cost, f"Stock purchase: {name}", 
                            datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
         
         conn.commit()
-        conn.close()
         return jsonify({'success': True})
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/bulk_add_stock', methods=['POST'])
+def bulk_add_stock():
+    try:
+        # Either a CSV upload in the 'file' field or a JSON array / {"items": [...]}
+        if 'file' in request.files:
+            rows = read_csv(request.files['file'].stream)
+            add_to_credit = request.form.get('add_to_credit') in ('1', 'true', 'on')
+        else:
+            data = request.json
+            rows = data if isinstance(data, list) else data['items']
+            add_to_credit = not isinstance(data, list) and bool(data.get('add_to_credit'))
+        
+        conn = get_db()
+        cursor = conn.cursor()
+        imported, errors = import_stock(cursor, rows, add_to_credit)
+        conn.commit()
+        
+        return jsonify({'success': not errors, 'imported': imported, 'errors': errors})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/delete_stock/<int:stock_id>', methods=['DELETE'])
 def delete_stock(stock_id):
     try:
-        conn = sqlite3.connect('business_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
-        cursor.execute("SELECT product_name FROM stock WHERE id = ?", (stock_id,))
+        cursor.execute("SELECT product_name, quantity FROM stock WHERE id = ?", (stock_id,))
         stock = cursor.fetchone()
         
         if not stock:
-            conn.close()
             return jsonify({'success': False, 'error': 'Stock item not found'})
         
+        # Whatever was still on hand leaves the books as an adjustment
+        adjust(cursor, stock_id, -stock[1], 0, note=f"Deleted {stock[0]}")
         cursor.execute("DELETE FROM stock WHERE id = ?", (stock_id,))
         conn.commit()
-        conn.close()
         
         return jsonify({'success': True, 'message': f'Deleted {stock[0]} successfully'})
     except Exception as e:
@@ -186,18 +318,25 @@ def delete_stock(stock_id):
 def edit_stock(stock_id):
     try:
         data = request.json
-        conn = sqlite3.connect('business_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
+        cursor.execute("SELECT quantity FROM stock WHERE id = ?", (stock_id,))
+        stock = cursor.fetchone()
+        if not stock:
+            return jsonify({'success': False, 'error': 'Stock item not found'})
+        
+        # A changed count is journaled as an adjustment; purchase_price only prices future receipts
+        adjust(cursor, stock_id, int(data['quantity']) - stock[0], float(data['purchase_price']),
+               note='Manual edit')
         cursor.execute('''UPDATE stock SET 
                          product_name = ?, quantity = ?, purchase_price = ?, 
-                         selling_price = ?, supplier = ?
+                         selling_price = ?, supplier = ?, reorder_level = COALESCE(?, reorder_level)
                          WHERE id = ?''',
                       (data['product_name'], data['quantity'], data['purchase_price'], 
-                       data['selling_price'], data['supplier'], stock_id))
+                       data['selling_price'], data['supplier'], data.get('reorder_level'), stock_id))
         
         conn.commit()
-        conn.close()
         return jsonify({'success': True, 'message': 'Stock updated successfully'})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
@@ -205,49 +344,117 @@ def edit_stock(stock_id):
 @app.route('/get_stock/<int:stock_id>')
 def get_stock(stock_id):
     try:
-        conn = sqlite3.connect('business_system.db')
+        conn = get_db()
+        # recent_sold is only current once the window has been moved up to today
+        roll_window(conn)
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM stock WHERE id = ?", (stock_id,))
-        stock = cursor.fetchone()
-        conn.close()
         
-        if stock:
-            return jsonify({
-                'success': True,
-                'stock': {
-                    'id': stock[0],
-                    'product_name': stock[1],
-                    'quantity': stock[2],
-                    'sold_quantity': stock[3],
-                    'purchase_price': stock[4],
-                    'selling_price': stock[5],
-                    'supplier': stock[6]
-                }
-            })
-        return jsonify({'success': False, 'error': 'Stock not found'})
+        def build():
+            cursor.execute('''SELECT id, product_name, quantity, sold_quantity, purchase_price,
+                              selling_price, supplier, reorder_level, last_sold_at, recent_sold
+                              FROM stock WHERE id = ?''', (stock_id,))
+            stock = cursor.fetchone()
+            if stock:
+                return jsonify({'success': True,
+                                'stock': dict(zip([c[0] for c in cursor.description], stock))})
+            return jsonify({'success': False, 'error': 'Stock not found'})
+        
+        return conditional(version_etag(cursor, 'stock', stock_id), build)
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/sales')
 def sales():
-    conn = sqlite3.connect('business_system.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM sales ORDER BY id DESC")
-    sales_data = cursor.fetchall()
-    conn.close()
-    return render_template('smart_sales.html', sales=sales_data)
+    return _listing_page('sales', 'smart_sales.html', 'sales')
+
+@app.route('/parties')
+def parties():
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        party_type = request.args.get('type', 'customer')
+        limit = min(int(request.args.get('limit', 100)), 1000)
+        
+        # Largest balances first, straight off the (type, balance) index
+        cursor.execute('''SELECT id, name, phone, balance, last_activity FROM parties
+                          WHERE type = ? ORDER BY balance DESC LIMIT ?''', (party_type, limit))
+        columns = [c[0] for c in cursor.description]
+        return jsonify({'success': True, 'parties': [dict(zip(columns, row)) for row in cursor.fetchall()]})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/balance/<party_type>/<name>')
+def balance(party_type, name):
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        party = get_party(cursor, party_type, name)
+        
+        if party:
+            return jsonify({'success': True, 'party_id': party[0], 'type': party[1], 'name': party[2],
+                            'phone': party[3], 'balance': party[4], 'last_activity': party[5]})
+        return jsonify({'success': False, 'error': f'Unknown {party_type}'})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/statement/<int:party_id>')
+def party_statement(party_id):
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute("SELECT type, name, balance FROM parties WHERE id = ?", (party_id,))
+        party = cursor.fetchone()
+        if not party:
+            return jsonify({'success': False, 'error': 'Unknown party'})
+        
+        opening, entries = statement(cursor, party_id, parse_date(request.args.get('from')),
+                                     parse_date(request.args.get('to')))
+        closing = entries[-1]['balance'] if entries else opening
+        return jsonify({'success': True, 'type': party[0], 'name': party[1], 'balance': party[2],
+                        'opening_balance': opening, 'closing_balance': closing, 'entries': entries})
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/record_payment', methods=['POST'])
+def add_payment():
+    try:
+        data = request.json
+        new_balance = record_payment(get_db(), data['type'], data['name'], data['amount'],
+                                     data.get('description'))
+        
+        return jsonify({'success': True, 'balance': new_balance})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/aging')
+def aging():
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        party_type = request.args.get('type', 'customer')
+        if party_type not in PARTY_TYPES:
+            return jsonify({'success': False, 'error': f'Unknown party type: {party_type}'}), 400
+        
+        report, totals = aging_report(cursor, party_type)
+        return jsonify({'success': True, 'parties': report, 'totals': totals})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/get_product_info/<product_name>')
 def get_product_info(product_name):
     try:
-        conn = sqlite3.connect('business_system.db')
+        conn = get_db()
         cursor = conn.cursor()
-        cursor.execute("SELECT selling_price, quantity FROM stock WHERE LOWER(product_name) = LOWER(?)", (product_name,))
-        result = cursor.fetchone()
-        conn.close()
+        
+        def load(cursor):
+            cursor.execute("SELECT selling_price, quantity, id FROM stock WHERE product_name = ? COLLATE NOCASE", (product_name,))
+            return cursor.fetchone()
+        result = catalog.get(cursor, ('product', product_name), load)
         
         if result:
-            return jsonify({'success': True, 'price': result[0], 'available_qty': result[1]})
+            return jsonify({'success': True, 'price': result[0], 'available_qty': result[1], 'stock_id': result[2]})
         else:
             return jsonify({'success': False, 'message': 'Product not found in stock'})
     except Exception as e:
@@ -256,185 +463,198 @@ def get_product_info(product_name):
 @app.route('/get_all_stock')
 def get_all_stock():
     try:
-        conn = sqlite3.connect('business_system.db')
+        conn = get_db()
         cursor = conn.cursor()
-        cursor.execute("SELECT product_name, quantity, selling_price FROM stock WHERE quantity > 0 ORDER BY product_name")
-        stock_items = cursor.fetchall()
-        conn.close()
-        
-        stock_data = []
-        for item in stock_items:
-            stock_data.append({
-                'product_name': item[0],
-                'quantity': item[1],
-                'selling_price': item[2]
-            })
         
-        return jsonify({'success': True, 'stock': stock_data})
+        def load(cursor):
+            cursor.execute("SELECT product_name, quantity, selling_price, id FROM stock WHERE quantity > 0 ORDER BY product_name COLLATE NOCASE")
+            stock_data = []
+            for item in cursor.fetchall():
+                stock_data.append({
+                    'product_name': item[0],
+                    'quantity': item[1],
+                    'selling_price': item[2],
+                    'stock_id': item[3]
+                })
+            return stock_data
+        # ?format=columns sends one array per field instead of one object per product
+        columnar = request.args.get('format') == 'columns'
+        
+        def build():
+            stock_data = catalog.get(cursor, ('all',), load)
+            if columnar:
+                fields = ('product_name', 'quantity', 'selling_price', 'stock_id')
+                return jsonify({'success': True, 'format': 'columns',
+                                'stock': {field: [item[field] for item in stock_data] for field in fields}})
+            return jsonify({'success': True, 'stock': stock_data})
+        
+        return conditional(version_etag(cursor, 'stock', 'columns' if columnar else 'rows'), build)
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
-@app.route('/create_sale', methods=['POST'])
-def create_sale():
+@app.route('/search')
+def search():
+    # Ranked, typo-tolerant lookup over products, customers and suppliers (FTS5 index)
     try:
-        data = request.json
-        conn = sqlite3.connect('business_system.db')
+        conn = get_db()
         cursor = conn.cursor()
+        limit = min(int(request.args.get('limit', 20)), SEARCH_MAX_LIMIT)
+        kinds = parse_kinds(request.args.get('kinds'))
+        return jsonify({'success': True, 'results': cached_search(cursor, request.args.get('q', ''), kinds, limit)})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/search/suggest')
+def search_suggest():
+    # Autocomplete for the till: a handful of ranked product names per keystroke instead of the whole catalog
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        limit = min(int(request.args.get('limit', 8)), 20)
+        kinds = parse_kinds(request.args.get('kinds', 'product'))
+        suggestions = [{'kind': result['kind'], 'id': result['id'], 'name': result['name'],
+                        'price': result.get('selling_price'), 'available_qty': result.get('quantity')}
+                       for result in cached_search(cursor, request.args.get('q', ''), kinds, limit)]
+        return jsonify({'success': True, 'suggestions': suggestions})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/slow_queries')
+def slow_queries():
+    return jsonify({'success': True, 'threshold_ms': metrics.SLOW_QUERY_MS,
+                    'queries': list(metrics.registry.slow_queries)})
+
+@app.route('/cache_stats')
+def cache_stats():
+    return jsonify({'success': True, 'catalog': catalog.stats(), 'chat': chat_answers.stats(),
+                    'search': search_results.stats()})
+
+@app.route('/backups')
+def list_backups():
+    snapshots = backups.list_snapshots(current_store())
+    return jsonify({'success': True, 'store': current_store(), 'interval_hours': backups.BACKUP_INTERVAL_HOURS,
+                    'snapshots': [{'file': os.path.basename(path), 'created_at': f"{created:%Y-%m-%d %H:%M:%S}",
+                                   'bytes': size} for path, created, size in snapshots]})
+
+@app.route('/stores')
+def list_stores():
+    return jsonify({'success': True, 'current': current_store(), 'stores': sorted(all_stores())})
+
+@app.route('/select_store', methods=['POST'])
+def select_store():
+    # Remembers the till's store in a cookie; a header or host mapping still wins
+    try:
+        store_id = (request.json or {}).get('store_id', '').strip().lower()
+        if stores.lookup(store_id) is None:
+            return jsonify({'success': False, 'error': f"Unknown store: {store_id}"})
         
-        invoice_no = f"QS{datetime.now().strftime('%Y%m%d%H%M%S')}"
-        total_amount = sum(item['total'] for item in data['items'])
-        
-        cursor.execute('''INSERT INTO sales 
-                         (invoice_no, customer_name, customer_phone, items, total_amount, payment_type, sale_date)
-                         VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                      (invoice_no, data.get('customer', 'Walk-in Customer'), '', json.dumps(data['items']), 
-                       total_amount, 'cash', datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-        
-        for item in data['items']:
-            # Handle both 'name' and 'product_name' keys for compatibility
-            product_name = item.get('name') or item.get('product_name')
-            cursor.execute("SELECT quantity FROM stock WHERE LOWER(product_name) = LOWER(?)", (product_name,))
-            stock = cursor.fetchone()
-            if stock and stock[0] >= item['quantity']:
-                cursor.execute("UPDATE stock SET quantity = quantity - ?, sold_quantity = sold_quantity + ? WHERE LOWER(product_name) = LOWER(?)", 
-                              (item['quantity'], item['quantity'], product_name))
+        response = jsonify({'success': True, 'store_id': store_id})
+        response.set_cookie(stores.STORE_COOKIE, store_id, max_age=365 * 24 * 3600, samesite='Lax')
+        return response
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+REPORT_FIELDS = ('revenue', 'sales_count', 'expenses', 'returns_qty', 'cogs', 'products', 'stock_quantity',
+                 'stock_value')
+
+@app.route('/stores/report')
+def stores_report():
+    # Consolidated totals: every store's rollups are read in parallel and summed
+    try:
+        date_from = parse_date(request.args.get('from'))
+        date_to = parse_date(request.args.get('to'))
         
-        conn.commit()
-        conn.close()
+        def store_totals(store_id, cursor):
+            if date_from is None and date_to is None:
+                totals = (*get_totals(cursor), total_cogs(cursor))
+            else:
+                cursor.execute('''SELECT COALESCE(SUM(revenue), 0), COALESCE(SUM(sales_count), 0),
+                                         COALESCE(SUM(expenses), 0), COALESCE(SUM(returns_qty), 0),
+                                         COALESCE(SUM(cogs), 0)
+                                  FROM summary_totals WHERE granularity = 'day' AND period BETWEEN ? AND ?''',
+                               (date_from or '0000-00-00', date_to or '9999-12-31'))
+                totals = cursor.fetchone()
+            row = dict(zip(REPORT_FIELDS, (*totals, *get_stock_totals(cursor))))
+            row['profit'] = row['revenue'] - row['cogs'] - row['expenses']
+            return row
+        
+        per_store = fan_out(store_totals)
+        combined = {field: sum(row[field] for row in per_store.values() if 'error' not in row)
+                    for field in REPORT_FIELDS}
+        combined['profit'] = combined['revenue'] - combined['cogs'] - combined['expenses']
+        return jsonify({'success': True, 'from': date_from, 'to': date_to,
+                        'stores': per_store, 'combined': combined})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/create_sale', methods=['POST'])
+def create_sale():
+    try:
+        data = request.json
+        sale = place_sale(get_db(), data['items'], data.get('customer', 'Walk-in Customer'), '', 'cash',
+                          prefix='QS')
         
-        return jsonify({'success': True, 'invoice': invoice_no})
+        return jsonify({'success': True, 'invoice': sale['invoice_no']})
+    except SaleRejected as e:
+        return jsonify({'success': False, 'errors': e.errors})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/returns')
 def returns():
-    conn = sqlite3.connect('business_system.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM returns ORDER BY return_date DESC")
-    returns_data = cursor.fetchall()
-    conn.close()
-    return render_template('returns.html', returns=returns_data)
+    return _listing_page('returns', 'returns.html', 'returns')
 
 @app.route('/add_return', methods=['POST'])
 def add_return():
     try:
         data = request.json
-        conn = sqlite3.connect('business_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
+        # The sale it came from fixes the cost that goes back on the shelf
+        # (invoice_no when the till sends it, else the customer's latest purchase)
+        product = resolve_product(cursor, data)
+        sale_id = product and returned_sale(cursor, product[0], data.get('invoice_no'), data['customer_name'])
+        
         # Add to returns table
+        return_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         cursor.execute('''INSERT INTO returns 
                          (product_name, quantity, reason, customer_name, return_date)
                          VALUES (?, ?, ?, ?, ?)''',
                       (data['product_name'], data['quantity'], data['reason'], 
-                       data['customer_name'], datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+                       data['customer_name'], return_date))
+        return_id = cursor.lastrowid
         
         # Add back to stock
-        cursor.execute("SELECT id FROM stock WHERE LOWER(product_name) = LOWER(?)", (data['product_name'],))
-        stock_exists = cursor.fetchone()
-        
-        if stock_exists:
-            cursor.execute("UPDATE stock SET quantity = quantity + ? WHERE LOWER(product_name) = LOWER(?)", 
-                          (data['quantity'], data['product_name']))
+        if product:
+            cursor.execute("UPDATE stock SET quantity = quantity + ? WHERE id = ?", 
+                          (data['quantity'], product[0]))
+            return_to_stock(cursor, product[0], int(data['quantity']), sale_id, f"Return #{return_id}",
+                            return_date)
         
         conn.commit()
-        conn.close()
         return jsonify({'success': True, 'message': 'Return processed and stock updated'})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
-def send_whatsapp_invoice(phone, invoice_no, customer_name, items, total_amount):
-    try:
-        # Create beautiful invoice message
-        message = "🧾 *INVOICE RECEIPT* 🧾\n"
-        message += "═══════════════════════════\n\n"
-        
-        message += f"📋 *Invoice:* {invoice_no}\n"
-        message += f"👤 *Customer:* {customer_name or 'Valued Customer'}\n"
-        message += f"📅 *Date:* {datetime.now().strftime('%d/%m/%Y %H:%M')}\n\n"
-        
-        message += "📦 *ITEMS PURCHASED:*\n"
-        message += "─────────────────────────────\n"
-        
-        for i, item in enumerate(items, 1):
-            message += f"{i}. *{item['product_name']}*\n"
-            message += f"   Qty: {item['quantity']} × PKR {item['price']} = *PKR {item['total']}*\n\n"
-        
-        message += "─────────────────────────────\n"
-        message += f"💰 *TOTAL: PKR {total_amount}*\n"
-        message += "─────────────────────────────\n\n"
-        
-        message += "🙏 *Thank you for your business!*\n"
-        message += "📞 Contact us for support\n"
-        message += "✨ We appreciate you! ✨"
-        
-        # Clean phone and create WhatsApp URL
-        clean_phone = phone.replace('+', '').replace(' ', '').replace('-', '').replace('(', '').replace(')', '')
-        
-        # Encode message for URL
-        import urllib.parse
-        encoded_message = urllib.parse.quote(message)
-        
-        url = f"https://wa.me/{clean_phone}?text={encoded_message}"
-        
-        # Open WhatsApp
-        webbrowser.open(url)
-        print(f"WhatsApp invoice sent to {phone}")
-        
-    except Exception as e:
-        print(f"WhatsApp error: {e}")
-
 @app.route('/create_invoice', methods=['POST'])
 def create_invoice():
     try:
         data = request.json
-        conn = sqlite3.connect('business_system.db')
-        cursor = conn.cursor()
-        
-        # Validate stock before creating invoice
-        errors = []
-        for item in data['items']:
-            cursor.execute("SELECT quantity FROM stock WHERE LOWER(product_name) = LOWER(?)", (item['product_name'],))
-            result = cursor.fetchone()
-            
-            if not result:
-                errors.append(f"Product '{item['product_name']}' not found in stock")
-            elif result[0] < item['quantity']:
-                errors.append(f"Insufficient stock for '{item['product_name']}'. Available: {result[0]}")
-        
-        if errors:
-            conn.close()
-            return jsonify({'success': False, 'errors': errors})
-        
-        # Create invoice if validation passes
-        invoice_no = f"INV{datetime.now().strftime('%Y%m%d%H%M%S')}"
-        total_amount = sum(item['total'] for item in data['items'])
-        
-        cursor.execute('''INSERT INTO sales 
-                         (invoice_no, customer_name, customer_phone, items, total_amount, payment_type, sale_date)
-                         VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                      (invoice_no, data['customer_name'], data.get('customer_phone'), json.dumps(data['items']), 
-                       total_amount, data['payment_type'], datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-        
-        for item in data['items']:
-            cursor.execute("UPDATE stock SET quantity = quantity - ?, sold_quantity = sold_quantity + ? WHERE LOWER(product_name) = LOWER(?)", 
-                          (item['quantity'], item['quantity'], item['product_name']))
-        
-        if data['payment_type'] == 'credit':
-            cursor.execute('''INSERT INTO credits (type, name, amount, description, date)
-                             VALUES (?, ?, ?, ?, ?)''',
-                          ("customer", data['customer_name'], total_amount, f"Sale: {invoice_no}", 
-                           datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-        
-        conn.commit()
-        conn.close()
         
-        if data.get('customer_phone') and data.get('send_whatsapp'):
-            threading.Thread(target=send_whatsapp_invoice, 
-                            args=(data['customer_phone'], invoice_no, data['customer_name'], 
-                                 data['items'], total_amount), daemon=True).start()
+        # Stock is checked and reserved atomically; any shortfall rolls the invoice back.
+        # The WhatsApp receipt is queued in the outbox and sent by the background dispatcher.
+        sale = place_sale(get_db(), data['items'], data['customer_name'], data.get('customer_phone'),
+                          data['payment_type'],
+                          receipt_phone=data.get('send_whatsapp') and data.get('customer_phone'))
         
-        return jsonify({'success': True, 'invoice_no': invoice_no})
+        return jsonify({'success': True, 'invoice_no': sale['invoice_no']})
+    except SaleRejected as e:
+        return jsonify({'success': False, 'errors': e.errors})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
@@ -442,181 +662,269 @@ def create_invoice():
 def simple_create_sale():
     try:
         data = request.json
-        conn = sqlite3.connect('business_system.db')
-        cursor = conn.cursor()
-        
-        # Validate stock
-        errors = []
-        for item in data['items']:
-            cursor.execute("SELECT quantity FROM stock WHERE LOWER(product_name) = LOWER(?)", (item['product_name'],))
-            result = cursor.fetchone()
-            
-            if not result:
-                errors.append(f"Product '{item['product_name']}' not found")
-            elif result[0] < item['quantity']:
-                errors.append(f"Only {result[0]} {item['product_name']} available")
-        
-        if errors:
-            conn.close()
-            return jsonify({'success': False, 'errors': errors})
-        
-        # Create sale
-        invoice_no = f"INV{datetime.now().strftime('%Y%m%d%H%M%S')}"
-        total_amount = sum(item['total'] for item in data['items'])
-        
-        cursor.execute('''INSERT INTO sales 
-                         (invoice_no, customer_name, customer_phone, items, total_amount, payment_type, sale_date)
-                         VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                      (invoice_no, data.get('customer_name', 'Walk-in'), data.get('customer_phone'), 
-                       json.dumps(data['items']), total_amount, data['payment_type'], 
-                       datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-        
-        # Update stock
-        for item in data['items']:
-            cursor.execute("UPDATE stock SET quantity = quantity - ?, sold_quantity = sold_quantity + ? WHERE LOWER(product_name) = LOWER(?)", 
-                          (item['quantity'], item['quantity'], item['product_name']))
-        
-        # Add credit if needed
-        if data['payment_type'] == 'credit' and data.get('customer_name'):
-            cursor.execute('''INSERT INTO credits (type, name, amount, description, date)
-                             VALUES (?, ?, ?, ?, ?)''',
-                          ("customer", data['customer_name'], total_amount, f"Invoice: {invoice_no}", 
-                           datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-        
-        conn.commit()
-        conn.close()
         
-        # Send WhatsApp if requested
-        if data.get('send_whatsapp') and data.get('customer_phone'):
-            threading.Thread(target=send_whatsapp_invoice, 
-                            args=(data['customer_phone'], invoice_no, data.get('customer_name', 'Valued Customer'), 
-                                 data['items'], total_amount), daemon=True).start()
+        # Create sale (queueing a WhatsApp receipt if requested)
+        sale = place_sale(get_db(), data['items'], data.get('customer_name', 'Walk-in'),
+                          data.get('customer_phone'), data['payment_type'],
+                          receipt_phone=data.get('send_whatsapp') and data.get('customer_phone'))
         
-        return jsonify({'success': True, 'invoice_no': invoice_no, 'total': total_amount})
+        return jsonify({'success': True, 'invoice_no': sale['invoice_no'], 'total': sale['total_amount']})
+    except SaleRejected as e:
+        return jsonify({'success': False, 'errors': e.errors})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/sync/sales', methods=['POST'])
+def sync_sales():
+    # Drain a till's offline queue: one transaction, one savepoint per sale, idempotent per key
+    try:
+        data = request.json
+        conn = get_db()
+        with write_transaction(conn):
+            results = apply_batch(conn.cursor(), data['sales'], data.get('device_id'))
+            version = catalog_version(conn.cursor())
+        
+        # Some of the sales may have queued receipts
+        if any(r['status'] == 'applied' for r in results):
+            receipts.notify(current_path())
+        return jsonify({'success': True, 'results': results, 'catalog_version': version,
+                        'applied': sum(r['status'] == 'applied' for r in results),
+                        'conflicts': sum(r['status'] in ('rejected', 'invalid') for r in results)})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/sync/catalog')
+def sync_catalog():
+    # Catalog changes since the till's last catalog_version, paged by change sequence
+    try:
+        since = int(request.args.get('since', 0))
+        limit = min(int(request.args.get('limit', SYNC_DELTA_LIMIT)), SYNC_DELTA_LIMIT)
+        products, deleted, next_since, more = catalog_delta(get_db().cursor(), since, limit)
+        return jsonify({'success': True, 'products': products, 'deleted': deleted,
+                        'catalog_version': next_since, 'more': more})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/get_sales_summary')
 def get_sales_summary():
     try:
-        conn = sqlite3.connect('business_system.db')
+        conn = get_db()
         cursor = conn.cursor()
+        today = datetime.now().strftime('%Y-%m-%d')
+        
+        def build():
+            # Today's sales
+            revenue, count, _, _ = get_totals(cursor, 'day', today)
+            today_sales = (count, revenue)
+            
+            # Total sales
+            revenue, count, _, _ = get_totals(cursor)
+            total_sales = (count, revenue)
+            
+            # Recent sales
+            cursor.execute("SELECT invoice_no, customer_name, total_amount, sale_date FROM sales ORDER BY sale_date DESC LIMIT 5")
+            recent_sales = cursor.fetchall()
+            
+            return jsonify({
+                'success': True,
+                'today_count': today_sales[0],
+                'today_amount': today_sales[1],
+                'total_count': total_sales[0],
+                'total_amount': total_sales[1],
+                'recent_sales': recent_sales
+            })
         
-        # Today's sales
+        # The summary only changes when a sale is written (or the day rolls over)
+        return conditional(version_etag(cursor, 'sales', today), build)
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/product_sales')
+def product_sales():
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+
+        # Per-product revenue and margin straight from the indexed sale_items table;
+        # cogs is the FIFO cost fixed when each line was sold
+        date_from = parse_date(request.args.get('from'))
+        date_to = parse_date(request.args.get('to'))
+        clauses, params = [], []
+        if date_from:
+            clauses.append("sale_date >= ?")
+            params.append(date_from)
+        if date_to:
+            clauses.append("sale_date < ?")
+            params.append(next_day(date_to))
+        cursor.execute(f'''SELECT product_name, SUM(quantity), SUM(total), SUM(cogs),
+                                  SUM(total - COALESCE(cogs, quantity * unit_cost))
+                           FROM sale_items {'WHERE ' + ' AND '.join(clauses) if clauses else ''}
+                           GROUP BY COALESCE(stock_id, LOWER(product_name)) ORDER BY SUM(total) DESC''',
+                       params)
+        products = [{'product_name': row[0], 'quantity': row[1], 'revenue': row[2], 'cogs': row[3],
+                     'margin': row[4]}
+                    for row in cursor.fetchall()]
+
+        return jsonify({'success': True, 'products': products})
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/alerts')
+def alerts():
+    try:
+        conn = get_db()
+        roll_window(conn)
+        cursor = conn.cursor()
+        limit = min(int(request.args.get('limit', 50)), 500)
+        days = int(request.args.get('days', DEAD_STOCK_DAYS))
+        min_units = int(request.args.get('min_units', HIGH_VELOCITY_UNITS))
         today = datetime.now().strftime('%Y-%m-%d')
-        cursor.execute("SELECT COUNT(*), COALESCE(SUM(total_amount), 0) FROM sales WHERE DATE(sale_date) = ?", (today,))
-        today_sales = cursor.fetchone()
         
-        # Total sales
-        cursor.execute("SELECT COUNT(*), COALESCE(SUM(total_amount), 0) FROM sales")
-        total_sales = cursor.fetchone()
+        def build():
+            return jsonify({
+                'success': True,
+                'low_stock': [{'product_name': r[0], 'quantity': r[1], 'reorder_level': r[2]}
+                              for r in low_stock(cursor, limit)],
+                'dead_stock': [{'product_name': r[0], 'quantity': r[1], 'last_sold_at': r[2]}
+                               for r in dead_stock(cursor, days, limit)],
+                'high_velocity': [{'product_name': r[0], 'quantity': r[1], 'recent_sold': r[2]}
+                                  for r in high_velocity(cursor, min_units, limit)]
+            })
         
-        # Recent sales
-        cursor.execute("SELECT invoice_no, customer_name, total_amount, sale_date FROM sales ORDER BY sale_date DESC LIMIT 5")
-        recent_sales = cursor.fetchall()
+        # Every sale, return and window roll writes to stock, so its version covers all three lists
+        return conditional(version_etag(cursor, 'stock', today, limit, days, min_units), build)
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/forecast')
+def forecast():
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        limit = min(int(request.args.get('limit', 50)), 1000)
+        products = forecasts.get(cursor)
         
-        conn.close()
+        return jsonify({'success': True, 'revenue_next_week': forecast_revenue(cursor),
+                        'count': len(products), 'products': products[:limit]})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/forecast/<int:stock_id>')
+def product_forecast(stock_id):
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        for product in forecasts.get(cursor):
+            if product['stock_id'] == stock_id:
+                return jsonify({'success': True, 'forecast': product})
         
-        return jsonify({
-            'success': True,
-            'today_count': today_sales[0],
-            'today_amount': today_sales[1],
-            'total_count': total_sales[0],
-            'total_amount': total_sales[1],
-            'recent_sales': recent_sales
-        })
+        return jsonify({'success': False, 'error': 'Product not found'})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/analytics')
 def analytics():
-    conn = sqlite3.connect('business_system.db')
+    conn = get_db()
     cursor = conn.cursor()
     
     # Basic metrics
-    cursor.execute("SELECT SUM(total_amount) FROM sales")
-    total_revenue = cursor.fetchone()[0] or 0
-    
-    cursor.execute("SELECT COUNT(*) FROM sales")
-    total_sales = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT SUM(quantity * purchase_price) FROM stock")
-    stock_value = cursor.fetchone()[0] or 0
-    
-    cursor.execute("SELECT SUM(amount) FROM expenses")
-    total_expenses = cursor.fetchone()[0] or 0
+    total_revenue, total_sales, total_expenses, _ = get_totals(cursor)
+    cost_of_goods = total_cogs(cursor)
+    stock_value = get_stock_totals(cursor)[2]
     
     # Monthly data for current year
     current_year = datetime.now().year
-    cursor.execute("""SELECT strftime('%m', sale_date) as month, 
-                            SUM(total_amount) as revenue,
-                            (SELECT SUM(amount) FROM expenses WHERE strftime('%Y-%m', date) = strftime('%Y-%m', sales.sale_date)) as expenses
-                     FROM sales 
-                     WHERE strftime('%Y', sale_date) = ? 
-                     GROUP BY month ORDER BY month""", (str(current_year),))
-    monthly_data = cursor.fetchall()
+    monthly_profit_loss = [(period[5:7], revenue, expenses, profit) for period, revenue, expenses, profit
+                           in profit_loss(cursor, 'month', f"{current_year}-01-01", f"{current_year}-12-31")]
     
     # Yearly profit/loss data
-    cursor.execute("""SELECT strftime('%Y', sale_date) as year, 
-                            SUM(total_amount) as revenue,
-                            (SELECT SUM(amount) FROM expenses WHERE strftime('%Y', date) = strftime('%Y', sales.sale_date)) as expenses
-                     FROM sales 
-                     GROUP BY year ORDER BY year""")
-    yearly_data = cursor.fetchall()
-    
-    # Process data for charts
-    monthly_profit_loss = []
-    for month_data in monthly_data:
-        month, revenue, expenses = month_data
-        expenses = expenses or 0
-        profit = revenue - expenses
-        monthly_profit_loss.append((month, revenue, expenses, profit))
+    yearly_profit_loss = profit_loss(cursor, 'year')
     
-    yearly_profit_loss = []
-    for year_data in yearly_data:
-        year, revenue, expenses = year_data
-        expenses = expenses or 0
-        profit = revenue - expenses
-        yearly_profit_loss.append((year, revenue, expenses, profit))
-    
-    conn.close()
+    # Custom range / granularity requested through the query string
+    try:
+        granularity = request.args.get('granularity', 'month')
+        series = profit_loss(cursor, granularity,
+                             parse_date(request.args.get('from')), parse_date(request.args.get('to')))
+    except ValueError as e:
+        return f"Error: {str(e)}", 400
     
     analytics_data = {
         'total_revenue': total_revenue,
         'total_sales': total_sales,
         'stock_value': stock_value,
         'total_expenses': total_expenses,
-        'profit_loss': total_revenue - total_expenses - stock_value,
+        'cogs': cost_of_goods,
+        'gross_margin': total_revenue - cost_of_goods,
+        # Stock still on the shelf is an asset, not a loss; only what was sold is costed
+        'profit_loss': total_revenue - cost_of_goods - total_expenses,
         'monthly_data': monthly_profit_loss,
         'yearly_data': yearly_profit_loss,
-        'current_year': current_year
+        'current_year': current_year,
+        'granularity': granularity,
+        'series': series
     }
     
     return render_template('profit_loss_analytics.html', data=analytics_data)
 
+@app.route('/get_profit_loss')
+def get_profit_loss():
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        periods = margin_report(cursor, request.args.get('granularity', 'month'),
+                                parse_date(request.args.get('from')), parse_date(request.args.get('to')))
+        return jsonify({'success': True, 'periods': periods})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/margins/sale/<invoice_no>')
+def sale_margin(invoice_no):
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, sale_date, total_amount FROM sales WHERE invoice_no = ?", (invoice_no,))
+        sale = cursor.fetchone()
+        if not sale:
+            return jsonify({'success': False, 'error': 'Sale not found'})
+        
+        cursor.execute('''SELECT product_name, quantity, total, cogs FROM sale_items
+                          WHERE sale_id = ? ORDER BY id''', (sale[0],))
+        lines = [{'product_name': row[0], 'quantity': row[1], 'revenue': row[2], 'cogs': row[3],
+                  'margin': row[2] - (row[3] or 0)} for row in cursor.fetchall()]
+        cogs = sum(line['cogs'] or 0 for line in lines)
+        return jsonify({'success': True, 'invoice_no': invoice_no, 'date': sale[1], 'revenue': sale[2],
+                        'cogs': cogs, 'margin': sale[2] - cogs, 'items': lines})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/movements/<int:stock_id>')
+def stock_movements(stock_id):
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        limit = min(int(request.args.get('limit', 100)), 1000)
+        before = request.args.get('before', type=int)
+        rows = movements(cursor, stock_id, before, limit)
+        return jsonify({'success': True, 'movements': rows,
+                        'next_before': rows[-1]['id'] if len(rows) == limit else None})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
 @app.route('/ledger')
 def ledger():
-    conn = sqlite3.connect('business_system.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM credits ORDER BY date DESC")
-    credits_data = cursor.fetchall()
-    conn.close()
-    return render_template('ledger_management.html', credits=credits_data)
+    return _listing_page('credits', 'ledger_management.html', 'credits')
 
 @app.route('/expenses')
 def expenses():
-    conn = sqlite3.connect('business_system.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM expenses ORDER BY date DESC")
-    expenses_data = cursor.fetchall()
-    conn.close()
-    return render_template('expense_management.html', expenses=expenses_data)
+    return _listing_page('expenses', 'expense_management.html', 'expenses')
 
 @app.route('/add_expense', methods=['POST'])
 def add_expense():
     try:
         data = request.json
-        conn = sqlite3.connect('business_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         cursor.execute('''INSERT INTO expenses (category, amount, description, date)
@@ -625,7 +933,6 @@ def add_expense():
                        datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
         
         conn.commit()
-        conn.close()
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
@@ -633,57 +940,44 @@ def add_expense():
 @app.route('/ai_chat', methods=['POST'])
 def ai_chat():
     try:
-        query = request.json['query'].lower()
+        query = request.json['query']
         
-        conn = sqlite3.connect('business_system.db')
+        conn = get_db()
+        # Fast-mover answers read recent_sold; a roll is a stock write, so it also clears the answer cache
+        roll_window(conn)
         cursor = conn.cursor()
         
-        if "stock" in query or "inventory" in query:
-            if "low" in query:
-                cursor.execute("SELECT product_name, quantity FROM stock WHERE quantity < 10")
-                low_stock = cursor.fetchall()
-                response = "Low stock: " + ", ".join([f"{item[0]} ({item[1]} left)" for item in low_stock]) if low_stock else "All items well stocked!"
-            else:
-                cursor.execute("SELECT COUNT(*), SUM(quantity) FROM stock")
-                result = cursor.fetchone()
-                response = f"Total: {result[0]} products, {result[1]} items in stock"
-        elif "sales" in query or "revenue" in query:
-            if "today" in query:
-                cursor.execute("SELECT COUNT(*), SUM(total_amount) FROM sales WHERE DATE(sale_date) = DATE('now')")
-                result = cursor.fetchone()
-                response = f"Today: {result[0]} sales, PKR {result[1] or 0} revenue"
-            else:
-                cursor.execute("SELECT COUNT(*), SUM(total_amount) FROM sales")
-                result = cursor.fetchone()
-                response = f"Total: {result[0]} sales, PKR {result[1] or 0} revenue"
-        elif "profit" in query:
-            cursor.execute("SELECT SUM(total_amount) FROM sales")
-            revenue = cursor.fetchone()[0] or 0
-            cursor.execute("SELECT SUM(amount) FROM expenses")
-            expenses = cursor.fetchone()[0] or 0
-            cursor.execute("SELECT SUM(quantity * purchase_price) FROM stock")
-            stock_cost = cursor.fetchone()[0] or 0
-            profit = revenue - expenses - stock_cost
-            response = f"Profit: PKR {profit} (Revenue: PKR {revenue}, Expenses: PKR {expenses}, Stock: PKR {stock_cost})"
-        else:
-            response = "I can help with stock, sales, profit analysis. Ask me anything!"
+        # Intent, time range and product are parsed once; answers come from the rollups
+        # and are cached until the next write
+        intent, response = ask(cursor, query)
         
-        conn.close()
-        return jsonify({'response': response})
+        return jsonify({'response': response, 'intent': intent})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/export/<kind>')
+def export(kind):
+    try:
+        chunks, content_type, filename = stream_export(
+            kind, request.args.get('format', 'csv'),
+            parse_date(request.args.get('from')), parse_date(request.args.get('to')),
+            gzip=request.args.get('gzip') == '1', path=current_path())
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)})
+    
+    return Response(chunks, mimetype=content_type,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
 @app.route('/print_invoice/<invoice_no>')
 def print_invoice(invoice_no):
     try:
-        conn = sqlite3.connect('business_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM sales WHERE invoice_no = ?", (invoice_no,))
         sale = cursor.fetchone()
-        conn.close()
         
         if sale:
-            items = json.loads(sale[4])
+            items = get_sale_items(cursor, sale[0])
             return render_template('elegant_invoice.html', sale=sale, items=items)
         return "Invoice not found", 404
     except Exception as e:
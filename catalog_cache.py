@@ -0,0 +1,86 @@
+"""
+Per-worker catalog cache for the POS lookups
+
+get_product_info and get_all_stock are polled on every keystroke at the
+till.  Their results are kept in a bounded LRU with a TTL; before serving
+a hit the cache compares its version with the stock data version (see
+versions.py), which every stock write bumps inside its own transaction, so
+a change made through any gunicorn worker clears every worker's cache on
+its next lookup.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from stores import StoreLocal
+from versions import data_version
+
+CACHE_SIZE = int(os.environ.get('CATALOG_CACHE_SIZE', 10000))
+CACHE_TTL = float(os.environ.get('CATALOG_CACHE_TTL', 60))
+
+
+class CatalogCache:
+
+    def __init__(self, max_size=CACHE_SIZE, ttl=CACHE_TTL, tables=('stock',)):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.tables = tables
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, cursor, key, loader):
+        """Return the cached value for key, calling loader(cursor) on a miss."""
+        # A write to any of the tables it depends on invalidates the whole cache
+        version = tuple(data_version(cursor, table) for table in self.tables)
+        now = time.monotonic()
+        with self._lock:
+            if version != self._version:
+                if self._version is not None:
+                    self.invalidations += 1
+                self._entries.clear()
+                self._version = version
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        value = loader(cursor)
+        with self._lock:
+            # Only keep it if nothing was invalidated while we were loading
+            if self._version == version:
+                self._entries[key] = (now + self.ttl, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._version = None
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0,
+                'invalidations': self.invalidations,
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'version': self._version,
+            }
+
+
+# One cache per store database
+catalog = StoreLocal(CatalogCache)
@@ -0,0 +1,300 @@
+"""
+Intent engine behind /ai_chat
+
+A question is parsed into an Intent -- what is asked (sales, top customers,
+low stock, ...), a time range ("last week", "this month", "last 7 days",
+"2024"), a limit ("top 5") and the word n-grams that may name a product.
+Parsing is pure and memoized per question text.  answer() maps each
+intent onto a parameterized query that is either a lookup in the
+precomputed aggregates (summary_totals, stock_totals, the stock alert
+columns) or an index range scan over sale_items / sales, and keeps recent
+answers in an LRU that any write to stock, sales, expenses, returns or
+credits invalidates (see versions.py).
+"""
+
+import calendar
+import re
+from collections import namedtuple
+from datetime import date, timedelta
+from functools import lru_cache
+
+from catalog_cache import CatalogCache
+from inventory import period_cogs, total_cogs
+from stores import StoreLocal
+from summaries import NAMED_CUSTOMER, get_totals, get_stock_totals
+from stock_alerts import low_stock, dead_stock, high_velocity, DEAD_STOCK_DAYS
+from versions import TRACKED_TABLES
+
+Intent = namedtuple('Intent', 'name period limit ngrams')
+
+DEFAULT_LIMIT = 5
+MAX_LIMIT = 50
+MAX_NGRAM = 3
+
+HELP = "I can help with stock, sales, profit analysis. Ask me anything!"
+
+# (intent, words any of which must appear, words any of which must also appear)
+RULES = (
+    ('forecast', ('forecast', 'predict', 'prediction', 'projected'), None),
+    ('dead_stock', ('dead', 'unsold', 'slow'), None),
+    ('low_stock', ('low', 'reorder', 'restock'), None),
+    ('fast_movers', ('fast', 'velocity', 'trending', 'hot'), None),
+    ('top_customers', ('customer', 'customers', 'buyer', 'buyers'), ('top', 'best', 'biggest')),
+    ('top_products', ('top', 'best', 'most'), ('product', 'products', 'item', 'items', 'selling', 'seller', 'sellers', 'sold')),
+    ('balance', ('owe', 'owes', 'owed', 'balance', 'due', 'dues', 'outstanding'), None),
+    ('profit', ('profit', 'profits', 'margin', 'loss'), None),
+    ('expenses', ('expense', 'expenses', 'spent', 'spending', 'costs'), None),
+    ('returns', ('return', 'returns', 'returned', 'refund', 'refunds'), None),
+    ('sales', ('sale', 'sales', 'revenue', 'sold', 'sell', 'income', 'earned'), None),
+    ('stock', ('stock', 'inventory', 'items', 'products'), None),
+)
+
+_WORD = re.compile(r"[\w'-]+")
+_LAST_DAYS = re.compile(r'\b(?:last|past) (\d{1,3}) days?\b')
+_RELATIVE = re.compile(r'\b(this|last|previous) (week|month|year)\b')
+_DAY = re.compile(r'\b(today|yesterday)\b')
+_YEAR = re.compile(r'\b(20\d\d|19\d\d)\b')
+_TOP = re.compile(r'\b(?:top|best|first) (\d{1,2})\b')
+
+
+@lru_cache(maxsize=1024)
+def parse(question):
+    """Parse a question into an Intent; the period is relative, e.g. ('last', 'week')."""
+    text = question.lower()
+    words = _WORD.findall(text)
+    vocabulary = set(words)
+
+    name = None
+    for intent, required, qualifiers in RULES:
+        if vocabulary.intersection(required) and (qualifiers is None or vocabulary.intersection(qualifiers)):
+            name = intent
+            break
+
+    match = _LAST_DAYS.search(text)
+    if match:
+        period = ('days', int(match.group(1)))
+    elif _RELATIVE.search(text):
+        which, unit = _RELATIVE.search(text).groups()
+        period = ('this' if which == 'this' else 'last', unit)
+    elif _DAY.search(text):
+        period = (_DAY.search(text).group(1), None)
+    elif _YEAR.search(text):
+        period = ('year', int(_YEAR.search(text).group(1)))
+    else:
+        period = None
+
+    match = _TOP.search(text)
+    limit = min(int(match.group(1)), MAX_LIMIT) if match else DEFAULT_LIMIT
+
+    ngrams = tuple(' '.join(words[i:i + n]) for n in range(MAX_NGRAM, 0, -1)
+                   for i in range(len(words) - n + 1))
+    return Intent(name, period, limit, ngrams)
+
+
+def resolve_period(period, today):
+    """Turn a relative period into (start, end, label, granularity, key).
+
+    granularity/key name a single summary_totals row when the period is exactly
+    one day, month or year, otherwise they are None.
+    """
+    if period is None:
+        return None, None, 'all time', 'all', 'all'
+    kind, value = period
+    if kind in ('today', 'yesterday'):
+        day = today if kind == 'today' else today - timedelta(days=1)
+        return day, day, kind, 'day', day.isoformat()
+    if kind == 'days':
+        return today - timedelta(days=value - 1), today, f"last {value} days", None, None
+    if kind == 'year':
+        return date(value, 1, 1), date(value, 12, 31), str(value), 'year', str(value)
+    if value == 'week':
+        start = today - timedelta(days=today.weekday())
+        if kind == 'last':
+            start -= timedelta(days=7)
+        return start, start + timedelta(days=6), f"{kind} week", None, None
+    if value == 'month':
+        start = today.replace(day=1)
+        if kind == 'last':
+            start = (start - timedelta(days=1)).replace(day=1)
+        end = start.replace(day=calendar.monthrange(start.year, start.month)[1])
+        return start, end, f"{kind} month", 'month', start.strftime('%Y-%m')
+    year = today.year if kind == 'this' else today.year - 1
+    return date(year, 1, 1), date(year, 12, 31), f"{kind} year", 'year', str(year)
+
+
+def _bounds(start, end):
+    # sale_date style bounds covering whole days ('YYYY-MM-DD' .. 'YYYY-MM-DD 99')
+    if start is None:
+        return '0000-00-00', '9999-99-99'
+    return start.isoformat(), end.isoformat() + ' 99'
+
+
+def _period_totals(cursor, start, end, granularity, key):
+    """(revenue, sales_count, expenses, returns_qty) for a period from the rollups."""
+    if granularity:
+        return get_totals(cursor, granularity, key)
+    cursor.execute('''SELECT COALESCE(SUM(revenue), 0), COALESCE(SUM(sales_count), 0),
+                             COALESCE(SUM(expenses), 0), COALESCE(SUM(returns_qty), 0)
+                      FROM summary_totals WHERE granularity = 'day' AND period BETWEEN ? AND ?''',
+                   (start.isoformat(), end.isoformat()))
+    return cursor.fetchone()
+
+
+def find_product(cursor, ngrams):
+    """The longest n-gram of the question that is a product name: (id, product_name, quantity) or None."""
+    if not ngrams:
+        return None
+    marks = ','.join('?' * len(ngrams))
+    cursor.execute(f'''SELECT id, product_name, quantity FROM stock
+                       WHERE product_name COLLATE NOCASE IN ({marks})''', ngrams)
+    found = {row[1].lower(): row for row in cursor.fetchall()}
+    for ngram in ngrams:
+        if ngram in found:
+            return found[ngram]
+    return None
+
+
+def find_party(cursor, ngrams):
+    """The longest n-gram of the question that names a customer or supplier: (type, name, balance) or None."""
+    if not ngrams:
+        return None
+    marks = ','.join('?' * len(ngrams))
+    cursor.execute(f'''SELECT type, name, balance FROM parties
+                       WHERE type IN ('customer', 'supplier') AND name COLLATE NOCASE IN ({marks})''', ngrams)
+    found = {row[1].lower(): row for row in cursor.fetchall()}
+    for ngram in ngrams:
+        if ngram in found:
+            return found[ngram]
+    return None
+
+
+def _money(value):
+    return round(value or 0, 2)
+
+
+def _answer_sales(cursor, intent, start, end, label, granularity, key):
+    product = find_product(cursor, intent.ngrams)
+    if product:
+        date_from, date_to = _bounds(start, end)
+        cursor.execute('''SELECT COALESCE(SUM(quantity), 0), COALESCE(SUM(total), 0) FROM sale_items
+                          WHERE stock_id = ? AND sale_date BETWEEN ? AND ?''', (product[0], date_from, date_to))
+        quantity, revenue = cursor.fetchone()
+        return f"{product[1]} ({label}): {quantity} sold, PKR {_money(revenue)} revenue"
+    revenue, count, _, _ = _period_totals(cursor, start, end, granularity, key)
+    if intent.period is None:
+        return f"Total: {count} sales, PKR {revenue} revenue"
+    return f"{label.capitalize()}: {count} sales, PKR {_money(revenue)} revenue"
+
+
+def _answer_top_products(cursor, intent, start, end, label):
+    if start is None:
+        cursor.execute('''SELECT product_name, sold_quantity FROM stock WHERE sold_quantity > 0
+                          ORDER BY sold_quantity DESC LIMIT ?''', (intent.limit,))
+    else:
+        cursor.execute('''SELECT product_name, SUM(quantity) FROM sale_items WHERE sale_date BETWEEN ? AND ?
+                          GROUP BY COALESCE(stock_id, LOWER(product_name))
+                          ORDER BY SUM(quantity) DESC LIMIT ?''', (*_bounds(start, end), intent.limit))
+    rows = cursor.fetchall()
+    if not rows:
+        return f"No products sold ({label})."
+    return f"Top products ({label}): " + ", ".join(f"{name} ({quantity} sold)" for name, quantity in rows)
+
+
+def _answer_top_customers(cursor, intent, start, end, label):
+    # Names are matched case-insensitively, as in parties ("Ali" and "ali" are one customer)
+    if start is None:
+        cursor.execute("SELECT name, revenue, sales_count FROM customer_totals ORDER BY revenue DESC LIMIT ?",
+                       (intent.limit,))
+    else:
+        cursor.execute(f'''SELECT MIN(customer_name), SUM(total_amount), COUNT(*) FROM sales
+                           WHERE sale_date BETWEEN ? AND ? AND {NAMED_CUSTOMER}
+                           GROUP BY customer_name COLLATE NOCASE ORDER BY SUM(total_amount) DESC LIMIT ?''',
+                       (*_bounds(start, end), intent.limit))
+    rows = cursor.fetchall()
+    if not rows:
+        return f"No customer sales ({label})."
+    return f"Top customers ({label}): " + ", ".join(
+        f"{name} (PKR {_money(total)}, {count} sales)" for name, total, count in rows)
+
+
+def _answer_stock(cursor, intent):
+    product = find_product(cursor, intent.ngrams)
+    if product:
+        return f"{product[1]}: {product[2]} in stock"
+    products, quantity, _ = get_stock_totals(cursor)
+    return f"Total: {products} products, {quantity} items in stock"
+
+
+def _answer_forecast(cursor):
+    # Imported here so chat keeps working where numpy is not installed
+    from forecasting import forecasts, forecast_revenue
+    top = [p for p in forecasts.get(cursor)[:DEFAULT_LIMIT] if p['forecast_qty'] > 0]
+    response = f"Forecast for next week: PKR {forecast_revenue(cursor)} revenue"
+    if top:
+        response += ". Top products: " + ", ".join(f"{p['product_name']} ({p['forecast_qty']} units)" for p in top)
+    return response
+
+
+def answer(cursor, intent, today):
+    """Answer a parsed Intent; returns the response text."""
+    start, end, label, granularity, key = resolve_period(intent.period, today)
+    name = intent.name
+
+    if name == 'low_stock':
+        items = low_stock(cursor, MAX_LIMIT)
+        return "Low stock: " + ", ".join(f"{item[0]} ({item[1]} left)" for item in items) if items else "All items well stocked!"
+    if name == 'dead_stock':
+        items = dead_stock(cursor, limit=MAX_LIMIT)
+        return f"Unsold for {DEAD_STOCK_DAYS}+ days: " + ", ".join(f"{item[0]} ({item[1]} in stock)" for item in items) if items else "No dead stock!"
+    if name == 'fast_movers':
+        items = high_velocity(cursor, limit=intent.limit)
+        return "Fast movers: " + ", ".join(f"{item[0]} ({item[2]} sold recently)" for item in items) if items else "No fast-moving items right now."
+    if name == 'forecast':
+        return _answer_forecast(cursor)
+    if name == 'top_customers':
+        return _answer_top_customers(cursor, intent, start, end, label)
+    if name == 'top_products':
+        return _answer_top_products(cursor, intent, start, end, label)
+    if name == 'sales':
+        return _answer_sales(cursor, intent, start, end, label, granularity, key)
+    if name == 'balance':
+        party = find_party(cursor, intent.ngrams)
+        if party:
+            if party[0] == 'customer':
+                return f"{party[1]} owes PKR {_money(party[2])}"
+            return f"You owe {party[1]} PKR {_money(party[2])}"
+        cursor.execute("SELECT type, COALESCE(SUM(balance), 0) FROM parties WHERE balance > 0 GROUP BY type")
+        totals = dict(cursor.fetchall())
+        return (f"Customers owe PKR {_money(totals.get('customer'))}; "
+                f"you owe suppliers PKR {_money(totals.get('supplier'))}")
+    if name == 'profit':
+        revenue, _, expenses, _ = _period_totals(cursor, start, end, granularity, key)
+        cogs = total_cogs(cursor, granularity, key) if granularity else \
+            period_cogs(cursor, start.isoformat(), end.isoformat())
+        return (f"Profit ({label}): PKR {_money(revenue - cogs - expenses)} "
+                f"(Revenue: PKR {_money(revenue)}, Cost of goods sold: PKR {_money(cogs)}, "
+                f"Expenses: PKR {_money(expenses)})")
+    if name == 'expenses':
+        expenses = _period_totals(cursor, start, end, granularity, key)[2]
+        return f"Expenses ({label}): PKR {_money(expenses)}"
+    if name == 'returns':
+        returns_qty = _period_totals(cursor, start, end, granularity, key)[3]
+        return f"Returns ({label}): {returns_qty} items"
+    if name == 'stock':
+        return _answer_stock(cursor, intent)
+    return HELP
+
+
+answers = StoreLocal(lambda: CatalogCache(max_size=1024, tables=TRACKED_TABLES))
+
+
+def ask(cursor, question, today=None):
+    """Parse and answer a question, serving repeats from the answer cache.
+
+    Returns (intent name, response text).
+    """
+    today = today or date.today()
+    intent = parse(question.strip())
+    if intent.name is None:
+        return None, HELP
+    return intent.name, answers.get(cursor, (intent, today), lambda c: answer(c, intent, today))
@@ -0,0 +1,183 @@
+"""
+Sale reservation and commit
+
+place_sale() is the single write path behind create_invoice,
+simple_create_sale and create_sale (and, through record_sale(), the
+batched till sync in pos_sync.py).  It takes the write lock up front
+(BEGIN IMMEDIATE), resolves every cart line once through the product
+index, decrements stock with conditional updates (WHERE quantity >= ?)
+and rolls the whole invoice back if any line falls short, so concurrent
+checkouts in different workers can never oversell.
+"""
+
+from datetime import datetime
+
+from database import current_path, write_transaction
+from inventory import issue
+from ledger import ensure_party
+from receipts import enqueue_receipt, notify as notify_receipts
+
+
+class SaleRejected(Exception):
+    """Raised when a cart cannot be fulfilled; .errors holds one message per problem."""
+
+    def __init__(self, errors):
+        super().__init__('; '.join(errors))
+        self.errors = errors
+
+
+def item_name(item):
+    # Handle both 'name' and 'product_name' keys for compatibility
+    return item.get('product_name') or item.get('name')
+
+
+def line_total(item):
+    # Tills may leave the line total out; it is then price x quantity
+    total = item.get('total')
+    return (item.get('price') or 0) * item['quantity'] if total is None else total
+
+
+def resolve_product(cursor, item):
+    """Look a cart line up once by index: stock_id when the till sent it, else the product key.
+
+    Returns (id, quantity, purchase_price) or None.
+    """
+    if item.get('stock_id'):
+        cursor.execute("SELECT id, quantity, purchase_price FROM stock WHERE id = ?", (item['stock_id'],))
+    else:
+        cursor.execute("SELECT id, quantity, purchase_price FROM stock WHERE product_name = ? COLLATE NOCASE",
+                       (item_name(item),))
+    return cursor.fetchone()
+
+
+def record_sale_items(cursor, sale_id, sale_date, lines, costs):
+    """Insert invoice lines given as (cart item, resolved stock row or None) pairs.
+
+    costs is the FIFO cost of each line (see inventory.issue); None for an
+    unknown product, which is recorded without a stock_id or cost.
+    """
+    rows = []
+    for number, (item, product) in enumerate(lines):
+        quantity = item['quantity']
+        price = item.get('price')
+        total = line_total(item)
+        if price is None:
+            price = total / quantity if quantity else 0
+        # Unknown products are still recorded, just without a stock_id / cost
+        stock_id, unit_cost = (product[0], product[2]) if product else (None, None)
+        cost = costs[number]
+        if cost is not None:
+            unit_cost = cost / quantity if quantity else 0
+        rows.append((sale_id, stock_id, item_name(item), quantity, price, unit_cost, total, sale_date, cost))
+    cursor.executemany('''INSERT INTO sale_items
+                          (sale_id, stock_id, product_name, quantity, unit_price, unit_cost, total, sale_date, cogs)
+                          VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+
+
+def next_invoice_no(cursor, prefix='INV', now=None):
+    """Allocate the next invoice number for today, e.g. INV20240131-00042.
+
+    Must run inside a write transaction: the per-day counter row is bumped
+    under the database write lock, so numbers never repeat across workers.
+    """
+    day = (now or datetime.now()).strftime('%Y%m%d')
+    cursor.execute('''INSERT INTO invoice_counters (day, last_no) VALUES (?, 1)
+                      ON CONFLICT(day) DO UPDATE SET last_no = last_no + 1''', (day,))
+    cursor.execute("SELECT last_no FROM invoice_counters WHERE day = ?", (day,))
+    return f"{prefix}{day}-{cursor.fetchone()[0]:05d}"
+
+
+def _reserve(cursor, items):
+    # Resolve and check every line, then decrement each product once
+    lines, errors, wanted = [], [], {}
+    for item in items:
+        name = item_name(item)
+        product = resolve_product(cursor, item)
+        quantity = item.get('quantity')
+        # JSON clients may send a whole number as 2.0
+        if isinstance(quantity, float) and quantity.is_integer():
+            item['quantity'] = quantity = int(quantity)
+        if isinstance(quantity, bool) or not isinstance(quantity, int) or quantity <= 0:
+            errors.append(f"Invalid quantity for '{name}': {quantity!r} is not a whole number above zero")
+        elif not product:
+            errors.append(f"Product '{name}' not found in stock")
+        else:
+            wanted[product[0]] = wanted.get(product[0], 0) + item['quantity']
+            if product[1] < wanted[product[0]]:
+                errors.append(f"Insufficient stock for '{name}'. Available: {product[1]}")
+        lines.append((item, product))
+    if errors:
+        raise SaleRejected(errors)
+
+    cursor.executemany('''UPDATE stock SET quantity = quantity - ?, sold_quantity = sold_quantity + ?
+                          WHERE id = ? AND quantity >= ?''',
+                       [(qty, qty, stock_id, qty) for stock_id, qty in wanted.items()])
+    if cursor.rowcount != len(wanted):
+        raise SaleRejected(["Stock changed while the sale was being processed, please retry"])
+    return lines
+
+
+def record_sale(cursor, items, customer_name, customer_phone, payment_type, prefix='INV',
+                receipt_phone=None, now=None):
+    """Reserve stock and write one sale inside the caller's write transaction.
+
+    `now` is when the sale happened (the till's clock for synced sales).
+    Raises SaleRejected, possibly after some stock rows were already
+    decremented, so the caller must roll back (to a savepoint) on error.
+    """
+    if not items:
+        raise SaleRejected(["Cart is empty"])
+    lines = _reserve(cursor, items)
+
+    now = now or datetime.now()
+    invoice_no = next_invoice_no(cursor, prefix, now)
+    total_amount = sum(line_total(item) for item in items)
+    sale_date = now.strftime("%Y-%m-%d %H:%M:%S")
+
+    cursor.execute('''INSERT INTO sales
+                     (invoice_no, customer_name, customer_phone, items, total_amount, payment_type, sale_date)
+                     VALUES (?, ?, ?, '[]', ?, ?, ?)''',
+                   (invoice_no, customer_name, customer_phone, total_amount, payment_type, sale_date))
+    sale_id = cursor.lastrowid
+    # Cost each line from the oldest stock first, so the margin is fixed now
+    costs = [issue(cursor, product[0], item['quantity'], 'sale', sale_id, at=sale_date) if product else None
+             for item, product in lines]
+    record_sale_items(cursor, sale_id, sale_date, lines, costs)
+
+    # Named customers with a phone or a tab become parties; the credits trigger
+    # keeps their balance
+    if customer_name and (customer_phone or payment_type == 'credit'):
+        ensure_party(cursor, 'customer', customer_name, customer_phone)
+    if payment_type == 'credit' and customer_name:
+        cursor.execute('''INSERT INTO credits (type, name, amount, description, date)
+                         VALUES (?, ?, ?, ?, ?)''',
+                       ("customer", customer_name, total_amount, f"Sale: {invoice_no}", sale_date))
+
+    if receipt_phone:
+        enqueue_receipt(cursor, sale_id, receipt_phone, {
+            'invoice_no': invoice_no, 'customer_name': customer_name, 'sale_date': sale_date,
+            'total_amount': total_amount,
+            'items': [{'product_name': item_name(item), 'quantity': item['quantity'],
+                       'price': item.get('price'), 'total': line_total(item)} for item in items],
+        })
+    return {'sale_id': sale_id, 'invoice_no': invoice_no, 'total_amount': total_amount}
+
+
+def place_sale(conn, items, customer_name, customer_phone, payment_type, prefix='INV',
+               receipt_phone=None):
+    """Reserve stock and record one sale atomically.
+
+    When receipt_phone is given a WhatsApp receipt is queued in the same
+    transaction.  Returns {'sale_id', 'invoice_no', 'total_amount'}; raises
+    SaleRejected (after rolling back) if any line is unknown or short.
+    """
+    if not items:
+        raise SaleRejected(["Cart is empty"])
+
+    with write_transaction(conn):
+        sale = record_sale(conn.cursor(), items, customer_name, customer_phone, payment_type, prefix,
+                           receipt_phone)
+
+    if receipt_phone:
+        notify_receipts(current_path())
+    return sale
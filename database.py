@@ -0,0 +1,150 @@
+"""
+SQLite connection management shared by every route
+
+Each gunicorn worker keeps a small pool of open connections per database
+file -- one file per store (see stores.py).  Connections are opened in WAL mode with tuned pragmas so readers
+never block the writer and concurrent checkouts wait on the busy timeout
+instead of failing with "database is locked".
+"""
+
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+
+from metrics import connection_factory
+
+DB_PATH = os.environ.get('DATABASE_PATH', 'business_system.db')
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 10000))
+CACHE_SIZE_KB = int(os.environ.get('DB_CACHE_SIZE_KB', 16384))
+MMAP_SIZE = int(os.environ.get('DB_MMAP_SIZE', 256 * 1024 * 1024))
+STATEMENT_CACHE_SIZE = int(os.environ.get('DB_STATEMENT_CACHE_SIZE', 256))
+
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    f"PRAGMA cache_size = -{CACHE_SIZE_KB}",
+    f"PRAGMA mmap_size = {MMAP_SIZE}",
+    "PRAGMA temp_store = MEMORY",
+    f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}",
+)
+
+
+def connect(path=None):
+    """Open a new tuned connection; prefer the pool over calling this directly."""
+    conn = sqlite3.connect(path or DB_PATH,
+                           timeout=BUSY_TIMEOUT_MS / 1000,
+                           check_same_thread=False,
+                           cached_statements=STATEMENT_CACHE_SIZE,
+                           factory=connection_factory())
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+class ConnectionPool:
+    """Bounded LIFO pool of connections to one database file.
+
+    The pool remembers the pid that created it so connections inherited
+    across a gunicorn fork are dropped rather than shared between workers.
+    """
+
+    def __init__(self, path, size=POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._pid = os.getpid()
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            self._idle = queue.LifoQueue(maxsize=self.size)
+            self._pid = os.getpid()
+
+    def acquire(self):
+        self._check_fork()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return connect(self.path)
+
+    def release(self, conn):
+        if self._pid != os.getpid():
+            return
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put_nowait(conn)
+        except (queue.Full, sqlite3.Error):
+            conn.close()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(path=None):
+    path = path or DB_PATH
+    pool = _pools.get(path)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(path, ConnectionPool(path))
+    return pool
+
+
+@contextmanager
+def connection(path=None):
+    """Borrow a pooled connection outside of a request (CLI, startup, workers)."""
+    pool = get_pool(path)
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+
+@contextmanager
+def write_transaction(conn):
+    """Run a block under BEGIN IMMEDIATE, committing on success and rolling back on error.
+
+    Taking the write lock up front means checks made inside the block still
+    hold when its writes run, even with other gunicorn workers writing too.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+def current_path():
+    """Database file of the store the current request is for (see stores.py)."""
+    if has_app_context():
+        return g.get('db_path') or DB_PATH
+    return DB_PATH
+
+
+def get_db():
+    """Return the pooled connection bound to the current request."""
+    if 'db' not in g:
+        g.db_pool = get_pool(current_path())
+        g.db = g.db_pool.acquire()
+    return g.db
+
+
+def close_db(exc=None):
+    conn = g.pop('db', None)
+    if conn is not None:
+        g.pop('db_pool').release(conn)
@@ -0,0 +1,115 @@
+"""
+Streaming CSV / NDJSON exports
+
+Rows are pulled from a server-side cursor in fixed-size batches and encoded
+as they go, so an export of any size runs in constant memory and the first
+bytes reach the client immediately.  The generator borrows its own pooled
+connection because it keeps running after the view function has returned.
+"""
+
+import csv
+import io
+import json
+import zlib
+
+from database import connection
+
+BATCH_SIZE = 1000
+
+# kind -> (SELECT ..., date column used for from/to filters, ORDER BY)
+EXPORTS = {
+    # One row per invoice line, with the invoice header repeated
+    'sales': ('''SELECT s.id AS sale_id, s.invoice_no, s.customer_name, s.customer_phone,
+                        s.payment_type, s.sale_date, s.total_amount AS invoice_total,
+                        i.stock_id, i.product_name, i.quantity, i.unit_price, i.unit_cost,
+                        i.total AS line_total
+                 FROM sales s LEFT JOIN sale_items i ON i.sale_id = s.id''',
+              's.sale_date', 's.sale_date, s.id, i.id'),
+    'stock': ("SELECT * FROM stock", 'date_added', 'id'),
+    'credits': ("SELECT * FROM credits", 'date', 'date, id'),
+    'expenses': ("SELECT * FROM expenses", 'date', 'date, id'),
+    'returns': ("SELECT * FROM returns", 'return_date', 'return_date, id'),
+}
+
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def build_query(kind, date_from=None, date_to=None):
+    query, date_col, order = EXPORTS[kind]
+    clauses, params = [], []
+    if date_from:
+        clauses.append(f"{date_col} >= ?")
+        params.append(date_from)
+    if date_to:
+        clauses.append(f"{date_col} <= ?")
+        params.append(date_to + ' 23:59:59')
+    if clauses:
+        query += ' WHERE ' + ' AND '.join(clauses)
+    return f"{query} ORDER BY {order}", params
+
+
+def iter_rows(kind, date_from=None, date_to=None, path=None):
+    """Yield the column names, then every row, batch by batch."""
+    query, params = build_query(kind, date_from, date_to)
+    with connection(path) as conn:
+        cursor = conn.execute(query, params)
+        try:
+            yield [column[0] for column in cursor.description]
+            while True:
+                batch = cursor.fetchmany(BATCH_SIZE)
+                if not batch:
+                    break
+                yield from batch
+        finally:
+            cursor.close()
+
+
+def iter_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def iter_ndjson(rows):
+    columns = next(rows)
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(columns, row))))
+        if len(lines) == BATCH_SIZE:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def iter_gzip(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream_export(kind, fmt='csv', date_from=None, date_to=None, gzip=False, path=None):
+    """Return (byte/str chunk generator, content type, download filename)."""
+    if kind not in EXPORTS:
+        raise ValueError(f"Unknown export '{kind}'")
+    if fmt not in CONTENT_TYPES:
+        raise ValueError(f"Unknown format '{fmt}'")
+
+    rows = iter_rows(kind, date_from, date_to, path)
+    chunks = iter_csv(rows) if fmt == 'csv' else iter_ndjson(rows)
+    filename = f"{kind}.{fmt}"
+    if gzip:
+        return iter_gzip(chunks), 'application/gzip', filename + '.gz'
+    return chunks, CONTENT_TYPES[fmt], filename
@@ -0,0 +1,145 @@
+"""
+Demand forecasting
+
+Per-product daily unit sales for the last WINDOW_DAYS are pulled with one
+grouped query over sale_items into a products x days matrix, and a least
+squares trend line is fitted to every row at once with NumPy -- there is
+no per-product Python loop, so tens of thousands of SKUs take about as
+long as the query that loads them.
+
+Results are cached per worker and reused until sales or stock change (see
+versions.py) and the cached run is at least FORECAST_MIN_AGE seconds old,
+so a busy till does not trigger a refit on every sale.
+"""
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from stores import StoreLocal
+from versions import data_version
+
+WINDOW_DAYS = int(os.environ.get('FORECAST_WINDOW_DAYS', 90))
+HORIZON_DAYS = 7
+FORECAST_MIN_AGE = float(os.environ.get('FORECAST_MIN_AGE', 60))
+
+
+def fit_trend(y):
+    """Least squares line through each row of y (rows = series, columns = days).
+
+    Returns (intercept, slope) arrays, with day 0 at the first column.
+    """
+    x = np.arange(y.shape[1], dtype=np.float64)
+    x_centered = x - x.mean()
+    slope = (y - y.mean(axis=1, keepdims=True)) @ x_centered / (x_centered @ x_centered)
+    intercept = y.mean(axis=1) - slope * x.mean()
+    return intercept, slope
+
+
+def project(intercept, slope, start, days=HORIZON_DAYS):
+    """Sum of the fitted line over days start .. start+days-1, never below zero per day."""
+    x = np.arange(start, start + days, dtype=np.float64)
+    return np.clip(intercept[:, None] + slope[:, None] * x, 0, None).sum(axis=1)
+
+
+def load_daily_matrix(cursor, window=WINDOW_DAYS, today=None):
+    """Return (stock rows, matrix) where matrix[i, d] is units of product i sold on day d."""
+    today = today or datetime.now().date()
+    start = today - timedelta(days=window - 1)
+
+    cursor.execute("SELECT id, product_name, quantity, selling_price FROM stock ORDER BY id")
+    products = cursor.fetchall()
+    ids = np.fromiter((p[0] for p in products), dtype=np.int64, count=len(products))
+
+    cursor.execute('''SELECT stock_id,
+                             CAST(julianday(substr(sale_date, 1, 10)) - julianday(?) AS INTEGER),
+                             SUM(quantity)
+                      FROM sale_items
+                      WHERE sale_date >= ? AND stock_id IS NOT NULL
+                      GROUP BY stock_id, substr(sale_date, 1, 10)''',
+                   (start.isoformat(), start.isoformat()))
+    sales = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, 3)
+
+    matrix = np.zeros((len(products), window), dtype=np.float64)
+    if len(sales) and len(ids):
+        rows = np.searchsorted(ids, sales[:, 0].astype(np.int64))
+        rows = np.minimum(rows, len(ids) - 1)
+        days = sales[:, 1].astype(np.int64)
+        # Drop lines for deleted products or outside the window
+        keep = (ids[rows] == sales[:, 0]) & (days >= 0) & (days < window)
+        matrix[rows[keep], days[keep]] = sales[keep, 2]
+    return products, matrix
+
+
+def forecast_products(cursor, window=WINDOW_DAYS, horizon=HORIZON_DAYS):
+    """Forecast next-`horizon`-day demand for every product.
+
+    Returns a list of dicts sorted by forecast revenue, highest first.
+    """
+    products, matrix = load_daily_matrix(cursor, window)
+    if not products:
+        return []
+    intercept, slope = fit_trend(matrix)
+    forecast_qty = project(intercept, slope, window, horizon)
+    prices = np.fromiter((p[3] for p in products), dtype=np.float64, count=len(products))
+    on_hand = np.fromiter((p[2] for p in products), dtype=np.float64, count=len(products))
+    forecast_revenue = forecast_qty * prices
+    daily_rate = forecast_qty / horizon
+    with np.errstate(divide='ignore'):
+        days_of_cover = np.where(daily_rate > 0, on_hand / daily_rate, np.inf)
+
+    order = np.argsort(-forecast_revenue, kind='stable')
+    avg_daily = matrix.mean(axis=1)
+    return [{
+        'stock_id': products[i][0],
+        'product_name': products[i][1],
+        'quantity': products[i][2],
+        'avg_daily_sales': round(float(avg_daily[i]), 3),
+        'trend_per_day': round(float(slope[i]), 4),
+        'forecast_qty': round(float(forecast_qty[i]), 2),
+        'forecast_revenue': round(float(forecast_revenue[i]), 2),
+        'days_of_cover': None if np.isinf(days_of_cover[i]) else round(float(days_of_cover[i]), 1),
+    } for i in order]
+
+
+def forecast_revenue(cursor, window=WINDOW_DAYS, horizon=HORIZON_DAYS):
+    """Next-`horizon`-day revenue forecast for the whole shop from the daily rollups."""
+    today = datetime.now().date()
+    start = today - timedelta(days=window - 1)
+    cursor.execute('''SELECT CAST(julianday(period) - julianday(?) AS INTEGER), revenue
+                      FROM summary_totals
+                      WHERE granularity = 'day' AND period BETWEEN ? AND ?''',
+                   (start.isoformat(), start.isoformat(), today.isoformat()))
+    daily = np.zeros((1, window), dtype=np.float64)
+    for day, revenue in cursor.fetchall():
+        daily[0, day] = revenue
+    intercept, slope = fit_trend(daily)
+    return round(float(project(intercept, slope, window, horizon)[0]), 2)
+
+
+class ForecastCache:
+    """Keeps the last full forecast per worker, keyed by the sales and stock data versions and day."""
+
+    def __init__(self, min_age=FORECAST_MIN_AGE):
+        self.min_age = min_age
+        self._key = None
+        self._computed_at = 0
+        self._result = None
+        self._lock = threading.Lock()
+
+    def get(self, cursor):
+        key = (data_version(cursor, 'sales'), data_version(cursor, 'stock'), datetime.now().date())
+        with self._lock:
+            fresh = time.monotonic() - self._computed_at < self.min_age
+            if self._result is not None and (key == self._key or (fresh and key[2] == self._key[2])):
+                return self._result
+            self._result = forecast_products(cursor)
+            self._key = key
+            self._computed_at = time.monotonic()
+            return self._result
+
+
+forecasts = StoreLocal(ForecastCache)
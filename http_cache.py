@@ -0,0 +1,57 @@
+"""
+Conditional GET and compression for the polled JSON endpoints
+
+ETags are built from the data_versions counters (see versions.py), so
+answering "has anything changed?" costs one primary-key read and a 304
+carries no body at all.  Tags include the store id, since each store's
+database has its own counters.  Large JSON bodies are gzipped for clients that
+accept it.
+"""
+
+import gzip
+
+from flask import Response, request
+
+from stores import STORE_HEADER, current_store
+from versions import data_version
+
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+
+
+def version_etag(cursor, table, *extra):
+    """ETag value for a response that only depends on `table` (plus any extra key parts).
+
+    Every store has its own counters, so two stores can be at the same
+    version; the store id keeps their tags apart.
+    """
+    return '-'.join(str(part) for part in (current_store(), table, data_version(cursor, table), *extra))
+
+
+def conditional(etag, build):
+    """Return 304 when the client already holds `etag`, otherwise build() tagged with it."""
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = build()
+    # Weak, because the gzipped and plain bodies share the tag
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    # The store is picked by header or cookie (see stores.py), so the body depends on both
+    response.vary.update(('Cookie', STORE_HEADER))
+    return response
+
+
+def gzip_response(response):
+    """after_request hook: compress large, complete JSON bodies."""
+    response.vary.add('Accept-Encoding')
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or response.mimetype != 'application/json' or 'Content-Encoding' in response.headers
+            or 'gzip' not in request.accept_encodings):
+        return response
+    body = response.get_data()
+    if len(body) < GZIP_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(body, GZIP_LEVEL))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
@@ -0,0 +1,168 @@
+"""
+Stock movement journal and FIFO cost layers
+
+Every change to a product's quantity is written to stock_movements, an
+append-only journal (triggers reject UPDATE and DELETE):
+
+  opening     quantity on hand when the journal was introduced
+  receipt     deliveries (add_stock, bulk import)
+  sale        checkout, costed from the oldest layers first
+  return      customer returns, back into stock at the cost booked on their sale
+  adjustment  manual corrections and deleted products
+
+Each inbound movement opens a cost layer (quantity, remaining, unit cost);
+sales consume the oldest open layers, so the cost of every sale line is
+fixed at write time and stored on sale_items.cogs.  Triggers roll that
+cost into summary_totals.cogs alongside revenue -- returns take it back out
+-- so gross margin and net profit for any day, month, year or date range
+read the same rollup rows as revenue (see profit_loss.py), and per-product
+and per-sale margins come from sale_items (a covering index for date ranges).
+
+If the layers and the stock quantity ever disagree (a row edited outside the
+app), the shortfall is costed at the product's purchase_price.  The journal,
+layers and triggers are created by migration 13.
+"""
+
+from datetime import datetime
+
+from summaries import GRANULARITIES, period_key
+
+
+def _now():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _record(cursor, stock_id, kind, quantity, cost, ref_id, note, at):
+    cursor.execute('''INSERT INTO stock_movements
+                      (stock_id, kind, quantity, unit_cost, cost, ref_id, note, created_at)
+                      VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                   (stock_id, kind, quantity, abs(cost / quantity) if quantity else 0, cost, ref_id, note,
+                    at or _now()))
+    return cursor.lastrowid
+
+
+def receive(cursor, stock_id, quantity, unit_cost, kind='receipt', ref_id=None, note=None, at=None):
+    """Journal an inbound movement and open a cost layer for it; returns the movement id."""
+    if quantity <= 0:
+        return None
+    movement_id = _record(cursor, stock_id, kind, quantity, quantity * unit_cost, ref_id, note, at)
+    cursor.execute('''INSERT INTO cost_layers (stock_id, movement_id, quantity, remaining, unit_cost)
+                      VALUES (?, ?, ?, ?, ?)''', (stock_id, movement_id, quantity, quantity, unit_cost))
+    return movement_id
+
+
+def _fallback_cost(cursor, stock_id):
+    cursor.execute("SELECT purchase_price FROM stock WHERE id = ?", (stock_id,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def issue(cursor, stock_id, quantity, kind='sale', ref_id=None, note=None, at=None):
+    """Journal an outbound movement, consuming the oldest cost layers; returns its total cost."""
+    if quantity <= 0:
+        return 0
+    cursor.execute('''SELECT id, remaining, unit_cost FROM cost_layers
+                      WHERE stock_id = ? AND remaining > 0 ORDER BY id''', (stock_id,))
+    cost, left, taken = 0, quantity, []
+    for layer_id, remaining, unit_cost in cursor.fetchall():
+        take = min(remaining, left)
+        cost += take * unit_cost
+        taken.append((take, layer_id))
+        left -= take
+        if not left:
+            break
+    cursor.executemany("UPDATE cost_layers SET remaining = remaining - ? WHERE id = ?", taken)
+    if left:
+        cost += left * _fallback_cost(cursor, stock_id)
+    _record(cursor, stock_id, kind, -quantity, -cost, ref_id, note, at)
+    return cost
+
+
+def adjust(cursor, stock_id, delta, unit_cost, note=None):
+    """Journal a manual quantity correction (positive or negative)."""
+    if delta > 0:
+        receive(cursor, stock_id, delta, unit_cost, 'adjustment', note=note)
+    elif delta < 0:
+        issue(cursor, stock_id, -delta, 'adjustment', note=note)
+
+
+def returned_sale(cursor, stock_id, invoice_no=None, customer_name=None):
+    """Id of the sale a returned product came from, or None.
+
+    The invoice when given, else the customer's latest purchase of the
+    product, else its latest sale.
+    """
+    if invoice_no:
+        cursor.execute('''SELECT s.id FROM sales s JOIN sale_items i ON i.sale_id = s.id
+                          WHERE s.invoice_no = ? AND i.stock_id = ? LIMIT 1''', (invoice_no, stock_id))
+        row = cursor.fetchone()
+        if row is None:
+            raise ValueError(f"Invoice {invoice_no} has no line for this product")
+        return row[0]
+    if customer_name:
+        cursor.execute('''SELECT i.sale_id FROM sale_items i JOIN sales s ON s.id = i.sale_id
+                          WHERE i.stock_id = ? AND s.customer_name = ? COLLATE NOCASE
+                          ORDER BY i.sale_date DESC LIMIT 1''', (stock_id, customer_name))
+        row = cursor.fetchone()
+        if row:
+            return row[0]
+    cursor.execute("SELECT sale_id FROM sale_items WHERE stock_id = ? ORDER BY sale_date DESC LIMIT 1",
+                   (stock_id,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def return_to_stock(cursor, stock_id, quantity, sale_id=None, note=None, at=None):
+    """Journal a customer return at the cost booked on the sale it came from (ref_id is that sale)."""
+    cursor.execute('''SELECT SUM(cogs) / SUM(quantity) FROM sale_items
+                      WHERE sale_id = ? AND stock_id = ? AND cogs IS NOT NULL''', (sale_id, stock_id))
+    unit_cost = cursor.fetchone()[0]
+    if unit_cost is None:
+        unit_cost = _fallback_cost(cursor, stock_id)
+    receive(cursor, stock_id, quantity, unit_cost, 'return', ref_id=sale_id, note=note, at=at)
+
+
+def open_balance(cursor, stock_id, quantity, unit_cost):
+    """Opening layer for stock that predates the journal, minus anything already layered since."""
+    cursor.execute("SELECT 1 FROM stock_movements WHERE stock_id = ? AND kind = 'opening' LIMIT 1", (stock_id,))
+    if cursor.fetchone():
+        return
+    cursor.execute("SELECT COALESCE(SUM(remaining), 0) FROM cost_layers WHERE stock_id = ? AND remaining > 0",
+                   (stock_id,))
+    receive(cursor, stock_id, quantity - cursor.fetchone()[0], unit_cost, 'opening')
+
+
+def rebuild_cogs(cursor):
+    """Recompute summary_totals.cogs from sale_items and return movements (backfill / repair)."""
+    cursor.execute("UPDATE summary_totals SET cogs = 0")
+    for table, col, measure, where in (
+            ('sale_items', 'sale_date', 'SUM(cogs)', 'cogs IS NOT NULL'),
+            ('stock_movements', 'created_at', '-SUM(cost)', "kind = 'return'")):
+        for granularity in GRANULARITIES:
+            period = period_key(granularity, col)
+            cursor.execute(f'''INSERT INTO summary_totals (granularity, period, cogs)
+                               SELECT '{granularity}', {period}, {measure} FROM {table} WHERE {where}
+                               GROUP BY {period} HAVING COUNT(*) > 0
+                               ON CONFLICT(granularity, period) DO UPDATE SET cogs = cogs + excluded.cogs''')
+
+
+def period_cogs(cursor, start, end):
+    """Cost of goods sold between two 'YYYY-MM-DD' days (inclusive), from the day rollups."""
+    cursor.execute('''SELECT COALESCE(SUM(cogs), 0) FROM summary_totals
+                      WHERE granularity = 'day' AND period BETWEEN ? AND ?''', (start, end))
+    return cursor.fetchone()[0]
+
+
+def total_cogs(cursor, granularity='all', period='all'):
+    cursor.execute("SELECT cogs FROM summary_totals WHERE granularity = ? AND period = ?", (granularity, period))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def movements(cursor, stock_id, before=None, limit=100):
+    """A product's journal, newest first, keyset-paged by movement id."""
+    cursor.execute('''SELECT id, kind, quantity, unit_cost, cost, ref_id, note, created_at
+                      FROM stock_movements WHERE stock_id = ? AND id < ? ORDER BY id DESC LIMIT ?''',
+                   (stock_id, before or 2 ** 63 - 1, limit))
+    columns = [c[0] for c in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
@@ -0,0 +1,144 @@
+"""
+Customer and supplier balances
+
+credits is the journal: every credit sale, supplier purchase and payment
+is one row, signed so that a positive amount increases what the party owes
+(for a customer) or what we owe (for a supplier).  A trigger on credits keeps
+parties.balance current and stamps each entry with its party_id and the
+running balance after it, in the same transaction as the sale, stock
+purchase or payment that wrote it.  Running balances follow (date, id), the
+order statements list entries in: an entry dated before existing ones (a
+till sale synced late) also moves the balances of the entries after it.  So
+"how much does X owe" is one read of parties by its (type, name) index, and
+a statement is a range scan on credits(party_id, date).  The schema and
+trigger are created by migrations 11 and 15.
+
+Aging assumes payments clear the oldest charges first: the outstanding
+balance is made up of the newest charges, so only those are read.
+"""
+
+from datetime import datetime
+
+from database import write_transaction
+
+PARTY_TYPES = ('customer', 'supplier')
+
+# (label, minimum age in days) -- each bucket runs up to the next one's minimum
+AGING_BUCKETS = (('current', 0), ('31-60', 31), ('61-90', 61), ('90+', 91))
+
+
+def rebuild_ledger(cursor):
+    """Recompute party balances and every entry's running balance from credits (backfill / repair)."""
+    cursor.execute("UPDATE parties SET balance = 0")
+    cursor.execute('''INSERT INTO parties (type, name, balance, last_activity, created_at)
+                      SELECT type, MIN(name), SUM(amount), MAX(date), MIN(date) FROM credits WHERE true
+                      GROUP BY type, name COLLATE NOCASE
+                      ON CONFLICT(type, name COLLATE NOCASE) DO UPDATE SET
+                          balance = excluded.balance, last_activity = excluded.last_activity''')
+    cursor.execute('''UPDATE credits SET party_id = (SELECT id FROM parties p
+                                                     WHERE p.type = credits.type
+                                                     AND p.name = credits.name COLLATE NOCASE)''')
+    cursor.execute('''SELECT SUM(amount) OVER (PARTITION BY party_id ORDER BY date, id), id
+                      FROM credits''')
+    cursor.executemany("UPDATE credits SET balance = ? WHERE id = ?", cursor.fetchall())
+
+
+def ensure_party(cursor, party_type, name, phone=None):
+    """Register a customer or supplier (keeping the first spelling of its name); returns its id."""
+    cursor.execute("SELECT id, phone FROM parties WHERE type = ? AND name = ? COLLATE NOCASE", (party_type, name))
+    row = cursor.fetchone()
+    # Most sales are by known customers: skip the write when nothing changed
+    if row and (not phone or phone == row[1]):
+        return row[0]
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    cursor.execute('''INSERT INTO parties (type, name, phone, created_at) VALUES (?, ?, ?, ?)
+                      ON CONFLICT(type, name COLLATE NOCASE) DO UPDATE SET
+                          phone = COALESCE(excluded.phone, phone)''',
+                   (party_type, name, phone or None, now))
+    cursor.execute("SELECT id FROM parties WHERE type = ? AND name = ? COLLATE NOCASE", (party_type, name))
+    return cursor.fetchone()[0]
+
+
+def get_party(cursor, party_type, name):
+    """(id, type, name, phone, balance, last_activity) or None -- one index lookup."""
+    cursor.execute('''SELECT id, type, name, phone, balance, last_activity FROM parties
+                      WHERE type = ? AND name = ? COLLATE NOCASE''', (party_type, name))
+    return cursor.fetchone()
+
+
+def record_payment(conn, party_type, name, amount, description=None, date=None):
+    """Record money received from a customer or paid to a supplier.
+
+    Returns the party's new balance; raises ValueError for a bad amount or an
+    unknown party.
+    """
+    if party_type not in PARTY_TYPES:
+        raise ValueError(f"Unknown party type: {party_type}")
+    amount = float(amount)
+    if amount <= 0:
+        raise ValueError("Payment amount must be positive")
+    kind = 'payment' if party_type == 'customer' else 'settlement'
+    date = date or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with write_transaction(conn):
+        cursor = conn.cursor()
+        party = get_party(cursor, party_type, name)
+        if not party:
+            raise ValueError(f"Unknown {party_type}: {name}")
+        cursor.execute('''INSERT INTO credits (type, name, amount, description, date, kind)
+                          VALUES (?, ?, ?, ?, ?, ?)''',
+                       (party_type, party[2], -amount, description or kind.capitalize(), date, kind))
+        cursor.execute("SELECT balance FROM parties WHERE id = ?", (party[0],))
+        return cursor.fetchone()[0]
+
+
+def statement(cursor, party_id, date_from=None, date_to=None):
+    """Opening balance and entries for one party over [date_from, date_to].
+
+    Entries are dicts with their running balance; returns (opening, entries).
+    """
+    date_from = date_from or '0000-00-00'
+    date_to = (date_to or '9999-99-99') + ' 99'
+    cursor.execute('''SELECT balance FROM credits WHERE party_id = ? AND date < ?
+                      ORDER BY date DESC, id DESC LIMIT 1''', (party_id, date_from))
+    row = cursor.fetchone()
+    opening = row[0] if row else 0
+    cursor.execute('''SELECT id, date, kind, description, amount, balance FROM credits
+                      WHERE party_id = ? AND date BETWEEN ? AND ? ORDER BY date, id''',
+                   (party_id, date_from, date_to))
+    columns = [c[0] for c in cursor.description]
+    return opening, [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def party_aging(cursor, party_id, balance, today=None):
+    """Split an outstanding balance into AGING_BUCKETS by the age of the charges that make it up."""
+    today = today or datetime.now()
+    buckets = {label: 0 for label, _ in AGING_BUCKETS}
+    remaining = balance
+    cursor.execute('''SELECT date, amount FROM credits WHERE party_id = ? AND amount > 0
+                      ORDER BY date DESC, id DESC''', (party_id,))
+    while remaining > 0.005:
+        row = cursor.fetchone()
+        if row is None:
+            # Older than the journal (e.g. opening balances): count it as the oldest
+            buckets[AGING_BUCKETS[-1][0]] += remaining
+            break
+        part = min(row[1], remaining)
+        age = (today - datetime.strptime(row[0][:10], "%Y-%m-%d")).days
+        label = [label for label, minimum in AGING_BUCKETS if age >= minimum][-1]
+        buckets[label] += part
+        remaining -= part
+    return {label: round(amount, 2) for label, amount in buckets.items()}
+
+
+def aging_report(cursor, party_type, limit=500):
+    """Aging buckets for every party of a type with a positive balance, largest balance first."""
+    cursor.execute('''SELECT id, name, balance FROM parties WHERE type = ? AND balance > 0
+                      ORDER BY balance DESC LIMIT ?''', (party_type, limit))
+    parties = cursor.fetchall()
+    report, totals = [], {label: 0 for label, _ in AGING_BUCKETS}
+    for party_id, name, balance in parties:
+        buckets = party_aging(cursor.connection.cursor(), party_id, balance)
+        for label, amount in buckets.items():
+            totals[label] += amount
+        report.append({'party_id': party_id, 'name': name, 'balance': round(balance, 2), 'aging': buckets})
+    return report, {label: round(amount, 2) for label, amount in totals.items()}
@@ -0,0 +1,390 @@
+"""
+Request and SQL instrumentation
+
+Every request is timed into a per-route latency histogram, and every SQL
+statement run through a pooled connection is timed by TimedConnection /
+TimedCursor: execute() plus any fetches on the same cursor count towards
+the statement, grouped by its normalized text.  A progress handler counts
+SQLite VM steps per statement as a proxy for rows scanned.  Statements
+slower than SLOW_QUERY_MS are logged to the 'slow_query' logger together with
+their EXPLAIN QUERY PLAN.  Transaction control (BEGIN, COMMIT, SAVEPOINT, ...)
+is never logged as slow: the time BEGIN IMMEDIATE spends waiting for the
+write lock goes into its own histogram instead.  Routes that swallow an
+exception into {'success': False, 'error': ...} are counted and logged as
+application errors.
+
+Everything is exposed in Prometheus text format by render_metrics() (the
+/metrics route).  Counters are per worker process, like the caches; each
+gunicorn worker reports its own, labelled with its pid.
+
+Setting PROFILING_ENABLED=1 lets a request ask for ?profile=1, which runs
+it under cProfile and returns the profile and its SQL statements as plain
+text instead of the normal response.
+"""
+
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from functools import lru_cache
+
+from flask import Response, g, has_request_context, request
+
+SQL_TIMING = os.environ.get('SQL_TIMING', '1') == '1'
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+PROGRESS_STEPS = int(os.environ.get('SQL_PROGRESS_STEPS', 1000))
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED') == '1'
+MAX_STATEMENTS = 500
+SLOW_LOG_SIZE = 100
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_TRANSACTION_CONTROL = ('BEGIN', 'COMMIT', 'END', 'ROLLBACK', 'SAVEPOINT', 'RELEASE')
+# These wait for the database write lock before they return
+_LOCKING_BEGINS = ('BEGIN IMMEDIATE', 'BEGIN EXCLUSIVE')
+
+slow_log = logging.getLogger('slow_query')
+error_log = logging.getLogger('app_errors')
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus style."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.total += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        running = 0
+        for bound, count in zip(self.buckets, self.counts):
+            running += count
+            yield f'{name}_bucket{_labels(labels, le=bound)} {running}'
+        yield f'{name}_bucket{_labels(labels, le="+Inf")} {self.count}'
+        yield f'{name}_sum{_labels(labels)} {self.total}'
+        yield f'{name}_count{_labels(labels)} {self.count}'
+
+
+class Registry:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}    # (endpoint, method) -> Histogram
+        self.responses = {}   # (endpoint, method, status) -> count
+        self.app_errors = {}  # endpoint -> count
+        self.statements = {}  # statement -> [calls, seconds, vm steps, slow]
+        self.sql_latency = Histogram()
+        self.lock_wait = Histogram()
+        self.slow_queries = deque(maxlen=SLOW_LOG_SIZE)
+
+    def observe_request(self, endpoint, method, status, seconds):
+        with self._lock:
+            histogram = self.requests.get((endpoint, method))
+            if histogram is None:
+                histogram = self.requests[(endpoint, method)] = Histogram()
+            histogram.observe(seconds)
+            key = (endpoint, method, status)
+            self.responses[key] = self.responses.get(key, 0) + 1
+
+    def observe_app_error(self, endpoint):
+        with self._lock:
+            self.app_errors[endpoint] = self.app_errors.get(endpoint, 0) + 1
+
+    def observe_statement(self, statement, seconds, steps, calls=0, slow=False, latency=None):
+        with self._lock:
+            entry = self.statements.get(statement)
+            if entry is None:
+                if len(self.statements) >= MAX_STATEMENTS:
+                    statement = 'other'
+                entry = self.statements.setdefault(statement, [0, 0.0, 0, 0])
+            entry[0] += calls
+            entry[1] += seconds
+            entry[2] += steps
+            entry[3] += slow
+            if latency is not None:
+                self.sql_latency.observe(latency)
+
+    def observe_lock_wait(self, seconds):
+        with self._lock:
+            self.lock_wait.observe(seconds)
+
+    def reset(self):
+        with self._lock:
+            self.__init__()
+
+
+registry = Registry()
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(labels, **extra):
+    labels = {'pid': os.getpid(), **labels, **extra}
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+@lru_cache(maxsize=4096)
+def normalize(sql):
+    """Collapse whitespace and IN (?, ?, ...) lists so one statement is one label."""
+    sql = ' '.join(sql.split())
+    sql = re.sub(r'\?(?:\s*,\s*\?)+', '?, ...', sql)
+    return sql[:200]
+
+
+@lru_cache(maxsize=256)
+def transaction_control(statement):
+    """The keywords of a transaction control statement (e.g. 'BEGIN IMMEDIATE'), else None."""
+    words = statement.upper().split()[:2]
+    if not words or words[0] not in _TRANSACTION_CONTROL:
+        return None
+    return ' '.join(words)
+
+
+def _note_request_sql(statement, seconds, calls):
+    if has_request_context():
+        g.sql_seconds = g.get('sql_seconds', 0) + seconds
+        g.sql_count = g.get('sql_count', 0) + calls
+        if 'sql_trace' in g:
+            entry = g.sql_trace.setdefault(statement, [0, 0.0])
+            entry[0] += calls
+            entry[1] += seconds
+
+
+def _log_slow(conn, sql, params, seconds, steps):
+    plan = []
+    if sql.lstrip()[:6].upper() in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH ', 'REPLAC'):
+        try:
+            # Plain sqlite3 cursor, so the plan lookup is not timed itself
+            plan = [row[3] for row in sqlite3.Connection.execute(conn, f"EXPLAIN QUERY PLAN {sql}", params)]
+        except sqlite3.Error as e:
+            plan = [f"(no plan: {e})"]
+    entry = {'statement': normalize(sql), 'ms': round(seconds * 1000, 2), 'vm_steps': steps,
+             'plan': plan, 'at': time.strftime("%Y-%m-%d %H:%M:%S")}
+    registry.slow_queries.append(entry)
+    slow_log.warning("Slow query (%.1f ms, ~%d VM steps): %s | plan: %s",
+                     entry['ms'], steps, entry['statement'], '; '.join(plan))
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that charges execute() and fetch time to the statement it is running."""
+
+    _sql = None
+    _params = ()
+    _spent = 0.0
+    _steps = 0
+    _slow_logged = False
+
+    def _start(self, sql, params):
+        self._finish()
+        self._sql, self._params = sql, params
+        self._spent, self._steps, self._slow_logged = 0.0, 0, False
+
+    def _charge(self, started, steps_before, calls=0):
+        if self._sql is None:
+            return
+        seconds = time.perf_counter() - started
+        steps = (self.connection.vm_steps - steps_before) * PROGRESS_STEPS
+        self._spent += seconds
+        self._steps += steps
+        statement = normalize(self._sql)
+        control = transaction_control(statement)
+        slow = not control and not self._slow_logged and self._spent * 1000 >= SLOW_QUERY_MS
+        if control in _LOCKING_BEGINS and calls:
+            registry.observe_lock_wait(seconds)
+        registry.observe_statement(statement, seconds, steps, calls, slow)
+        _note_request_sql(statement, seconds, calls)
+        if slow:
+            self._slow_logged = True
+            _log_slow(self.connection, self._sql, self._params, self._spent, self._steps)
+
+    def _finish(self):
+        # Total time of the previous statement on this cursor goes into the histogram
+        if self._sql is not None:
+            registry.observe_statement(normalize(self._sql), 0, 0, latency=self._spent)
+            self._sql = None
+
+    def _timed(self, method, *args):
+        started, steps = time.perf_counter(), self.connection.vm_steps
+        try:
+            return method(*args)
+        finally:
+            self._charge(started, steps)
+
+    def execute(self, sql, params=()):
+        self._start(sql, params)
+        started, steps = time.perf_counter(), self.connection.vm_steps
+        try:
+            return super().execute(sql, params)
+        finally:
+            self._charge(started, steps, calls=1)
+
+    def executemany(self, sql, seq_of_params):
+        # The first parameter set is enough for EXPLAIN QUERY PLAN
+        self._start(sql, seq_of_params[0] if isinstance(seq_of_params, (list, tuple)) and seq_of_params else ())
+        started, steps = time.perf_counter(), self.connection.vm_steps
+        try:
+            return super().executemany(sql, seq_of_params)
+        finally:
+            self._charge(started, steps, calls=1)
+
+    def fetchone(self):
+        return self._timed(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._timed(super().fetchmany, size or self.arraysize)
+
+    def fetchall(self):
+        rows = self._timed(super().fetchall)
+        self._finish()
+        return rows
+
+    def close(self):
+        self._finish()
+        super().close()
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose cursors (including the execute() shortcuts) are TimedCursors."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.vm_steps = 0
+        self.set_progress_handler(self._progress, PROGRESS_STEPS)
+
+    def _progress(self):
+        self.vm_steps += 1
+        return 0
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+
+def connection_factory():
+    """Factory for sqlite3.connect(): timed connections unless SQL_TIMING=0."""
+    return TimedConnection if SQL_TIMING else sqlite3.Connection
+
+
+def start_request():
+    """before_request hook: start the clock (and the profiler when asked for)."""
+    g.request_started = time.perf_counter()
+    if PROFILING_ENABLED and request.args.get('profile') == '1':
+        g.sql_trace = {}
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+def _swallowed_error(response):
+    # Routes report failures as 200 {'success': False, 'error': ...}; only small bodies are checked
+    if response.mimetype != 'application/json' or response.is_streamed or response.direct_passthrough:
+        return None
+    if (response.content_length or 0) > 4096 or 'Content-Encoding' in response.headers:
+        return None
+    try:
+        body = json.loads(response.get_data())
+    except ValueError:
+        return None
+    if isinstance(body, dict) and body.get('success') is False:
+        return body.get('error') or body.get('errors')
+    return None
+
+
+def finish_request(response):
+    """after_request hook: record latency, SQL totals and swallowed errors."""
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+    seconds = time.perf_counter() - started
+    endpoint = request.endpoint or 'unmatched'
+    registry.observe_request(endpoint, request.method, response.status_code, seconds)
+
+    error = _swallowed_error(response)
+    if error is not None:
+        registry.observe_app_error(endpoint)
+        error_log.warning("%s %s failed: %s", request.method, request.path, error)
+
+    sql_seconds = g.get('sql_seconds', 0)
+    response.headers['Server-Timing'] = (f"app;dur={seconds * 1000:.2f}, "
+                                         f"db;dur={sql_seconds * 1000:.2f};desc=\"{g.get('sql_count', 0)} queries\"")
+
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        return _profile_response(profiler, seconds, g.pop('sql_trace', {}))
+    return response
+
+
+def _profile_response(profiler, seconds, sql_trace):
+    out = io.StringIO()
+    calls = sum(entry[0] for entry in sql_trace.values())
+    spent = sum(entry[1] for entry in sql_trace.values())
+    out.write(f"{request.method} {request.full_path}: {seconds * 1000:.2f} ms, "
+              f"{calls} SQL statements, {spent * 1000:.2f} ms in SQL\n\n")
+    for statement, (count, total) in sorted(sql_trace.items(), key=lambda item: -item[1][1])[:50]:
+        out.write(f"{total * 1000:9.3f} ms {count:5d}x  {statement}\n")
+    out.write("\n")
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(40)
+    return Response(out.getvalue(), mimetype='text/plain')
+
+
+def render_metrics():
+    """All counters in the Prometheus text exposition format."""
+    lines = []
+    with registry._lock:
+        lines += ['# HELP http_request_duration_seconds Request latency by route.',
+                  '# TYPE http_request_duration_seconds histogram']
+        for (endpoint, method), histogram in sorted(registry.requests.items()):
+            lines += histogram.lines('http_request_duration_seconds', {'endpoint': endpoint, 'method': method})
+
+        lines += ['# HELP http_responses_total Responses by route and status code.',
+                  '# TYPE http_responses_total counter']
+        lines += [f'http_responses_total{_labels({"endpoint": e, "method": m, "status": s})} {count}'
+                  for (e, m, s), count in sorted(registry.responses.items())]
+
+        lines += ['# HELP app_errors_total Requests that returned success: false.',
+                  '# TYPE app_errors_total counter']
+        lines += [f'app_errors_total{_labels({"endpoint": e})} {count}'
+                  for e, count in sorted(registry.app_errors.items())]
+
+        lines += ['# HELP sqlite_query_duration_seconds Time per SQL statement, execute plus fetches.',
+                  '# TYPE sqlite_query_duration_seconds histogram']
+        lines += registry.sql_latency.lines('sqlite_query_duration_seconds', {})
+
+        lines += ['# HELP sqlite_lock_wait_seconds Time BEGIN IMMEDIATE waited for the write lock.',
+                  '# TYPE sqlite_lock_wait_seconds histogram']
+        lines += registry.lock_wait.lines('sqlite_lock_wait_seconds', {})
+
+        statements = sorted(registry.statements.items())
+        for metric, index, kind, help_text in (
+                ('sqlite_statement_calls_total', 0, 'counter', 'Executions per statement.'),
+                ('sqlite_statement_seconds_total', 1, 'counter', 'Time spent per statement.'),
+                ('sqlite_statement_vm_steps_total', 2, 'counter',
+                 f'Approximate SQLite VM steps per statement (rows scanned proxy, granularity {PROGRESS_STEPS}).'),
+                ('sqlite_slow_queries_total', 3, 'counter', f'Executions slower than {SLOW_QUERY_MS:g} ms.')):
+            lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} {kind}']
+            lines += [f'{metric}{_labels({"statement": statement})} {entry[index]}'
+                      for statement, entry in statements]
+    return '\n'.join(lines) + '\n'
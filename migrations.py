@@ -0,0 +1,869 @@
+"""
+Versioned schema migrations
+
+Each migration is a numbered function registered with @migration.  The
+schema_version table records which ones a database has had applied, and
+migrate() runs the missing ones in order -- at startup through init_db()
+or with `flask migrate` -- so an existing production database evolves
+in place instead of being hand-edited.
+
+Migrations are written to be safe against a live app:
+
+  * schema changes run in short write transactions (BEGIN IMMEDIATE);
+  * backfills go through backfill(), which walks the table by key in chunks
+    of BACKFILL_CHUNK rows, committing and pausing between chunks so
+    requests can take the write lock in between;
+  * every step is idempotent (IF NOT EXISTS, "only if new" guards,
+    backfills that skip rows already done), so a migration interrupted
+    part-way simply runs again.  Its version is recorded only once it has
+    finished.
+
+Workers starting together serialize on a lock file next to the database,
+so only one of them applies the migrations.
+
+Each migration carries the exact DDL and backfill SQL it runs instead of
+calling into the app modules, so a numbered migration does the same thing
+whatever later commits do to those modules.  To change the schema, append
+a new @migration with the next version number; never edit one that has
+already shipped (or a helper below that one calls).
+"""
+
+import json
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from database import DB_PATH, write_transaction
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process lock, run migrations from one process
+    fcntl = None
+
+BACKFILL_CHUNK = int(os.environ.get('MIGRATION_BACKFILL_CHUNK', 1000))
+BACKFILL_PAUSE = float(os.environ.get('MIGRATION_BACKFILL_PAUSE', 0.01))
+
+MIGRATIONS = []
+
+
+def migration(version, name):
+    """Register fn(conn) as migration `version`."""
+    def register(fn):
+        MIGRATIONS.append((version, name, fn))
+        return fn
+    return register
+
+
+def backfill(conn, select_sql, apply, chunk_size=None, start=0):
+    """Process rows in key order, one committed chunk at a time.
+
+    select_sql takes (last_key, limit) and returns rows whose first column is
+    the key, in ascending order; apply(cursor, rows) writes one chunk.
+    Returns the number of rows processed.
+    """
+    chunk_size = chunk_size or BACKFILL_CHUNK
+    last, done = start, 0
+    while True:
+        with write_transaction(conn):
+            rows = conn.execute(select_sql, (last, chunk_size)).fetchall()
+            if rows:
+                apply(conn.cursor(), rows)
+        if not rows:
+            return done
+        last, done = rows[-1][0], done + len(rows)
+        time.sleep(BACKFILL_PAUSE)
+
+
+def _index_exists(cursor, name):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (name,))
+    return cursor.fetchone() is not None
+
+
+def _add_columns(cursor, table, columns):
+    """Add the (name, definition) columns a table lacks; returns True if any were new."""
+    cursor.execute(f"PRAGMA table_info({table})")
+    existing = {row[1] for row in cursor.fetchall()}
+    for name, definition in columns:
+        if name not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+    return any(name not in existing for name, _ in columns)
+
+
+# Rollup helpers shared by migrations 9 and 13: their output is part of those
+# migrations, so it must never change
+
+# (granularity, SQL expression turning a 'YYYY-MM-DD HH:MM:SS' column into its period key)
+_PERIODS = (
+    ('day', "substr({col}, 1, 10)"),
+    ('month', "substr({col}, 1, 7)"),
+    ('year', "substr({col}, 1, 4)"),
+    ('all', "'all'"),
+)
+
+
+def _rollup_trigger(name, table, col, columns, measures, when=None):
+    """AFTER INSERT trigger adding `measures` into `columns` of every period of NEW.<col>."""
+    updates = ', '.join(f"{c} = {c} + excluded.{c}" for c in columns)
+    values = ',\n            '.join(f"('{granularity}', {period.format(col='NEW.' + col)}, {measures})"
+                                   for granularity, period in _PERIODS)
+    return f'''CREATE TRIGGER IF NOT EXISTS {name} AFTER INSERT ON {table}
+        {f'WHEN {when}' if when else ''}
+        BEGIN
+            INSERT INTO summary_totals (granularity, period, {', '.join(columns)}) VALUES
+            {values}
+            ON CONFLICT(granularity, period) DO UPDATE SET {updates};
+        END'''
+
+
+def _rollup_backfill(cursor, table, col, columns, measures, where='true'):
+    """Add the grouped `measures` of existing rows into every period's `columns`."""
+    updates = ', '.join(f"{c} = {c} + excluded.{c}" for c in columns)
+    for granularity, period in _PERIODS:
+        period = period.format(col=col)
+        cursor.execute(f'''INSERT INTO summary_totals (granularity, period, {', '.join(columns)})
+                           SELECT '{granularity}', {period}, {measures} FROM {table} WHERE {where}
+                           GROUP BY {period} HAVING COUNT(*) > 0
+                           ON CONFLICT(granularity, period) DO UPDATE SET {updates}''')
+
+
+@migration(1, 'base tables')
+def _base_tables(conn):
+    with write_transaction(conn):
+        conn.execute('''CREATE TABLE IF NOT EXISTS stock (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_name TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            sold_quantity INTEGER DEFAULT 0,
+            purchase_price REAL NOT NULL,
+            selling_price REAL NOT NULL,
+            supplier TEXT,
+            date_added TEXT NOT NULL
+        )''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS sales (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            invoice_no TEXT NOT NULL,
+            customer_name TEXT,
+            customer_phone TEXT,
+            items TEXT NOT NULL,
+            total_amount REAL NOT NULL,
+            payment_type TEXT NOT NULL,
+            sale_date TEXT NOT NULL
+        )''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS credits (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            type TEXT NOT NULL,
+            name TEXT NOT NULL,
+            amount REAL NOT NULL,
+            description TEXT,
+            date TEXT NOT NULL
+        )''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS expenses (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            category TEXT NOT NULL,
+            amount REAL NOT NULL,
+            description TEXT,
+            date TEXT NOT NULL
+        )''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS returns (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_name TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            reason TEXT,
+            customer_name TEXT,
+            return_date TEXT NOT NULL
+        )''')
+
+
+def _merge_duplicate_products(cursor):
+    # Older databases allowed the same product twice; fold duplicates into the oldest row
+    cursor.execute("""SELECT GROUP_CONCAT(id) FROM stock
+                      GROUP BY product_name COLLATE NOCASE HAVING COUNT(*) > 1""")
+    for (ids,) in cursor.fetchall():
+        ids = sorted(int(i) for i in ids.split(','))
+        keep, duplicates = ids[0], ids[1:]
+        marks = ','.join('?' * len(duplicates))
+        cursor.execute(f"""UPDATE stock SET
+                           quantity = (SELECT SUM(quantity) FROM stock WHERE id IN ({marks}, ?)),
+                           sold_quantity = (SELECT SUM(sold_quantity) FROM stock WHERE id IN ({marks}, ?))
+                           WHERE id = ?""", (*duplicates, keep, *duplicates, keep, keep))
+        cursor.execute(f"UPDATE sale_items SET stock_id = ? WHERE stock_id IN ({marks})", (keep, *duplicates))
+        cursor.execute(f"DELETE FROM stock WHERE id IN ({marks})", duplicates)
+
+
+@migration(2, 'normalized sale items')
+def _sale_items(conn):
+    # Normalized invoice lines (replaces the JSON blob in sales.items)
+    with write_transaction(conn):
+        conn.execute('''CREATE TABLE IF NOT EXISTS sale_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sale_id INTEGER NOT NULL REFERENCES sales(id),
+            stock_id INTEGER REFERENCES stock(id),
+            product_name TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            unit_price REAL NOT NULL,
+            unit_cost REAL,
+            total REAL NOT NULL,
+            sale_date TEXT NOT NULL
+        )''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sale_items_sale ON sale_items(sale_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sale_items_stock_date ON sale_items(stock_id, sale_date)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sale_items_date ON sale_items(sale_date)")
+
+
+@migration(3, 'unique case-insensitive product names')
+def _unique_product_names(conn):
+    # Case-insensitive unique product key used by every POS lookup
+    with write_transaction(conn):
+        cursor = conn.cursor()
+        if not _index_exists(cursor, 'idx_stock_product_name'):
+            _merge_duplicate_products(cursor)
+            cursor.execute("CREATE UNIQUE INDEX idx_stock_product_name ON stock(product_name COLLATE NOCASE)")
+
+
+@migration(4, 'listing and dashboard indexes')
+def _indexes(conn):
+    with write_transaction(conn):
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sales_sale_date ON sales(sale_date)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_expenses_date ON expenses(date)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_stock_quantity ON stock(quantity)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_stock_sold_quantity ON stock(sold_quantity)")
+        # Keyset pagination: the sort order and filters of each listing (see pagination.py)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sales_customer_date ON sales(customer_name COLLATE NOCASE, sale_date)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_credits_date ON credits(date)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_credits_name_date ON credits(name COLLATE NOCASE, date)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_expenses_category_date ON expenses(category, date)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_returns_date ON returns(return_date)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_returns_customer_date "
+                     "ON returns(customer_name COLLATE NOCASE, return_date)")
+
+
+@migration(5, 'receipt outbox')
+def _receipt_outbox(conn):
+    with write_transaction(conn):
+        conn.execute('''CREATE TABLE IF NOT EXISTS receipt_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sale_id INTEGER NOT NULL REFERENCES sales(id),
+            phone TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TEXT NOT NULL,
+            claimed_at TEXT,
+            last_error TEXT,
+            created_at TEXT NOT NULL,
+            sent_at TEXT
+        )''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_receipt_outbox_due ON receipt_outbox(status, next_attempt_at)")
+
+
+@migration(6, 'data versions')
+def _data_versions(conn):
+    # One counter per table, bumped by any write to it (see versions.py)
+    with write_transaction(conn):
+        conn.execute('''CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID''')
+        for table in ('stock', 'sales', 'expenses', 'returns', 'credits'):
+            conn.execute("INSERT OR IGNORE INTO data_versions (name, version) VALUES (?, 0)", (table,))
+            for event in ('INSERT', 'UPDATE', 'DELETE'):
+                conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_version_{event.lower()} AFTER {event} ON {table}
+            BEGIN
+                UPDATE data_versions SET version = version + 1 WHERE name = '{table}';
+            END''')
+
+
+@migration(7, 'backfill legacy invoice lines')
+def _backfill_sale_items(conn):
+    # Legacy sales whose lines only live in the sales.items JSON blob; runs after
+    # the unique product index so each line resolves by index
+    def apply(cursor, rows):
+        for sale_id, items, sale_date in rows:
+            cursor.execute("SELECT 1 FROM sale_items WHERE sale_id = ? LIMIT 1", (sale_id,))
+            if cursor.fetchone():
+                continue
+            try:
+                items = json.loads(items)
+            except ValueError:
+                continue
+            lines = []
+            for item in items:
+                name = item.get('product_name') or item.get('name')
+                if item.get('stock_id'):
+                    cursor.execute("SELECT id, purchase_price FROM stock WHERE id = ?", (item['stock_id'],))
+                else:
+                    cursor.execute("SELECT id, purchase_price FROM stock WHERE product_name = ? COLLATE NOCASE",
+                                   (name,))
+                # Unknown products are still recorded, just without a stock_id / cost
+                stock_id, unit_cost = cursor.fetchone() or (None, None)
+                quantity = item['quantity']
+                price = item.get('price')
+                total = item.get('total', (price or 0) * quantity)
+                if price is None:
+                    price = total / quantity if quantity else 0
+                lines.append((sale_id, stock_id, name, quantity, price, unit_cost, total, sale_date))
+            cursor.executemany('''INSERT INTO sale_items
+                                  (sale_id, stock_id, product_name, quantity, unit_price, unit_cost, total, sale_date)
+                                  VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', lines)
+
+    backfill(conn, "SELECT id, items, sale_date FROM sales WHERE id > ? AND items != '[]' ORDER BY id LIMIT ?",
+             apply)
+
+
+def _dedupe_invoice_numbers(cursor):
+    # Timestamp-based numbers could collide; suffix the later copies (-2, -3, ...)
+    cursor.execute('''SELECT id, invoice_no FROM sales WHERE invoice_no IN
+                      (SELECT invoice_no FROM sales GROUP BY invoice_no HAVING COUNT(*) > 1)
+                      ORDER BY invoice_no, id''')
+    seen = {}
+    for sale_id, invoice_no in cursor.fetchall():
+        seen[invoice_no] = seen.get(invoice_no, 0) + 1
+        if seen[invoice_no] > 1:
+            cursor.execute("UPDATE sales SET invoice_no = ? WHERE id = ?",
+                           (f"{invoice_no}-{seen[invoice_no]}", sale_id))
+
+
+@migration(8, 'invoice number sequence')
+def _invoice_numbers(conn):
+    # Per-day invoice sequence and a unique invoice_no for O(log n) lookups
+    with write_transaction(conn):
+        cursor = conn.cursor()
+        cursor.execute('''CREATE TABLE IF NOT EXISTS invoice_counters (
+            day TEXT PRIMARY KEY,
+            last_no INTEGER NOT NULL
+        )''')
+        if not _index_exists(cursor, 'idx_sales_invoice_no'):
+            _dedupe_invoice_numbers(cursor)
+            cursor.execute("CREATE UNIQUE INDEX idx_sales_invoice_no ON sales(invoice_no)")
+
+
+@migration(9, 'dashboard rollups')
+def _summaries(conn):
+    # Kept current by triggers (see summaries.py); backfilled the first time they appear
+    with write_transaction(conn):
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'summary_totals'")
+        created = cursor.fetchone() is None
+        cursor.execute('''CREATE TABLE IF NOT EXISTS summary_totals (
+            granularity TEXT NOT NULL,
+            period TEXT NOT NULL,
+            revenue REAL NOT NULL DEFAULT 0,
+            sales_count INTEGER NOT NULL DEFAULT 0,
+            expenses REAL NOT NULL DEFAULT 0,
+            returns_qty INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (granularity, period)
+        ) WITHOUT ROWID''')
+        cursor.execute('''CREATE TABLE IF NOT EXISTS stock_totals (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            products INTEGER NOT NULL DEFAULT 0,
+            quantity INTEGER NOT NULL DEFAULT 0,
+            value REAL NOT NULL DEFAULT 0
+        )''')
+        cursor.execute(_rollup_trigger('trg_sales_summary', 'sales', 'sale_date',
+                                       ('revenue', 'sales_count'), 'NEW.total_amount, 1'))
+        cursor.execute(_rollup_trigger('trg_expenses_summary', 'expenses', 'date',
+                                       ('expenses',), 'NEW.amount'))
+        cursor.execute(_rollup_trigger('trg_returns_summary', 'returns', 'return_date',
+                                       ('returns_qty',), 'NEW.quantity'))
+        cursor.execute('''CREATE TRIGGER IF NOT EXISTS trg_stock_totals_insert AFTER INSERT ON stock
+        BEGIN
+            UPDATE stock_totals SET products = products + 1,
+                quantity = quantity + NEW.quantity,
+                value = value + NEW.quantity * NEW.purchase_price
+            WHERE id = 1;
+        END''')
+        cursor.execute('''CREATE TRIGGER IF NOT EXISTS trg_stock_totals_update
+        AFTER UPDATE OF quantity, purchase_price ON stock
+        BEGIN
+            UPDATE stock_totals SET
+                quantity = quantity + NEW.quantity - OLD.quantity,
+                value = value + NEW.quantity * NEW.purchase_price - OLD.quantity * OLD.purchase_price
+            WHERE id = 1;
+        END''')
+        cursor.execute('''CREATE TRIGGER IF NOT EXISTS trg_stock_totals_delete AFTER DELETE ON stock
+        BEGIN
+            UPDATE stock_totals SET products = products - 1,
+                quantity = quantity - OLD.quantity,
+                value = value - OLD.quantity * OLD.purchase_price
+            WHERE id = 1;
+        END''')
+        if created:
+            _rollup_backfill(cursor, 'sales', 'sale_date', ('revenue', 'sales_count'), 'SUM(total_amount), COUNT(*)')
+            _rollup_backfill(cursor, 'expenses', 'date', ('expenses',), 'SUM(amount)')
+            _rollup_backfill(cursor, 'returns', 'return_date', ('returns_qty',), 'SUM(quantity)')
+            cursor.execute('''INSERT INTO stock_totals (id, products, quantity, value)
+                              SELECT 1, COUNT(*), COALESCE(SUM(quantity), 0),
+                                     COALESCE(SUM(quantity * purchase_price), 0)
+                              FROM stock''')
+
+
+# Rolling velocity window start, as read by the stock alert triggers
+_WINDOW_START = "(SELECT start_day FROM velocity_window WHERE id = 1)"
+
+
+@migration(10, 'stock alert counters')
+def _stock_alerts(conn):
+    # Counters kept by triggers (see stock_alerts.py); backfilled when the columns are new
+    with write_transaction(conn):
+        cursor = conn.cursor()
+        created = _add_columns(cursor, 'stock', (
+            ('last_sold_at', 'TEXT'),
+            ('recent_sold', 'INTEGER NOT NULL DEFAULT 0'),
+            ('reorder_level', 'INTEGER NOT NULL DEFAULT 10'),
+        ))
+        cursor.execute('''CREATE TABLE IF NOT EXISTS velocity_window (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            start_day TEXT NOT NULL
+        )''')
+        cursor.execute('''CREATE TABLE IF NOT EXISTS product_daily_sales (
+            stock_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            PRIMARY KEY (stock_id, day)
+        ) WITHOUT ROWID''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_product_daily_sales_day ON product_daily_sales(day)")
+        # One index per alert list
+        cursor.execute('''CREATE INDEX IF NOT EXISTS idx_stock_last_activity ON stock(COALESCE(last_sold_at, date_added))
+           WHERE quantity > 0''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_stock_recent_sold ON stock(recent_sold)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_stock_reorder ON stock(quantity - reorder_level)")
+        cursor.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_sale_items_velocity AFTER INSERT ON sale_items
+        WHEN NEW.stock_id IS NOT NULL
+        BEGIN
+            UPDATE stock SET
+                last_sold_at = MAX(COALESCE(last_sold_at, ''), NEW.sale_date),
+                recent_sold = recent_sold +
+                    CASE WHEN substr(NEW.sale_date, 1, 10) >= {_WINDOW_START} THEN NEW.quantity ELSE 0 END
+            WHERE id = NEW.stock_id;
+            INSERT INTO product_daily_sales (stock_id, day, quantity)
+            SELECT NEW.stock_id, substr(NEW.sale_date, 1, 10), NEW.quantity
+            WHERE substr(NEW.sale_date, 1, 10) >= {_WINDOW_START}
+            ON CONFLICT(stock_id, day) DO UPDATE SET quantity = quantity + excluded.quantity;
+        END''')
+        # Returns only carry the product name; the NOCASE unique index resolves it
+        cursor.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_returns_velocity AFTER INSERT ON returns
+        WHEN substr(NEW.return_date, 1, 10) >= {_WINDOW_START}
+        BEGIN
+            UPDATE stock SET recent_sold = recent_sold - NEW.quantity
+            WHERE product_name = NEW.product_name COLLATE NOCASE;
+            INSERT INTO product_daily_sales (stock_id, day, quantity)
+            SELECT id, substr(NEW.return_date, 1, 10), -NEW.quantity FROM stock
+            WHERE product_name = NEW.product_name COLLATE NOCASE
+            ON CONFLICT(stock_id, day) DO UPDATE SET quantity = quantity + excluded.quantity;
+        END''')
+        # Frozen at the 30-day default of VELOCITY_WINDOW_DAYS: a shorter
+        # configured window is trimmed by stock_alerts.roll_window() on first
+        # use, a longer one fills in as the days pass
+        start = (datetime.now().date() - timedelta(days=30 - 1)).isoformat()
+        cursor.execute("INSERT OR IGNORE INTO velocity_window (id, start_day) VALUES (1, ?)", (start,))
+        if created:
+            cursor.execute('''INSERT INTO product_daily_sales (stock_id, day, quantity)
+                              SELECT stock_id, substr(sale_date, 1, 10), SUM(quantity) FROM sale_items
+                              WHERE stock_id IS NOT NULL AND sale_date >= ?
+                              GROUP BY stock_id, substr(sale_date, 1, 10)''', (start,))
+            cursor.execute('''INSERT INTO product_daily_sales (stock_id, day, quantity)
+                              SELECT s.id, substr(r.return_date, 1, 10), -SUM(r.quantity)
+                              FROM returns r JOIN stock s ON s.product_name = r.product_name COLLATE NOCASE
+                              WHERE r.return_date >= ?
+                              GROUP BY s.id, substr(r.return_date, 1, 10)
+                              ON CONFLICT(stock_id, day) DO UPDATE SET quantity = quantity + excluded.quantity''',
+                           (start,))
+            cursor.execute('''UPDATE stock SET
+                                  last_sold_at = (SELECT MAX(sale_date) FROM sale_items WHERE stock_id = stock.id),
+                                  recent_sold = COALESCE((SELECT SUM(quantity) FROM product_daily_sales
+                                                          WHERE stock_id = stock.id), 0)''')
+
+
+# A credit entry's party, looked up by the (type, name) index
+_PARTY = "(SELECT {col} FROM parties WHERE type = NEW.type AND name = NEW.name COLLATE NOCASE)"
+
+
+@migration(11, 'customer and supplier balances')
+def _ledger(conn):
+    # Balances kept by a trigger on credits (see ledger.py); backfilled from the existing journal
+    with write_transaction(conn):
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'parties'")
+        created = cursor.fetchone() is None
+        cursor.execute('''CREATE TABLE IF NOT EXISTS parties (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            type TEXT NOT NULL,
+            name TEXT NOT NULL,
+            phone TEXT,
+            balance REAL NOT NULL DEFAULT 0,
+            last_activity TEXT,
+            created_at TEXT NOT NULL
+        )''')
+        _add_columns(cursor, 'credits', (
+            ('kind', "TEXT NOT NULL DEFAULT 'charge'"),
+            ('party_id', 'INTEGER REFERENCES parties(id)'),
+            ('balance', 'REAL'),
+        ))
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_parties_type_name ON parties(type, name COLLATE NOCASE)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_parties_type_balance ON parties(type, balance)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_credits_party_date ON credits(party_id, date)")
+        cursor.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_credits_balance AFTER INSERT ON credits
+        BEGIN
+            INSERT INTO parties (type, name, balance, last_activity, created_at)
+            VALUES (NEW.type, NEW.name, NEW.amount, NEW.date, NEW.date)
+            ON CONFLICT(type, name COLLATE NOCASE) DO UPDATE SET
+                balance = balance + excluded.balance,
+                last_activity = MAX(COALESCE(last_activity, ''), excluded.last_activity);
+            UPDATE credits SET party_id = {_PARTY.format(col='id')}, balance = {_PARTY.format(col='balance')}
+            WHERE id = NEW.id;
+        END''')
+        if created:
+            cursor.execute('''INSERT INTO parties (type, name, balance, last_activity, created_at)
+                              SELECT type, MIN(name), SUM(amount), MAX(date), MIN(date) FROM credits WHERE true
+                              GROUP BY type, name COLLATE NOCASE
+                              ON CONFLICT(type, name COLLATE NOCASE) DO UPDATE SET
+                                  balance = excluded.balance, last_activity = excluded.last_activity''')
+            cursor.execute('''UPDATE credits SET party_id = (SELECT id FROM parties p
+                                                             WHERE p.type = credits.type
+                                                             AND p.name = credits.name COLLATE NOCASE)''')
+            cursor.execute('''SELECT SUM(amount) OVER (PARTITION BY party_id ORDER BY date, id), id
+                              FROM credits''')
+            cursor.executemany("UPDATE credits SET balance = ? WHERE id = ?", cursor.fetchall())
+
+
+# Next catalog change sequence number
+_NEXT_CHANGE = "(SELECT COALESCE(MAX(version), 0) + 1 FROM stock_changes)"
+
+
+@migration(12, 'till sync log and catalog change feed')
+def _pos_sync(conn):
+    # See pos_sync.py
+    with write_transaction(conn):
+        conn.execute('''CREATE TABLE IF NOT EXISTS sync_sales (
+            idempotency_key TEXT PRIMARY KEY,
+            device_id TEXT,
+            sale_id INTEGER NOT NULL REFERENCES sales(id),
+            invoice_no TEXT NOT NULL,
+            total_amount REAL NOT NULL,
+            received_at TEXT NOT NULL
+        ) WITHOUT ROWID''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS stock_changes (
+            stock_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL,
+            deleted INTEGER NOT NULL DEFAULT 0
+        )''')
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_stock_changes_version ON stock_changes(version)")
+        conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_stock_changes_insert AFTER INSERT ON stock
+        BEGIN
+            INSERT INTO stock_changes (stock_id, version, deleted) VALUES (NEW.id, {_NEXT_CHANGE}, 0)
+            ON CONFLICT(stock_id) DO UPDATE SET version = excluded.version, deleted = 0;
+        END''')
+        # Alert counters and sold_quantity change with every sale too; only what a till shows counts
+        conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_stock_changes_update
+        AFTER UPDATE OF product_name, quantity, selling_price ON stock
+        BEGIN
+            INSERT INTO stock_changes (stock_id, version, deleted) VALUES (NEW.id, {_NEXT_CHANGE}, 0)
+            ON CONFLICT(stock_id) DO UPDATE SET version = excluded.version, deleted = 0;
+        END''')
+        conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_stock_changes_delete AFTER DELETE ON stock
+        BEGIN
+            INSERT INTO stock_changes (stock_id, version, deleted) VALUES (OLD.id, {_NEXT_CHANGE}, 1)
+            ON CONFLICT(stock_id) DO UPDATE SET version = excluded.version, deleted = 1;
+        END''')
+
+    # Every existing product starts in the change feed; products the triggers
+    # already logged meanwhile are left alone
+    def apply(cursor, rows):
+        cursor.executemany(f'''INSERT OR IGNORE INTO stock_changes (stock_id, version)
+                               VALUES (?, {_NEXT_CHANGE})''', rows)
+
+    backfill(conn, "SELECT id FROM stock WHERE id > ? ORDER BY id LIMIT ?", apply)
+
+
+@migration(13, 'stock movement journal and FIFO cost')
+def _inventory(conn):
+    # See inventory.py
+    with write_transaction(conn):
+        cursor = conn.cursor()
+        _add_columns(cursor, 'sale_items', (('cogs', 'REAL'),))
+        _add_columns(cursor, 'summary_totals', (('cogs', 'REAL NOT NULL DEFAULT 0'),))
+        cursor.execute('''CREATE TABLE IF NOT EXISTS stock_movements (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            stock_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            unit_cost REAL NOT NULL,
+            cost REAL NOT NULL,
+            ref_id INTEGER,
+            note TEXT,
+            created_at TEXT NOT NULL
+        )''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_stock_movements_stock ON stock_movements(stock_id, id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_stock_movements_date ON stock_movements(created_at)")
+        cursor.execute('''CREATE TRIGGER IF NOT EXISTS trg_stock_movements_no_update BEFORE UPDATE ON stock_movements
+        BEGIN
+            SELECT RAISE(ABORT, 'stock_movements is append-only');
+        END''')
+        cursor.execute('''CREATE TRIGGER IF NOT EXISTS trg_stock_movements_no_delete BEFORE DELETE ON stock_movements
+        BEGIN
+            SELECT RAISE(ABORT, 'stock_movements is append-only');
+        END''')
+        cursor.execute('''CREATE TABLE IF NOT EXISTS cost_layers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            stock_id INTEGER NOT NULL,
+            movement_id INTEGER NOT NULL REFERENCES stock_movements(id),
+            quantity INTEGER NOT NULL,
+            remaining INTEGER NOT NULL,
+            unit_cost REAL NOT NULL
+        )''')
+        # Only open layers are ever read, oldest first
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_cost_layers_open ON cost_layers(stock_id, id) "
+                       "WHERE remaining > 0")
+        # Margin reports over a date range read only this index
+        cursor.execute('''CREATE INDEX IF NOT EXISTS idx_sale_items_date_margin
+           ON sale_items(sale_date, stock_id, quantity, total, cogs)''')
+        cursor.execute("DROP INDEX IF EXISTS idx_sale_items_date")
+        cursor.execute(_rollup_trigger('trg_sale_items_cogs', 'sale_items', 'sale_date', ('cogs',), 'NEW.cogs',
+                                       when='NEW.cogs IS NOT NULL'))
+        cursor.execute(_rollup_trigger('trg_returns_cogs', 'stock_movements', 'created_at', ('cogs',), '-NEW.cost',
+                                       when="NEW.kind = 'return'"))
+
+    # Lines sold before the journal are costed at the purchase price they were recorded with;
+    # lines of unknown products have none and keep a NULL cogs, as checkout writes them
+    def cost_lines(cursor, rows):
+        cursor.executemany("UPDATE sale_items SET cogs = quantity * unit_cost "
+                           "WHERE id = ? AND cogs IS NULL AND unit_cost IS NOT NULL", rows)
+
+    backfill(conn, "SELECT id FROM sale_items WHERE id > ? ORDER BY id LIMIT ?", cost_lines)
+
+    # Stock already on hand becomes one opening layer per product, less anything
+    # the app has layered since the journal appeared
+    def open_layers(cursor, rows):
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        for stock_id, quantity, purchase_price in rows:
+            cursor.execute("SELECT 1 FROM stock_movements WHERE stock_id = ? AND kind = 'opening' LIMIT 1",
+                           (stock_id,))
+            if cursor.fetchone():
+                continue
+            cursor.execute("SELECT COALESCE(SUM(remaining), 0) FROM cost_layers "
+                           "WHERE stock_id = ? AND remaining > 0", (stock_id,))
+            quantity -= cursor.fetchone()[0]
+            if quantity <= 0:
+                continue
+            unit_cost = purchase_price or 0
+            cursor.execute('''INSERT INTO stock_movements
+                              (stock_id, kind, quantity, unit_cost, cost, ref_id, note, created_at)
+                              VALUES (?, 'opening', ?, ?, ?, NULL, NULL, ?)''',
+                           (stock_id, quantity, unit_cost, quantity * unit_cost, now))
+            cursor.execute('''INSERT INTO cost_layers (stock_id, movement_id, quantity, remaining, unit_cost)
+                              VALUES (?, ?, ?, ?, ?)''', (stock_id, cursor.lastrowid, quantity, quantity, unit_cost))
+
+    backfill(conn, "SELECT id, quantity, purchase_price FROM stock WHERE id > ? ORDER BY id LIMIT ?",
+             open_layers)
+
+    # Sales costed by the triggers meanwhile are counted once, from scratch
+    with write_transaction(conn):
+        cursor = conn.cursor()
+        cursor.execute("UPDATE summary_totals SET cogs = 0")
+        _rollup_backfill(cursor, 'sale_items', 'sale_date', ('cogs',), 'SUM(cogs)', 'cogs IS NOT NULL')
+        _rollup_backfill(cursor, 'stock_movements', 'created_at', ('cogs',), '-SUM(cost)', "kind = 'return'")
+
+
+@migration(14, 'product and party search index')
+def _search(conn):
+    # See search.py; the trigram tokenizer needs SQLite 3.34 or newer
+    with write_transaction(conn):
+        # Names only, for typo matching; detail='none' keeps it small since only single trigrams are queried
+        conn.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS search_trigrams USING fts5(
+            name, tokenize = 'trigram', detail = 'none'
+        )''')
+        # How many names contain each trigram, to query the rarest (most telling) ones
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS search_trigram_terms "
+                     "USING fts5vocab(search_trigrams, 'row')")
+        conn.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+            kind UNINDEXED, ref_id UNINDEXED, name, detail,
+            tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+        )''')
+        # Plain statements only: inside a trigger an OR REPLACE would be overridden by the
+        # conflict handling of the statement that fired it (the stock upsert)
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_search_stock_insert AFTER INSERT ON stock
+        BEGIN
+            INSERT INTO search_index (rowid, kind, ref_id, name, detail)
+            VALUES (NEW.id * 2, 'product', NEW.id, NEW.product_name, NEW.supplier);
+            INSERT INTO search_trigrams (rowid, name) VALUES (NEW.id * 2, NEW.product_name);
+        END''')
+        # Sales only touch quantities; only a rename or a new supplier rewrites the row
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_search_stock_update AFTER UPDATE OF product_name, supplier ON stock
+        BEGIN
+            UPDATE search_index SET name = NEW.product_name, detail = NEW.supplier WHERE rowid = NEW.id * 2;
+            UPDATE search_trigrams SET name = NEW.product_name WHERE rowid = NEW.id * 2;
+        END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_search_stock_delete AFTER DELETE ON stock
+        BEGIN
+            DELETE FROM search_index WHERE rowid = OLD.id * 2;
+            DELETE FROM search_trigrams WHERE rowid = OLD.id * 2;
+        END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_search_parties_insert AFTER INSERT ON parties
+        BEGIN
+            INSERT INTO search_index (rowid, kind, ref_id, name, detail)
+            VALUES (NEW.id * 2 + 1, NEW.type, NEW.id, NEW.name, NEW.phone);
+            INSERT INTO search_trigrams (rowid, name) VALUES (NEW.id * 2 + 1, NEW.name);
+        END''')
+        # Balance updates (every credit entry) leave the index alone
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_search_parties_update AFTER UPDATE OF type, name, phone ON parties
+        BEGIN
+            UPDATE search_index SET kind = NEW.type, name = NEW.name, detail = NEW.phone
+            WHERE rowid = NEW.id * 2 + 1;
+            UPDATE search_trigrams SET name = NEW.name WHERE rowid = NEW.id * 2 + 1;
+        END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_search_parties_delete AFTER DELETE ON parties
+        BEGIN
+            DELETE FROM search_index WHERE rowid = OLD.id * 2 + 1;
+            DELETE FROM search_trigrams WHERE rowid = OLD.id * 2 + 1;
+        END''')
+        # bm25 weights, in column order: kind, ref_id, name, detail; set as the table's
+        # rank so ORDER BY rank LIMIT is done inside FTS5
+        conn.execute("INSERT INTO search_index (search_index, rank) VALUES ('rank', 'bm25(0, 0, 10, 1)')")
+
+    # Rows the triggers indexed meanwhile are simply replaced with the same values
+    def index_products(cursor, rows):
+        marks = ','.join('?' * len(rows))
+        ids = [row[0] for row in rows]
+        cursor.execute(f'''INSERT OR REPLACE INTO search_index (rowid, kind, ref_id, name, detail)
+                           SELECT id * 2, 'product', id, product_name, supplier FROM stock WHERE id IN ({marks})''',
+                       ids)
+        cursor.execute(f'''INSERT OR REPLACE INTO search_trigrams (rowid, name)
+                           SELECT id * 2, product_name FROM stock WHERE id IN ({marks})''', ids)
+
+    def index_parties(cursor, rows):
+        marks = ','.join('?' * len(rows))
+        ids = [row[0] for row in rows]
+        cursor.execute(f'''INSERT OR REPLACE INTO search_index (rowid, kind, ref_id, name, detail)
+                           SELECT id * 2 + 1, type, id, name, phone FROM parties WHERE id IN ({marks})''', ids)
+        cursor.execute(f'''INSERT OR REPLACE INTO search_trigrams (rowid, name)
+                           SELECT id * 2 + 1, name FROM parties WHERE id IN ({marks})''', ids)
+
+    backfill(conn, "SELECT id FROM stock WHERE id > ? ORDER BY id LIMIT ?", index_products)
+    backfill(conn, "SELECT id FROM parties WHERE id > ? ORDER BY id LIMIT ?", index_parties)
+
+
+@migration(15, 'running balances in date order')
+def _ledger_date_order(conn):
+    # Entries synced late by a till carry an earlier date than entries already
+    # stamped; balances now run in (date, id) order, the order statements list them
+    with write_transaction(conn):
+        conn.execute("DROP TRIGGER IF EXISTS trg_credits_balance")
+        conn.execute(f'''CREATE TRIGGER trg_credits_balance AFTER INSERT ON credits
+        BEGIN
+            INSERT INTO parties (type, name, balance, last_activity, created_at)
+            VALUES (NEW.type, NEW.name, NEW.amount, NEW.date, NEW.date)
+            ON CONFLICT(type, name COLLATE NOCASE) DO UPDATE SET
+                balance = balance + excluded.balance,
+                last_activity = MAX(COALESCE(last_activity, ''), excluded.last_activity);
+            UPDATE credits SET party_id = {_PARTY.format(col='id')} WHERE id = NEW.id;
+            -- The balance after the entry just before this one in date order
+            UPDATE credits SET balance = NEW.amount + COALESCE(
+                (SELECT c.balance FROM credits c
+                 WHERE c.party_id = credits.party_id AND (c.date, c.id) < (NEW.date, NEW.id)
+                 ORDER BY c.date DESC, c.id DESC LIMIT 1), 0)
+            WHERE id = NEW.id;
+            -- A back-dated entry moves every later balance; in-order entries find none
+            UPDATE credits SET balance = balance + NEW.amount
+            WHERE party_id = {_PARTY.format(col='id')} AND date > NEW.date;
+        END''')
+
+    def apply(cursor, rows):
+        cursor.execute(f'''SELECT SUM(amount) OVER (PARTITION BY party_id ORDER BY date, id), id
+                           FROM credits WHERE party_id IN ({','.join('?' * len(rows))})''',
+                       [row[0] for row in rows])
+        cursor.executemany("UPDATE credits SET balance = ? WHERE id = ?", cursor.fetchall())
+
+    backfill(conn, "SELECT id FROM parties WHERE id > ? ORDER BY id LIMIT ?", apply)
+
+
+@migration(16, 'stock listing index')
+def _stock_listing(conn):
+    # The stock page is a keyset listing by date added, like the history pages
+    with write_transaction(conn):
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_stock_date_added ON stock(date_added)")
+
+
+@migration(17, 'customer sales rollup')
+def _customer_totals(conn):
+    # Lifetime revenue per customer for "top customers" (see summaries.py); names
+    # compare case-insensitively, like parties, and the walk-in placeholders
+    # anonymous sales are stored under are left out
+    with write_transaction(conn):
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'customer_totals'")
+        created = cursor.fetchone() is None
+        cursor.execute('''CREATE TABLE IF NOT EXISTS customer_totals (
+            name TEXT NOT NULL PRIMARY KEY COLLATE NOCASE,
+            revenue REAL NOT NULL DEFAULT 0,
+            sales_count INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_customer_totals_revenue ON customer_totals(revenue)")
+        cursor.execute('''CREATE TRIGGER IF NOT EXISTS trg_sales_customer_totals AFTER INSERT ON sales
+        WHEN NEW.customer_name != '' AND NEW.customer_name COLLATE NOCASE NOT IN ('Walk-in', 'Walk-in Customer')
+        BEGIN
+            INSERT INTO customer_totals (name, revenue, sales_count) VALUES (NEW.customer_name, NEW.total_amount, 1)
+            ON CONFLICT(name) DO UPDATE SET revenue = revenue + excluded.revenue, sales_count = sales_count + 1;
+        END''')
+        if created:
+            cursor.execute('''INSERT INTO customer_totals (name, revenue, sales_count)
+                              SELECT MIN(customer_name), SUM(total_amount), COUNT(*) FROM sales
+                              WHERE customer_name != ''
+                              AND customer_name COLLATE NOCASE NOT IN ('Walk-in', 'Walk-in Customer')
+                              GROUP BY customer_name COLLATE NOCASE''')
+
+
+@contextmanager
+def _migration_lock(path):
+    if fcntl is None:
+        yield
+        return
+    with open(f"{path}.migrate.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _ensure_version_table(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TEXT NOT NULL,
+        duration_ms INTEGER NOT NULL
+    )''')
+    conn.commit()
+
+
+def applied_versions(conn):
+    _ensure_version_table(conn)
+    return {row[0] for row in conn.execute("SELECT version FROM schema_version")}
+
+
+def current_version(conn):
+    return max(applied_versions(conn), default=0)
+
+
+def pending(conn, target=None):
+    """Migrations not yet applied (up to `target`), in order: [(version, name, fn)]."""
+    done = applied_versions(conn)
+    return [m for m in sorted(MIGRATIONS, key=lambda m: m[0])
+            if m[0] not in done and (target is None or m[0] <= target)]
+
+
+def migrate(conn, target=None, path=None, log=print):
+    """Apply every pending migration (up to `target`); returns the versions applied."""
+    applied = []
+    with _migration_lock(path or DB_PATH):
+        # Another worker may have finished them while we waited for the lock
+        for version, name, fn in pending(conn, target):
+            started = time.perf_counter()
+            log(f"Applying migration {version}: {name} ...")
+            fn(conn)
+            duration_ms = int((time.perf_counter() - started) * 1000)
+            with write_transaction(conn):
+                conn.execute("INSERT INTO schema_version (version, name, applied_at, duration_ms) VALUES (?, ?, ?, ?)",
+                             (version, name, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), duration_ms))
+            applied.append(version)
+    return applied
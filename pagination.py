@@ -0,0 +1,120 @@
+"""
+Keyset (cursor) pagination for the history pages
+
+Every listing is ordered newest first by (date column, id), which matches
+an index on the date column (SQLite appends the rowid), so fetching a page
+is an index range scan of page-size rows no matter how much history sits
+behind it.  The position of the last row shown is handed back to the
+client as an opaque cursor instead of an OFFSET.
+"""
+
+import base64
+import json
+
+from profit_loss import parse_date
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# listing name -> table, sort/date column, the filters it accepts and (optionally)
+# the columns to read when a page should not carry every column of the table
+LISTINGS = {
+    'stock': {
+        'table': 'stock',
+        'date': 'date_added',
+        'columns': 'id, product_name, quantity, sold_quantity, purchase_price, selling_price, supplier, date_added',
+        'filters': {},
+    },
+    'sales': {
+        'table': 'sales',
+        'date': 'sale_date',
+        'filters': {
+            'customer': "customer_name = ? COLLATE NOCASE",
+            'payment_type': "payment_type = ?",
+        },
+    },
+    'credits': {
+        'table': 'credits',
+        'date': 'date',
+        'filters': {
+            'name': "name = ? COLLATE NOCASE",
+            'type': "type = ?",
+        },
+    },
+    'expenses': {
+        'table': 'expenses',
+        'date': 'date',
+        'filters': {
+            'category': "category = ?",
+        },
+    },
+    'returns': {
+        'table': 'returns',
+        'date': 'return_date',
+        'filters': {
+            'customer': "customer_name = ? COLLATE NOCASE",
+        },
+    },
+}
+
+
+def encode_cursor(date, row_id):
+    return base64.urlsafe_b64encode(json.dumps([date, row_id]).encode()).decode()
+
+
+def decode_cursor(token):
+    try:
+        date, row_id = json.loads(base64.urlsafe_b64decode(token.encode()))
+        return str(date), int(row_id)
+    except (ValueError, TypeError):
+        raise ValueError('Invalid page cursor')
+
+
+def build_filters(listing, args):
+    """Translate request args into (WHERE clauses, params) for a listing.
+
+    Understands 'from' / 'to' (inclusive YYYY-MM-DD) plus the listing's own filters.
+    """
+    spec = LISTINGS[listing]
+    clauses, params = [], []
+    date_from = parse_date(args.get('from'))
+    date_to = parse_date(args.get('to'))
+    if date_from:
+        clauses.append(f"{spec['date']} >= ?")
+        params.append(date_from)
+    if date_to:
+        clauses.append(f"{spec['date']} <= ?")
+        params.append(date_to + ' 23:59:59')
+    for name, clause in spec['filters'].items():
+        if args.get(name):
+            clauses.append(clause)
+            params.append(args[name])
+    return clauses, params
+
+
+def fetch_page(cursor, listing, args):
+    """Fetch one page of a listing.
+
+    Returns (rows, column names, next cursor or None).  Rows are table tuples
+    (the listing's columns, in table order) so templates keep indexing them
+    the way they always have.
+    """
+    spec = LISTINGS[listing]
+    limit = min(max(int(args.get('limit', PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    clauses, params = build_filters(listing, args)
+    if args.get('cursor'):
+        clauses.append(f"({spec['date']}, id) < (?, ?)")
+        params.extend(decode_cursor(args['cursor']))
+
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+    cursor.execute(f'''SELECT {spec.get('columns', '*')} FROM {spec['table']} {where}
+                       ORDER BY {spec['date']} DESC, id DESC LIMIT ?''', (*params, limit + 1))
+    rows = cursor.fetchall()
+    columns = [column[0] for column in cursor.description]
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = dict(zip(columns, rows[-1]))
+        next_cursor = encode_cursor(last[spec['date']], last['id'])
+    return rows, columns, next_cursor
@@ -0,0 +1,117 @@
+"""
+Offline till sync
+
+Tills that lose their connection keep selling and queue each sale locally
+with a client-generated idempotency key.  When they reconnect they drain
+the queue through apply_batch():
+
+  * the whole batch runs in one write transaction, each sale inside its own
+    SAVEPOINT, so one short or unknown product rejects only that sale
+    (reported back as a conflict) and the rest still commit;
+  * sales go through checkout.record_sale(), so stock checks, invoice
+    numbers, credit entries and receipts behave exactly as at the counter,
+    dated with the till's own clock.  Invoice numbers always take the
+    server's POS prefix, and a sale dated further back than
+    SYNC_MAX_BACKDATE_DAYS is reported invalid rather than rewriting closed
+    periods;
+  * every applied key is stored in sync_sales, so a batch re-sent after a
+    lost response returns the original invoice numbers instead of selling
+    twice.
+
+For the other direction, stock_changes keeps one row per product holding
+the sequence number of its latest change to anything a till shows (name,
+price, quantity) or a deleted flag.  catalog_delta(since) returns the
+products changed after a sequence number the till already has, so a till
+pulls only what changed instead of the whole catalog.  Both tables and the
+stock_changes triggers are created by migration 12.
+"""
+
+import os
+from datetime import datetime, timedelta
+
+from checkout import SaleRejected, record_sale
+
+MAX_BATCH = int(os.environ.get('SYNC_MAX_BATCH', 200))
+MAX_CLOCK_SKEW = timedelta(seconds=int(os.environ.get('SYNC_MAX_CLOCK_SKEW', 300)))
+MAX_BACKDATE = timedelta(days=int(os.environ.get('SYNC_MAX_BACKDATE_DAYS', 30)))
+INVOICE_PREFIX = 'POS'
+DELTA_LIMIT = 1000
+
+
+def catalog_version(cursor):
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM stock_changes")
+    return cursor.fetchone()[0]
+
+
+def catalog_delta(cursor, since=0, limit=DELTA_LIMIT):
+    """Products changed after sequence number `since`, oldest change first.
+
+    Returns (products, deleted stock ids, next `since`, more pages waiting).
+    """
+    cursor.execute('''SELECT c.version, c.stock_id, c.deleted, s.product_name, s.quantity, s.selling_price
+                      FROM stock_changes c LEFT JOIN stock s ON s.id = c.stock_id
+                      WHERE c.version > ? ORDER BY c.version LIMIT ?''', (since, limit))
+    rows = cursor.fetchall()
+    products, deleted = [], []
+    for version, stock_id, is_deleted, product_name, quantity, selling_price in rows:
+        if is_deleted or product_name is None:
+            deleted.append(stock_id)
+        else:
+            products.append({'id': stock_id, 'product_name': product_name, 'quantity': quantity,
+                             'selling_price': selling_price})
+    return products, deleted, rows[-1][0] if rows else since, len(rows) == limit
+
+
+def _sold_at(value, now):
+    # The till's clock, but never in the future beyond a small skew nor too far in the past
+    if not value:
+        return now
+    sold_at = datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+    if sold_at < now - MAX_BACKDATE:
+        raise ValueError(f"sold_at {value} is more than {MAX_BACKDATE.days} days old")
+    return now if sold_at > now + MAX_CLOCK_SKEW else sold_at
+
+
+def _apply_one(cursor, sale, device_id, now):
+    key = sale.get('idempotency_key') if isinstance(sale, dict) else None
+    if not key:
+        return {'status': 'invalid', 'errors': ["Missing idempotency_key"]}
+    result = {'idempotency_key': key}
+
+    cursor.execute("SELECT sale_id, invoice_no, total_amount FROM sync_sales WHERE idempotency_key = ?", (key,))
+    done = cursor.fetchone()
+    if done:
+        return {**result, 'status': 'duplicate', 'sale_id': done[0], 'invoice_no': done[1],
+                'total_amount': done[2]}
+
+    cursor.execute("SAVEPOINT sync_sale")
+    try:
+        phone = sale.get('customer_phone')
+        applied = record_sale(cursor, sale.get('items'), sale.get('customer_name', 'Walk-in'), phone,
+                              sale.get('payment_type', 'cash'), INVOICE_PREFIX,
+                              receipt_phone=sale.get('send_whatsapp') and phone,
+                              now=_sold_at(sale.get('sold_at'), now))
+        cursor.execute('''INSERT INTO sync_sales (idempotency_key, device_id, sale_id, invoice_no, total_amount,
+                                                  received_at) VALUES (?, ?, ?, ?, ?, ?)''',
+                       (key, device_id, applied['sale_id'], applied['invoice_no'], applied['total_amount'],
+                        now.strftime("%Y-%m-%d %H:%M:%S")))
+    except SaleRejected as e:
+        cursor.execute("ROLLBACK TO sync_sale")
+        cursor.execute("RELEASE sync_sale")
+        return {**result, 'status': 'rejected', 'errors': e.errors}
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        # Malformed sale (bad line, bad sold_at); the rest of the batch still applies
+        cursor.execute("ROLLBACK TO sync_sale")
+        cursor.execute("RELEASE sync_sale")
+        return {**result, 'status': 'invalid',
+                'errors': [f"Missing field {e}" if isinstance(e, KeyError) else str(e)]}
+    cursor.execute("RELEASE sync_sale")
+    return {**result, 'status': 'applied', **applied}
+
+
+def apply_batch(cursor, sales, device_id=None):
+    """Apply queued till sales; call inside a write transaction.  Returns one result per sale, in order."""
+    if len(sales) > MAX_BATCH:
+        raise ValueError(f"Batch too large: {len(sales)} sales (max {MAX_BATCH})")
+    now = datetime.now()
+    return [_apply_one(cursor, sale, device_id, now) for sale in sales]
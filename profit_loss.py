@@ -0,0 +1,70 @@
+"""
+Profit and loss over arbitrary date ranges
+
+Revenue, cost of goods sold (see inventory.py) and expenses are already
+bucketed per day in summary_totals (see summaries.py), keyed by an indexed
+'YYYY-MM-DD' period.  A report is a single range scan over those day rows
+grouped into the requested granularity, so its cost depends on the number
+of days covered rather than on the number of sales or expense rows behind
+them.
+"""
+
+from datetime import datetime, timedelta
+
+# SQL expression turning a day key into the bucket for each granularity
+_BUCKETS = {
+    'day': "period",
+    # Keyed on the week's Monday: a %Y-W%W key splits the New Year week in two
+    'week': "date(period, '-6 days', 'weekday 1')",
+    'month': "substr(period, 1, 7)",
+    'year': "substr(period, 1, 4)",
+}
+
+
+def parse_date(value):
+    """Validate a YYYY-MM-DD query parameter; None passes through."""
+    if not value:
+        return None
+    return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+
+
+def next_day(value):
+    """The day after a YYYY-MM-DD string: the exclusive upper bound of a timestamp range ending on it."""
+    return (datetime.strptime(value, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+
+
+def _totals(cursor, granularity, date_from, date_to):
+    if granularity not in _BUCKETS:
+        raise ValueError(f"Unknown granularity '{granularity}'")
+
+    if date_from is None and date_to is None and granularity != 'week':
+        # Whole history: the month and year rollups already hold the answer
+        cursor.execute('''SELECT period, revenue, cogs, expenses FROM summary_totals
+                          WHERE granularity = ? AND (sales_count > 0 OR expenses != 0 OR cogs != 0)
+                          ORDER BY period''', (granularity,))
+    else:
+        bucket = _BUCKETS[granularity]
+        cursor.execute(f'''SELECT {bucket} AS bucket, SUM(revenue), SUM(cogs), SUM(expenses)
+                           FROM summary_totals
+                           WHERE granularity = 'day' AND period BETWEEN ? AND ?
+                           AND (sales_count > 0 OR expenses != 0 OR cogs != 0)
+                           GROUP BY bucket ORDER BY bucket''',
+                       (date_from or '0000-00-00', date_to or '9999-12-31'))
+    return cursor.fetchall()
+
+
+def profit_loss(cursor, granularity='month', date_from=None, date_to=None):
+    """Return [(period, revenue, expenses, profit)] ordered by period.
+
+    Profit is revenue less the cost of the goods sold and expenses.
+    date_from / date_to are inclusive 'YYYY-MM-DD' strings; either may be None.
+    """
+    return [(period, revenue, expenses, revenue - cogs - expenses)
+            for period, revenue, cogs, expenses in _totals(cursor, granularity, date_from, date_to)]
+
+
+def margin_report(cursor, granularity='month', date_from=None, date_to=None):
+    """Like profit_loss(), as dicts that also carry cogs and gross margin."""
+    return [{'period': period, 'revenue': revenue, 'cogs': cogs, 'gross_margin': revenue - cogs,
+             'expenses': expenses, 'profit': revenue - cogs - expenses}
+            for period, revenue, cogs, expenses in _totals(cursor, granularity, date_from, date_to)]
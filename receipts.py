@@ -0,0 +1,244 @@
+"""
+WhatsApp receipt outbox
+
+Checkout only inserts a row into receipt_outbox, inside the same
+transaction as the sale, so a receipt exists if and only if the sale does
+and the request never waits on delivery.  Each worker runs one dispatcher
+thread that claims due rows and hands them to a small bounded thread pool,
+which renders the receipt from a template and passes it to the configured
+transport.  Failures are retried with exponential backoff; rows claimed by a
+worker that died are picked up again after CLAIM_TIMEOUT, so pending
+receipts survive restarts.
+
+Transports are chosen with RECEIPT_TRANSPORT: 'webhook' (POSTs JSON to
+RECEIPT_WEBHOOK_URL) or, for local testing, 'stub' (logs each message and
+keeps the last few in memory, delivering nothing).  Anything with a
+send(phone, message) method can be installed with set_transport().  With no
+transport configured the dispatcher logs a warning and leaves receipts
+pending, so they go out once one is.
+"""
+
+import json
+import logging
+import os
+import threading
+import urllib.parse
+import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from database import DB_PATH, connection, write_transaction
+
+POLL_INTERVAL = float(os.environ.get('RECEIPT_POLL_INTERVAL', 5))
+WORKERS = int(os.environ.get('RECEIPT_WORKERS', 2))
+BATCH_SIZE = WORKERS * 5
+MAX_ATTEMPTS = int(os.environ.get('RECEIPT_MAX_ATTEMPTS', 6))
+BACKOFF_SECONDS = float(os.environ.get('RECEIPT_BACKOFF_SECONDS', 30))
+CLAIM_TIMEOUT = 300
+STUB_KEEP = 100
+
+log = logging.getLogger('receipts')
+
+RECEIPT_TEMPLATE = """🧾 *INVOICE RECEIPT* 🧾
+═══════════════════════════
+
+📋 *Invoice:* {invoice_no}
+👤 *Customer:* {customer_name}
+📅 *Date:* {date}
+
+📦 *ITEMS PURCHASED:*
+─────────────────────────────
+{lines}─────────────────────────────
+💰 *TOTAL: PKR {total_amount}*
+─────────────────────────────
+
+🙏 *Thank you for your business!*
+📞 Contact us for support
+✨ We appreciate you! ✨"""
+
+LINE_TEMPLATE = "{number}. *{product_name}*\n   Qty: {quantity} × PKR {price} = *PKR {total}*\n\n"
+
+
+def _now():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def clean_phone(phone):
+    return ''.join(ch for ch in phone if ch.isdigit())
+
+
+def whatsapp_link(phone, message):
+    return f"https://wa.me/{clean_phone(phone)}?text={urllib.parse.quote(message)}"
+
+
+def render_receipt(payload):
+    lines = ''.join(LINE_TEMPLATE.format(number=number, **item)
+                    for number, item in enumerate(payload['items'], 1))
+    date = datetime.strptime(payload['sale_date'], "%Y-%m-%d %H:%M:%S").strftime('%d/%m/%Y %H:%M')
+    return RECEIPT_TEMPLATE.format(invoice_no=payload['invoice_no'],
+                                   customer_name=payload.get('customer_name') or 'Valued Customer',
+                                   date=date, lines=lines, total_amount=payload['total_amount'])
+
+
+def enqueue_receipt(cursor, sale_id, phone, payload):
+    """Queue a receipt; call inside the sale's transaction."""
+    now = _now()
+    cursor.execute('''INSERT INTO receipt_outbox (sale_id, phone, payload, next_attempt_at, created_at)
+                      VALUES (?, ?, ?, ?, ?)''', (sale_id, phone, json.dumps(payload), now, now))
+
+
+class StubTransport:
+    """Local transport: logs each message and keeps the last STUB_KEEP in memory."""
+
+    def __init__(self):
+        self.sent = deque(maxlen=STUB_KEEP)
+
+    def send(self, phone, message):
+        self.sent.append((phone, message))
+        log.info("WhatsApp invoice for %s: %s...", phone, whatsapp_link(phone, message)[:60])
+
+
+class WebhookTransport:
+    """POSTs {phone, message, link} as JSON to a gateway that talks to WhatsApp."""
+
+    def __init__(self, url, token=None, timeout=10):
+        self.url = url
+        self.token = token
+        self.timeout = timeout
+
+    def send(self, phone, message):
+        headers = {'Content-Type': 'application/json'}
+        if self.token:
+            headers['Authorization'] = f"Bearer {self.token}"
+        body = json.dumps({'phone': clean_phone(phone), 'message': message,
+                           'link': whatsapp_link(phone, message)}).encode('utf-8')
+        request = urllib.request.Request(self.url, data=body, headers=headers, method='POST')
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            if response.status >= 300:
+                raise RuntimeError(f"Webhook returned HTTP {response.status}")
+
+
+_transport = None
+_warned = False
+
+
+def get_transport():
+    """The configured transport, or None when RECEIPT_TRANSPORT names none."""
+    global _transport
+    if _transport is None:
+        kind = os.environ.get('RECEIPT_TRANSPORT')
+        if kind == 'webhook':
+            _transport = WebhookTransport(os.environ['RECEIPT_WEBHOOK_URL'],
+                                          os.environ.get('RECEIPT_WEBHOOK_TOKEN'))
+        elif kind == 'stub':
+            _transport = StubTransport()
+    return _transport
+
+
+def set_transport(transport):
+    global _transport
+    _transport = transport
+
+
+def claim_due(path=None, limit=BATCH_SIZE):
+    """Mark up to `limit` due receipts as 'sending' and return them."""
+    now = datetime.now()
+    stale = (now - timedelta(seconds=CLAIM_TIMEOUT)).strftime("%Y-%m-%d %H:%M:%S")
+    now = now.strftime("%Y-%m-%d %H:%M:%S")
+    due = '''(status = 'pending' AND next_attempt_at <= ?) OR (status = 'sending' AND claimed_at <= ?)'''
+    with connection(path) as conn:
+        # Cheap read first so idle workers never take the write lock
+        if not conn.execute(f"SELECT 1 FROM receipt_outbox WHERE {due} LIMIT 1", (now, stale)).fetchone():
+            return []
+        with write_transaction(conn):
+            jobs = conn.execute(f'''SELECT id, phone, payload, attempts FROM receipt_outbox
+                                    WHERE {due} ORDER BY next_attempt_at LIMIT ?''',
+                                (now, stale, limit)).fetchall()
+            conn.executemany("UPDATE receipt_outbox SET status = 'sending', claimed_at = ? WHERE id = ?",
+                             [(now, job[0]) for job in jobs])
+    return jobs
+
+
+def deliver(job, path=None):
+    outbox_id, phone, payload, attempts = job
+    try:
+        get_transport().send(phone, render_receipt(json.loads(payload)))
+    except Exception as e:
+        attempts += 1
+        status = 'failed' if attempts >= MAX_ATTEMPTS else 'pending'
+        retry_at = datetime.now() + timedelta(seconds=BACKOFF_SECONDS * 2 ** (attempts - 1))
+        update = ('''UPDATE receipt_outbox SET status = ?, attempts = ?, next_attempt_at = ?,
+                     last_error = ?, claimed_at = NULL WHERE id = ?''',
+                  (status, attempts, retry_at.strftime("%Y-%m-%d %H:%M:%S"), str(e), outbox_id))
+        log.warning("WhatsApp receipt %s failed (attempt %d): %s", outbox_id, attempts, e)
+    else:
+        update = ('''UPDATE receipt_outbox SET status = 'sent', attempts = ?, sent_at = ?,
+                     last_error = NULL WHERE id = ?''', (attempts + 1, _now(), outbox_id))
+    with connection(path) as conn:
+        conn.execute(*update)
+        conn.commit()
+
+
+class Dispatcher:
+    """One polling thread per worker feeding a bounded pool of sender threads."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self._wake = threading.Event()
+        self._pool = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='receipt-sender')
+        self._thread = threading.Thread(target=self._run, name='receipt-dispatcher', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def notify(self):
+        self._wake.set()
+
+    def run_once(self):
+        global _warned
+        if get_transport() is None:
+            # Nothing to deliver with: leave the receipts pending rather than mark them sent
+            if not _warned:
+                _warned = True
+                log.warning("No receipt transport configured (set RECEIPT_TRANSPORT); receipts stay pending")
+            return 0
+        jobs = claim_due(self.path)
+        # Wait for the batch so at most BATCH_SIZE receipts are ever in flight
+        list(self._pool.map(lambda job: deliver(job, self.path), jobs))
+        return len(jobs)
+
+    def _run(self):
+        while True:
+            try:
+                busy = self.run_once()
+            except Exception as e:
+                log.exception("Receipt dispatcher error: %s", e)
+                busy = 0
+            if not busy:
+                self._wake.wait(POLL_INTERVAL)
+                self._wake.clear()
+
+
+_dispatchers = {}
+_dispatchers_lock = threading.Lock()
+
+
+def ensure_dispatcher(path=None):
+    """Start this worker's dispatcher for a database if it is not running yet."""
+    key = (os.getpid(), path or DB_PATH)
+    dispatcher = _dispatchers.get(key)
+    if dispatcher is None:
+        with _dispatchers_lock:
+            dispatcher = _dispatchers.get(key)
+            if dispatcher is None:
+                dispatcher = _dispatchers[key] = Dispatcher(path)
+                dispatcher.start()
+    return dispatcher
+
+
+def notify(path=None):
+    """Wake the dispatcher after a commit so new receipts go out without waiting for the next poll."""
+    dispatcher = _dispatchers.get((os.getpid(), path or DB_PATH))
+    if dispatcher is not None:
+        dispatcher.notify()
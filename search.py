@@ -0,0 +1,175 @@
+"""
+Full-text search over products, customers and suppliers
+
+search_index is an FTS5 table with one row per product (name, supplier)
+and one per party (name, phone), kept current by triggers on stock and
+parties in the same transaction as the write.  Rows are keyed by rowid:
+stock.id * 2 for products and parties.id * 2 + 1 for customers and
+suppliers, so a trigger can replace or delete its row with one rowid
+lookup.
+
+search() runs in two steps:
+
+  * every word typed is matched as a prefix ("sams gal" finds "Samsung
+    Galaxy A15"), through the prefix indexes, and ranked by bm25 with the
+    name weighted above the supplier or phone (queries broader than
+    RANK_WINDOW rows are not worth ranking and return the first name matches);
+  * if that finds fewer than `limit` rows, the rarest trigrams of the words
+    are looked up in search_trigrams (FTS5's trigram tokenizer), and the
+    closest FUZZY_CANDIDATES names are re-scored with difflib, so a typo
+    ("samsnug") still finds the product.
+
+The tables, triggers and bm25 weights (name 10, supplier or phone 1) are
+created by migration 14; the trigram tokenizer needs SQLite 3.34 or newer.  Results are kept per
+store in a CatalogCache that any write to stock, sales or credits (the only
+writes that add or rename a party) clears.
+"""
+
+import os
+import re
+from difflib import SequenceMatcher
+
+from catalog_cache import CatalogCache
+from stores import StoreLocal
+
+KINDS = ('product', 'customer', 'supplier')
+SEARCH_LIMIT = 20
+MAX_LIMIT = 100
+# A query matching more rows than this ("p") is too broad for ranking to mean
+# much, so it returns the first name matches instead of scoring the whole catalog
+RANK_WINDOW = 2000
+FUZZY_CANDIDATES = 50
+# Trigrams are looked up rarest first, up to this many index entries in total;
+# one found in more names than this tells names apart too little to use
+FUZZY_MAX_POSTINGS = 5000
+FUZZY_CUTOFF = float(os.environ.get('SEARCH_FUZZY_CUTOFF', 0.7))
+
+
+def rebuild_search(cursor):
+    """Re-create every index row from stock and parties, then merge the index b-trees."""
+    cursor.execute("DELETE FROM search_index")
+    cursor.execute("DELETE FROM search_trigrams")
+    cursor.execute('''INSERT INTO search_index (rowid, kind, ref_id, name, detail)
+                      SELECT id * 2, 'product', id, product_name, supplier FROM stock''')
+    cursor.execute('''INSERT INTO search_index (rowid, kind, ref_id, name, detail)
+                      SELECT id * 2 + 1, type, id, name, phone FROM parties''')
+    cursor.execute('''INSERT INTO search_trigrams (rowid, name)
+                      SELECT id * 2, product_name FROM stock UNION ALL SELECT id * 2 + 1, name FROM parties''')
+    cursor.execute("INSERT INTO search_index (search_index) VALUES ('optimize')")
+    cursor.execute("INSERT INTO search_trigrams (search_trigrams) VALUES ('optimize')")
+
+
+def _words(text):
+    return re.findall(r'\w+', (text or '').lower())
+
+
+def _similarity(query, name):
+    # Best of the whole name and every window of it that starts a word and is as
+    # long as the query, so a half-typed word is compared with as much of the name
+    name = name.lower()
+    starts = [0] + [m.start() for m in re.finditer(r'(?<=\s)\S', name)]
+    return max([SequenceMatcher(None, query, name).ratio()] +
+               [SequenceMatcher(None, query, name[i:i + len(query)]).ratio() for i in starts])
+
+
+# Joined only after FTS5 has picked the rows, never for every match
+_SELECT = '''SELECT i.rowid, i.kind, i.ref_id, i.name, i.detail, s.quantity, s.selling_price, p.balance
+             FROM ({matches}) i
+             LEFT JOIN stock s ON i.kind = 'product' AND s.id = i.ref_id
+             LEFT JOIN parties p ON i.kind != 'product' AND p.id = i.ref_id'''
+
+
+def _result(row, match):
+    rowid, kind, ref_id, name, detail, quantity, selling_price, balance = row
+    result = {'kind': kind, 'id': ref_id, 'name': name, 'match': match}
+    if kind == 'product':
+        result.update(supplier=detail, quantity=quantity, selling_price=selling_price)
+    else:
+        result.update(phone=detail, balance=balance)
+    return result
+
+
+def _prefix_matches(cursor, words, kinds, limit):
+    query = ' '.join(f'"{word}"*' for word in words)
+    cursor.execute("SELECT COUNT(*) FROM (SELECT 1 FROM search_index WHERE search_index MATCH ? LIMIT ?)",
+                   (query, RANK_WINDOW + 1))
+    order = "ORDER BY rank"
+    if cursor.fetchone()[0] > RANK_WINDOW:
+        # Too broad to rank: names only, since a supplier or phone match is the weakest hit
+        query, order = f"name : ({query})", ""
+    matches = f'''SELECT rowid, kind, ref_id, name, detail, rank FROM search_index
+                    WHERE search_index MATCH ? AND kind IN ({','.join('?' * len(kinds))}) {order} LIMIT ?'''
+    cursor.execute(_SELECT.format(matches=matches) + " ORDER BY i.rank", (query, *kinds, limit))
+    return cursor.fetchall()
+
+
+def _rare_trigrams(cursor, words):
+    # Common trigrams ("pro" in every "Product ...") match most of the catalog and
+    # say little; the rarest ones that exist at all pick out the candidates
+    grams = sorted({word[i:i + 3] for word in words for i in range(len(word) - 2)})
+    if not grams:
+        return []
+    cursor.execute(f"SELECT term, doc FROM search_trigram_terms WHERE term IN ({','.join('?' * len(grams))}) "
+                   "ORDER BY doc", grams)
+    chosen, postings = [], 0
+    for term, doc in cursor.fetchall():
+        if postings + doc > FUZZY_MAX_POSTINGS:
+            break
+        chosen.append(term)
+        postings += doc
+    return chosen
+
+
+def _fuzzy_matches(cursor, words, kinds, limit, exclude):
+    grams = _rare_trigrams(cursor, words)
+    if not grams:
+        return []
+    cursor.execute('''SELECT rowid, name FROM search_trigrams WHERE search_trigrams MATCH ?
+                      ORDER BY rank LIMIT ?''',
+                   (' OR '.join(f'"{gram}"' for gram in grams), FUZZY_CANDIDATES))
+    query = ' '.join(words)
+    scored = sorted(((score, rowid) for rowid, name in cursor.fetchall() if rowid not in exclude
+                     for score in [_similarity(query, name)] if score >= FUZZY_CUTOFF), reverse=True)
+    if not scored:
+        return []
+    order = {rowid: n for n, (_, rowid) in enumerate(scored)}
+    matches = f'''SELECT rowid, kind, ref_id, name, detail FROM search_index
+                    WHERE rowid IN ({','.join('?' * len(order))}) AND kind IN ({','.join('?' * len(kinds))})'''
+    cursor.execute(_SELECT.format(matches=matches), (*order, *kinds))
+    return sorted(cursor.fetchall(), key=lambda row: order[row[0]])[:limit]
+
+
+def search(cursor, text, kinds=KINDS, limit=SEARCH_LIMIT):
+    """Ranked matches for `text`: prefix matches first, then typo-tolerant ones.
+
+    Returns a list of dicts with kind, id, name and match ('prefix' or
+    'fuzzy'), plus quantity / selling_price / supplier for products and
+    balance / phone for parties.
+    """
+    words = _words(text)
+    if not words:
+        return []
+    rows = _prefix_matches(cursor, words, kinds, limit)
+    results = [_result(row, 'prefix') for row in rows]
+    if len(rows) < limit:
+        found = {row[0] for row in rows}
+        results += [_result(row, 'fuzzy') for row in _fuzzy_matches(cursor, words, kinds, limit - len(rows), found)]
+    return results
+
+
+def parse_kinds(value):
+    """Validate a comma-separated kinds parameter; empty means every kind."""
+    kinds = tuple(kind.strip() for kind in (value or '').split(',') if kind.strip()) or KINDS
+    unknown = [kind for kind in kinds if kind not in KINDS]
+    if unknown:
+        raise ValueError(f"Unknown kind '{unknown[0]}'")
+    return kinds
+
+
+# Parties are only ever added or renamed alongside a stock, sale or credit write
+results = StoreLocal(lambda: CatalogCache(max_size=2048, tables=('stock', 'sales', 'credits')))
+
+
+def cached_search(cursor, text, kinds=KINDS, limit=SEARCH_LIMIT):
+    key = (' '.join(_words(text)), kinds, limit)
+    return results.get(cursor, key, lambda c: search(c, text, kinds, limit))
@@ -0,0 +1,103 @@
+"""
+Dead-stock, velocity and low-stock alerts
+
+Three columns on stock are maintained by triggers in the same transaction as
+the sale or return that changes them:
+
+  last_sold_at   latest sale_items.sale_date for the product
+  recent_sold    net units sold in the last WINDOW_DAYS days
+  reorder_level  per-product low-stock threshold (default 10)
+
+recent_sold is a rolling counter: every sale and return also lands in a
+per-product daily bucket (product_daily_sales), and when the window moves
+forward roll_window() subtracts the buckets that fell out of it and drops
+them, touching only the products sold on those days.  Every reader of
+recent_sold calls roll_window() first; once the window is current that is a
+single primary-key read.  The columns, tables and triggers are created by
+migration 10.  Each alert list is a
+range scan on its own index, so its cost depends on the number of alerts,
+not on the size of the sales history.
+"""
+
+import os
+from datetime import datetime, timedelta
+
+from database import write_transaction
+
+WINDOW_DAYS = int(os.environ.get('VELOCITY_WINDOW_DAYS', 30))
+DEAD_STOCK_DAYS = int(os.environ.get('DEAD_STOCK_DAYS', 30))
+HIGH_VELOCITY_UNITS = int(os.environ.get('HIGH_VELOCITY_UNITS', 30))
+
+
+def _window_start(today=None):
+    return ((today or datetime.now().date()) - timedelta(days=WINDOW_DAYS - 1)).isoformat()
+
+
+def rebuild_stock_alerts(cursor):
+    """Recompute last_sold_at and the rolling window from sale_items and returns (backfill / repair)."""
+    start = _window_start()
+    cursor.execute("UPDATE velocity_window SET start_day = ? WHERE id = 1", (start,))
+    cursor.execute("DELETE FROM product_daily_sales")
+    cursor.execute('''INSERT INTO product_daily_sales (stock_id, day, quantity)
+                      SELECT stock_id, substr(sale_date, 1, 10), SUM(quantity) FROM sale_items
+                      WHERE stock_id IS NOT NULL AND sale_date >= ?
+                      GROUP BY stock_id, substr(sale_date, 1, 10)''', (start,))
+    cursor.execute('''INSERT INTO product_daily_sales (stock_id, day, quantity)
+                      SELECT s.id, substr(r.return_date, 1, 10), -SUM(r.quantity)
+                      FROM returns r JOIN stock s ON s.product_name = r.product_name COLLATE NOCASE
+                      WHERE r.return_date >= ?
+                      GROUP BY s.id, substr(r.return_date, 1, 10)
+                      ON CONFLICT(stock_id, day) DO UPDATE SET quantity = quantity + excluded.quantity''',
+                   (start,))
+    cursor.execute('''UPDATE stock SET
+                          last_sold_at = (SELECT MAX(sale_date) FROM sale_items WHERE stock_id = stock.id),
+                          recent_sold = COALESCE((SELECT SUM(quantity) FROM product_daily_sales
+                                                  WHERE stock_id = stock.id), 0)''')
+
+
+def roll_window(conn, today=None):
+    """Move the rolling window up to today; returns True if it moved.
+
+    Only the products sold on the days that dropped out are updated.
+    """
+    start = _window_start(today)
+    if conn.execute("SELECT start_day FROM velocity_window WHERE id = 1").fetchone()[0] >= start:
+        return False
+    with write_transaction(conn):
+        # Re-check under the write lock in case another worker rolled it first
+        if conn.execute("SELECT start_day FROM velocity_window WHERE id = 1").fetchone()[0] >= start:
+            return False
+        conn.execute('''UPDATE stock SET recent_sold = recent_sold -
+                            (SELECT SUM(quantity) FROM product_daily_sales WHERE stock_id = stock.id AND day < ?)
+                        WHERE id IN (SELECT stock_id FROM product_daily_sales WHERE day < ?)''', (start, start))
+        conn.execute("DELETE FROM product_daily_sales WHERE day < ?", (start,))
+        conn.execute("UPDATE velocity_window SET start_day = ? WHERE id = 1", (start,))
+    return True
+
+
+def low_stock(cursor, limit=50):
+    """Products below their reorder level, most short first: (product_name, quantity, reorder_level)."""
+    cursor.execute('''SELECT product_name, quantity, reorder_level FROM stock
+                      WHERE quantity - reorder_level < 0
+                      ORDER BY quantity - reorder_level LIMIT ?''', (limit,))
+    return cursor.fetchall()
+
+
+def dead_stock(cursor, days=DEAD_STOCK_DAYS, limit=50):
+    """In-stock products not sold (or, if never sold, not added) in `days` days, oldest first.
+
+    Rows are (product_name, quantity, last_sold_at).
+    """
+    cutoff = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+    cursor.execute('''SELECT product_name, quantity, last_sold_at FROM stock
+                      WHERE quantity > 0 AND COALESCE(last_sold_at, date_added) < ?
+                      ORDER BY COALESCE(last_sold_at, date_added) LIMIT ?''', (cutoff, limit))
+    return cursor.fetchall()
+
+
+def high_velocity(cursor, min_units=HIGH_VELOCITY_UNITS, limit=50):
+    """Products with at least `min_units` net sold in the window, fastest first: (product_name, quantity, recent_sold)."""
+    cursor.execute('''SELECT product_name, quantity, recent_sold FROM stock
+                      WHERE recent_sold >= ?
+                      ORDER BY recent_sold DESC LIMIT ?''', (min_units, limit))
+    return cursor.fetchall()
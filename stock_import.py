@@ -0,0 +1,116 @@
+"""
+Bulk stock import
+
+A supplier delivery arrives as a JSON array or a CSV file with the columns
+product_name, quantity, purchase_price, selling_price, supplier.  Rows are
+validated up front, upserted by product key with one executemany call,
+resolved back to their ids with one IN (...) lookup, journaled as receipts
+with their own FIFO cost layers (see inventory.py) and committed in a single
+transaction by the caller.  Supplier credit is
+aggregated to one ledger entry per supplier instead of one per line.
+"""
+
+import csv
+import io
+import string
+from datetime import datetime
+
+from inventory import receive
+from ledger import ensure_party
+
+# Restocking an existing product tops up its row instead of duplicating it; a
+# row without a supplier keeps the one already on file
+UPSERT_STOCK_SQL = '''INSERT INTO stock
+                      (product_name, quantity, purchase_price, selling_price, supplier, date_added)
+                      VALUES (?, ?, ?, ?, ?, ?)
+                      ON CONFLICT(product_name COLLATE NOCASE) DO UPDATE SET
+                      quantity = quantity + excluded.quantity, purchase_price = excluded.purchase_price,
+                      selling_price = excluded.selling_price,
+                      supplier = COALESCE(NULLIF(excluded.supplier, ''), supplier)'''
+
+ID_CHUNK = 500
+_ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+CSV_COLUMNS = ('product_name', 'quantity', 'purchase_price', 'selling_price', 'supplier')
+
+
+def read_csv(stream):
+    """Yield row dicts from an uploaded CSV file stream (header row required)."""
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+    missing = [c for c in CSV_COLUMNS[:4] if c not in (reader.fieldnames or ())]
+    if missing:
+        raise ValueError(f"CSV is missing columns: {', '.join(missing)}")
+    yield from reader
+
+
+def validate_row(row):
+    """Return a clean (name, quantity, purchase_price, selling_price, supplier) tuple or raise ValueError."""
+    if not isinstance(row, dict):
+        raise ValueError("Row must be an object")
+    name = str(row.get('product_name') or '').strip()
+    if not name:
+        raise ValueError("product_name is required")
+    try:
+        quantity = float(row.get('quantity'))
+        purchase_price = float(row.get('purchase_price'))
+        selling_price = float(row.get('selling_price'))
+    except (TypeError, ValueError):
+        raise ValueError("quantity, purchase_price and selling_price must be numbers")
+    if not quantity.is_integer():
+        # int() would quietly turn 2.5 into 2
+        raise ValueError("quantity must be a whole number")
+    quantity = int(quantity)
+    if quantity < 0 or purchase_price < 0 or selling_price < 0:
+        raise ValueError("quantity and prices cannot be negative")
+    supplier = str(row.get('supplier') or '').strip()
+    return name, quantity, purchase_price, selling_price, supplier
+
+
+def _nocase(name):
+    # SQLite's NOCASE folds ASCII letters only
+    return name.translate(_ASCII_LOWER)
+
+
+def receive_deliveries(cursor, deliveries):
+    """Journal upserted (name, quantity, purchase_price, supplier) deliveries as receipts with cost layers."""
+    names = list({_nocase(delivery[0]): delivery[0] for delivery in deliveries}.values())
+    ids = {}
+    # One lookup through the product key; chunked only to stay under older SQLite's 999 variables
+    for start in range(0, len(names), ID_CHUNK):
+        chunk = names[start:start + ID_CHUNK]
+        cursor.execute(f"SELECT id, product_name FROM stock WHERE product_name COLLATE NOCASE IN "
+                       f"({','.join('?' * len(chunk))})", chunk)
+        ids.update((_nocase(name), stock_id) for stock_id, name in cursor.fetchall())
+    for name, quantity, purchase_price, supplier in deliveries:
+        receive(cursor, ids[_nocase(name)], quantity, purchase_price, note=supplier or None)
+
+
+def import_stock(cursor, rows, add_to_credit=False):
+    """Validate and upsert rows; returns (imported count, [{'row': n, 'error': msg}]).
+
+    Rows are numbered from 1 in input order.  Invalid rows are reported and
+    skipped; the caller commits once everything has been written.
+    """
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    valid, errors = [], []
+    supplier_totals = {}
+    for number, row in enumerate(rows, 1):
+        try:
+            name, quantity, purchase_price, selling_price, supplier = validate_row(row)
+        except ValueError as e:
+            errors.append({'row': number, 'error': str(e)})
+            continue
+        valid.append((name, quantity, purchase_price, selling_price, supplier, now))
+        if add_to_credit and supplier:
+            supplier_totals[supplier] = supplier_totals.get(supplier, 0) + quantity * purchase_price
+
+    cursor.executemany(UPSERT_STOCK_SQL, valid)
+    receive_deliveries(cursor, [(name, quantity, purchase_price, supplier)
+                                for name, quantity, purchase_price, _, supplier, _ in valid])
+    for supplier in {row[4] for row in valid if row[4]}:
+        ensure_party(cursor, 'supplier', supplier)
+    cursor.executemany('''INSERT INTO credits (type, name, amount, description, date)
+                          VALUES (?, ?, ?, ?, ?)''',
+                       [("supplier", supplier, total, "Stock purchase: bulk import", now)
+                        for supplier, total in supplier_totals.items()])
+    return len(valid), errors
@@ -0,0 +1,167 @@
+"""
+Stores (tenants), each with its own database file
+
+Every branch gets a separate SQLite file, so writes at one branch never
+wait on another branch's lock and each file stays the size of one shop.
+The default store is DATABASE_PATH as before; other stores live in
+STORE_DIR as <store id>.db or are listed explicitly in STORES
+("branch2=/data/branch2.db,branch3=/data/branch3.db").
+
+select_store() runs before every request and picks the store from, in
+order, the X-Store-ID header, the host (STORE_HOSTS="pos.branch2.example=
+branch2,...", or a subdomain equal to a store id) and the store_id cookie
+set by /select_store.  The request's database connection, caches and
+receipt dispatcher then all follow the chosen file (database.current_path).
+
+fan_out() runs a function against every store on a thread pool, each call
+with its own pooled connection, for cross-store reports.
+"""
+
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import g, jsonify, request
+
+from database import DB_PATH, connection, current_path
+
+DEFAULT_STORE = os.environ.get('DEFAULT_STORE', 'main')
+STORE_DIR = os.environ.get('STORE_DIR', 'store_dbs')
+FAN_OUT_WORKERS = int(os.environ.get('STORE_FAN_OUT_WORKERS', 8))
+STORE_HEADER = 'X-Store-ID'
+STORE_COOKIE = 'store_id'
+
+# Store ids end up in file names, so keep them to a safe alphabet
+STORE_ID = re.compile(r'^[a-z0-9][a-z0-9_-]{0,31}$')
+
+
+def _pairs(value):
+    pairs = {}
+    for entry in (value or '').split(','):
+        if '=' in entry:
+            key, _, item = entry.partition('=')
+            pairs[key.strip().lower()] = item.strip()
+    return pairs
+
+
+_configured = {DEFAULT_STORE: DB_PATH, **_pairs(os.environ.get('STORES'))}
+_hosts = _pairs(os.environ.get('STORE_HOSTS'))
+_known = dict(_configured)
+_known_lock = threading.Lock()
+
+
+def store_path(store_id):
+    """Database file for a store id (whether or not it exists yet)."""
+    if store_id in _configured:
+        return _configured[store_id]
+    if not STORE_ID.match(store_id or ''):
+        raise ValueError(f"Invalid store id: {store_id!r}")
+    return os.path.join(STORE_DIR, f"{store_id}.db")
+
+
+def all_stores():
+    """{store id: database path} for every configured store and every file in STORE_DIR."""
+    stores = dict(_configured)
+    if os.path.isdir(STORE_DIR):
+        for filename in sorted(os.listdir(STORE_DIR)):
+            store_id, ext = os.path.splitext(filename)
+            if ext == '.db' and STORE_ID.match(store_id) and store_id not in stores:
+                stores[store_id] = os.path.join(STORE_DIR, filename)
+    with _known_lock:
+        _known.update(stores)
+    return stores
+
+
+def lookup(store_id):
+    """Path of an existing store, or None; never creates a database."""
+    store_id = (store_id or '').strip().lower()
+    path = _known.get(store_id)
+    if path is None and STORE_ID.match(store_id):
+        candidate = os.path.join(STORE_DIR, f"{store_id}.db")
+        if os.path.exists(candidate):
+            with _known_lock:
+                path = _known.setdefault(store_id, candidate)
+    return path
+
+
+def create_store(store_id):
+    """Make a new store's database file; returns its path.  Run migrations on it afterwards."""
+    store_id = store_id.strip().lower()
+    path = store_path(store_id)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with connection(path):
+        pass
+    with _known_lock:
+        _known[store_id] = path
+    return path
+
+
+def _requested_store():
+    if request.headers.get(STORE_HEADER):
+        return request.headers[STORE_HEADER]
+    host = request.host.split(':')[0].lower()
+    if host in _hosts:
+        return _hosts[host]
+    subdomain = host.split('.')[0]
+    if subdomain != host and lookup(subdomain):
+        return subdomain
+    return request.cookies.get(STORE_COOKIE) or DEFAULT_STORE
+
+
+def select_store():
+    """before_request hook: bind the request to its store's database file."""
+    store_id = _requested_store().strip().lower()
+    path = lookup(store_id)
+    if path is None:
+        return jsonify({'success': False, 'error': f"Unknown store: {store_id}"}), 404
+    g.store_id = store_id
+    g.db_path = path
+
+
+def current_store():
+    return g.get('store_id', DEFAULT_STORE)
+
+
+class StoreLocal:
+    """One instance of a per-worker cache per store, picked by the current request's store.
+
+    Attribute access is forwarded, so `catalog.get(...)` keeps working as it
+    did with a single global cache.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._instances = {}
+        self._lock = threading.Lock()
+
+    def for_path(self, path):
+        instance = self._instances.get(path)
+        if instance is None:
+            with self._lock:
+                instance = self._instances.get(path)
+                if instance is None:
+                    instance = self._instances[path] = self._factory()
+        return instance
+
+    def __getattr__(self, name):
+        return getattr(self.for_path(current_path()), name)
+
+
+def fan_out(fn, stores=None):
+    """Run fn(store_id, cursor) for every store in parallel; returns {store id: result}.
+
+    A store that fails reports {'error': message} instead of failing the whole report.
+    """
+    stores = stores or all_stores()
+
+    def run(item):
+        store_id, path = item
+        try:
+            with connection(path) as conn:
+                return store_id, fn(store_id, conn.cursor())
+        except Exception as e:
+            return store_id, {'error': str(e)}
+
+    with ThreadPoolExecutor(min(FAN_OUT_WORKERS, len(stores)) or 1) as pool:
+        return dict(pool.map(run, stores.items()))
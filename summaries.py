@@ -0,0 +1,72 @@
+"""
+Incrementally maintained dashboard aggregates
+
+summary_totals holds one row per (granularity, period) -- day, month, year
+and a single 'all' row -- with revenue, sale count, expenses and returned
+quantity.  stock_totals is a single running row over the stock table, and
+customer_totals one row per named customer (case-insensitive, first
+spelling kept, walk-in placeholders left out) with their revenue and sale
+count.  All are kept current by triggers, so they change in the same
+transaction as the sale, expense, return or stock write that caused them and
+every writer (present or future) maintains them for free.  Tables and triggers come from migrations 9, 13 (cogs) and 17
+(customers).
+"""
+
+GRANULARITIES = ('day', 'month', 'year', 'all')
+
+# Sales that belong to a named customer: anonymous counter sales are stored
+# under a placeholder name and would otherwise top every customer ranking
+NAMED_CUSTOMER = "customer_name != '' AND customer_name COLLATE NOCASE NOT IN ('Walk-in', 'Walk-in Customer')"
+
+# (granularity, SQL expression turning a 'YYYY-MM-DD HH:MM:SS' column into its period key)
+_PERIODS = (
+    ('day', "substr({col}, 1, 10)"),
+    ('month', "substr({col}, 1, 7)"),
+    ('year', "substr({col}, 1, 4)"),
+    ('all', "'all'"),
+)
+
+
+def period_key(granularity, col):
+    """SQL expression for the summary_totals period of a timestamp column."""
+    return dict(_PERIODS)[granularity].format(col=col)
+
+
+def rebuild_summaries(cursor):
+    """Recompute every rollup from the base tables (backfill / repair)."""
+    cursor.execute("DELETE FROM summary_totals")
+    for table, col, columns, measures in (
+            ('sales', 'sale_date', ('revenue', 'sales_count'), 'SUM(total_amount), COUNT(*)'),
+            ('expenses', 'date', ('expenses',), 'SUM(amount)'),
+            ('returns', 'return_date', ('returns_qty',), 'SUM(quantity)')):
+        updates = ', '.join(f"{c} = excluded.{c}" for c in columns)
+        for granularity, period in _PERIODS:
+            period = period.format(col=col)
+            cursor.execute(f'''INSERT INTO summary_totals (granularity, period, {', '.join(columns)})
+                               SELECT '{granularity}', {period}, {measures} FROM {table}
+                               GROUP BY {period} HAVING COUNT(*) > 0
+                               ON CONFLICT(granularity, period) DO UPDATE SET {updates}''')
+
+    cursor.execute("DELETE FROM stock_totals")
+    cursor.execute('''INSERT INTO stock_totals (id, products, quantity, value)
+                      SELECT 1, COUNT(*), COALESCE(SUM(quantity), 0),
+                             COALESCE(SUM(quantity * purchase_price), 0)
+                      FROM stock''')
+
+    cursor.execute("DELETE FROM customer_totals")
+    cursor.execute(f'''INSERT INTO customer_totals (name, revenue, sales_count)
+                       SELECT MIN(customer_name), SUM(total_amount), COUNT(*) FROM sales
+                       WHERE {NAMED_CUSTOMER} GROUP BY customer_name COLLATE NOCASE''')
+
+
+def get_totals(cursor, granularity='all', period='all'):
+    """Return (revenue, sales_count, expenses, returns_qty) for one period."""
+    cursor.execute('''SELECT revenue, sales_count, expenses, returns_qty FROM summary_totals
+                      WHERE granularity = ? AND period = ?''', (granularity, period))
+    return cursor.fetchone() or (0, 0, 0, 0)
+
+
+def get_stock_totals(cursor):
+    """Return (products, quantity, value) over the whole stock table."""
+    cursor.execute("SELECT products, quantity, value FROM stock_totals WHERE id = 1")
+    return cursor.fetchone() or (0, 0, 0)
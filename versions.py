@@ -0,0 +1,17 @@
+"""
+Cheap per-table data versions
+
+data_versions holds one counter per tracked table, bumped by triggers in
+the same transaction as any insert, update or delete on that table.  Reading
+a counter is a single primary-key lookup, which lets every worker tell
+whether its cached view of a table is still current without re-querying it.
+The table and triggers are created by migration 6.
+"""
+
+TRACKED_TABLES = ('stock', 'sales', 'expenses', 'returns', 'credits')
+
+
+def data_version(cursor, table):
+    cursor.execute("SELECT version FROM data_versions WHERE name = ?", (table,))
+    row = cursor.fetchone()
+    return row[0] if row else 0